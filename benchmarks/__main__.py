@@ -5,10 +5,10 @@
 import subprocess
 import sys
 
-from benchmarks.profilers import DetailedProfiler, RawProfiler
+from benchmarks.profilers import DetailedProfiler, MemoryProfiler, RawProfiler
 from benchmarks import tests
 
-PROFILERS = {cls.__name__: cls() for cls in [RawProfiler, DetailedProfiler]}
+PROFILERS = {cls.__name__: cls() for cls in [RawProfiler, DetailedProfiler, MemoryProfiler]}
 SECTION_DELIM = '-' * 78
 
 
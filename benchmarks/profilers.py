@@ -4,6 +4,7 @@ from cProfile import Profile
 from io import StringIO
 import pstats
 import time
+import tracemalloc
 
 
 class AbstractProfiler:
@@ -77,3 +78,26 @@ class DetailedProfiler(AbstractProfiler):
                         sections += [f.rjust(w), colsep]
                 sections += [path, '\n']
         return ''.join(sections)
+
+
+class MemoryProfiler(AbstractProfiler):
+    """ Records the memory allocated by a function using tracemalloc. The function's return value is still alive
+        at the end of the run, so return the objects of interest to measure the memory they retain. """
+
+    def __init__(self) -> None:
+        self._sizes = []  # Retained and peak memory in bytes for each call to run().
+
+    def run(self, func, *args) -> None:
+        """ Evaluate a function while tracing memory allocations. """
+        tracemalloc.start()
+        try:
+            result = func(*args)
+            self._sizes.append(tracemalloc.get_traced_memory())
+        finally:
+            tracemalloc.stop()
+        del result
+
+    def format_best(self) -> str:
+        """ Format a string with the memory usage of the run that retained the least. """
+        current, peak = min(self._sizes)
+        return f'Retained memory = {current / 2**20:.2f} MiB\nPeak memory = {peak / 2**20:.2f} MiB\n'
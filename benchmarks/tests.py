@@ -70,6 +70,45 @@ def search_regex(n=1000):
     return _search_fn(patterns, count=100, mode_regex=True)
 
 
+def search_typing(n=2000):
+    words = [w for _, w in _random_translations(n)]
+    patterns = [w[:i] for w in words for i in range(1, len(w) + 1)]
+    return _search_fn(patterns, count=100)
+
+
+def search_typing_regex(n=500):
+    patterns = [p for r in _random_regexes(n) for p in (r[:i] for i in range(1, len(r) + 1))]
+    return _search_fn(patterns, count=100, mode_regex=True)
+
+
+def multidict(n=20):
+    from spectra_lexer.search.multidict import forward_multidict, reverse_multidict
+    translations = _get_translations()
+    def run() -> None:
+        for _ in range(n):
+            forward_multidict(translations)
+            reverse_multidict(translations)
+    return run
+
+
+def resource_memory(intern_strings=1):
+    # Compare the MemoryProfiler results with intern_strings = 0 and 1 to see the memory saved by interning.
+    from spectra_lexer.spc_resource import StenoResourceIO
+    from spectra_lexer.spc_search import SearchEngine
+    spectra = _spectra()
+    io = StenoResourceIO(spectra._rule_factory, intern_strings=bool(intern_strings))
+    paths = spectra.translations_paths
+    index_path = spectra.index_path
+    def run() -> SearchEngine:
+        search_engine = SearchEngine(" ", " ", intern_strings=bool(intern_strings))
+        search_engine.set_translations(io.load_json_translations(*paths))
+        search_engine.set_examples(io.load_json_examples(index_path))
+        for mode_strokes in (False, True):
+            search_engine.search("a", mode_strokes=mode_strokes)
+        return search_engine
+    return run
+
+
 def lexer(n=10000):
     samples = _random_translations(n)
     analyzer = _spectra().analyzer
@@ -105,10 +144,8 @@ def board(n=10000):
     return run
 
 
-def http_query(n=1000):
-    from spectra_lexer.app_json import build_app
-    from spectra_lexer.main_http import build_dispatcher
-    import io, json
+def _http_queries(n:int) -> list:
+    import json
     queries = []
     samples = _random_translations(n)
     for item in samples:
@@ -124,8 +161,17 @@ def http_query(n=1000):
                    b"",
                    content]
         queries.append(b"\r\n".join(request))
+    return queries
+
+
+def http_query(n=1000, cache_mb=0, gzip_level=0):
+    # gzip_level = 0 adapts the level to each response.
+    from spectra_lexer.app_json import build_app
+    from spectra_lexer.main_http import build_dispatcher
+    import io
+    queries = _http_queries(n)
     app = build_app(_spectra())
-    dispatcher = build_dispatcher(app)
+    dispatcher = build_dispatcher(app, cache_size=cache_mb << 20, gzip_level=gzip_level or None)
     def run() -> None:
         for data in queries:
             stream = io.BytesIO(data)
@@ -133,6 +179,28 @@ def http_query(n=1000):
     return run
 
 
+def http_gzip_levels(n=300):
+    # Runs the http_query requests at each gzip level (0 for adaptive) and prints throughput and response bytes.
+    from spectra_lexer.app_json import build_app
+    from spectra_lexer.main_http import build_dispatcher
+    import io
+    from time import perf_counter
+    queries = _http_queries(n)
+    app = build_app(_spectra())
+    def run() -> None:
+        print(f'{"level":>5} {"req/s":>8} {"bytes/req":>10}')
+        for level in range(10):
+            dispatcher = build_dispatcher(app, gzip_level=level or None)
+            streams = [io.BytesIO(data) for data in queries]
+            start = perf_counter()
+            for stream in streams:
+                dispatcher.handle_connection(stream, lambda s: None)
+            elapsed = perf_counter() - start
+            total = sum(len(stream.getvalue()) - len(data) for stream, data in zip(streams, queries))
+            print(f'{level or "auto":>5} {n / elapsed:8.1f} {total // n:10}')
+    return run
+
+
 def discord_query(n=100, k=5):
     from spectra_lexer.app_discord import build_app
     samples = _random_translations(n)
@@ -135,7 +135,8 @@ def build_app(spectra:Spectra, max_width:int, max_height:int, *, max_chars=None)
     rasterizer = SVGRasterizer(max_width, max_height)
     translations = io.load_json_translations(*spectra.translations_paths)
     # Ignore Plover glue and case metacharacters so our search engine has a chance to find the actual text.
-    search_engine = SearchEngine(' ', ' {<&>}')
+    # The bot only does exact and similar-key lookups, so compact index storage costs almost nothing in speed.
+    search_engine = SearchEngine(' ', ' {<&>}', compact=True)
     search_engine.set_translations(translations)
     return DiscordApplication(search_engine, analyzer, graph_engine, board_engine, rasterizer,
                               max_chars=max_chars, board_ratio=max_width/max_height)
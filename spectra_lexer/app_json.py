@@ -1,10 +1,12 @@
-from typing import Dict, Sequence
+from copy import copy
+from typing import Dict, List, Optional, Sequence
 
 from spectra_lexer import Spectra
-from spectra_lexer.engine import Engine, build_engine
+from spectra_lexer.engine import Engine, QueryState, build_engine
 from spectra_lexer.http.json import JSONApplication, JSONDict, JSONList, JSONStruct
 from spectra_lexer.spc_board import BoardDiagram
 from spectra_lexer.spc_graph import HTMLGraph
+from spectra_lexer.search.cache import SizedLRUCache
 from spectra_lexer.spc_search import EXPAND_KEY, MatchDict
 
 
@@ -14,14 +16,37 @@ class Request(JSONStruct):
     action: str               # Name of an action method to call.
     args: JSONList            # Positional arguments for the method.
     options: JSONDict = None  # GUI engine options to set before calling the method.
+    lazy_pages: bool = False  # If True, only send the default page of a display. Others are requested with "page".
+
+
+class BatchAction(JSONStruct):
+    """ Contains one action in a batch request. """
+
+    action: str     # Name of an action method to call.
+    args: JSONList  # Positional arguments for the method.
+
+
+class BatchRequest(JSONStruct):
+    """ Contains a list of actions to run in order with the same options. """
+
+    batch: JSONList           # Objects with the fields of a BatchAction.
+    options: JSONDict = None  # GUI engine options to set before calling any method.
+    lazy_pages: bool = False  # If True, only send the default page of a display. Others are requested with "page".
 
 
 class Matches(JSONStruct):
     """ Contains results for the search lists. """
 
-    pattern: str        # Input pattern string.
-    results: MatchDict  # Dictionary of matched strings and each of their translation mappings.
-    can_expand: bool    # If True, a search with more pages may yield more items.
+    pattern: str              # Input pattern string.
+    results: MatchDict        # Dictionary of matched strings and each of their translation mappings.
+    can_expand: bool          # If True, a search with more pages may yield more items.
+    cursor: int = 0           # Index position after the last result. A "search_more" action resumes from here.
+    is_more: bool = False     # If True, these results are a new page to be added after the previous ones.
+    match_count: int = None   # Total number of matches (None if unknown). If not exact, this is an upper bound.
+    count_exact: bool = True  # If True, <match_count> is the exact number of matches.
+    page: int = 1             # Page number of the last results shown so far, as in "page N of M".
+    page_count: int = 1       # Total number of pages for every match. Only exact if <count_exact> is.
+    timed_out: bool = False   # If True, the search ran out of time. Expanding it resumes from <cursor>.
 
 
 class Selections(JSONStruct):
@@ -51,6 +76,7 @@ class Display(JSONStruct):
     letters: str                   # Translation letters.
     pages_by_ref: DisplayPageDict  # Analysis pages keyed by HTML anchor reference.
     default_page: DisplayPage      # Default analysis page with nothing highlighted.
+    page_refs: List[str] = None    # With lazy pages, every valid reference (<pages_by_ref> may have only a few).
 
 
 class Updates(JSONStruct):
@@ -60,33 +86,118 @@ class Updates(JSONStruct):
     selections: Selections = None  # New selections in the search lists.
     display: Display = None        # New graphical objects.
     example_ref: str = None        # Focus reference for an example.
+    page: DisplayPage = None       # A single analysis page requested on its own.
+    page_ref: str = None           # HTML anchor reference for <page>.
 
 
 class JSONGUIApplication(JSONApplication):
-    """ Backend for the AJAX GUI web application. Actions are independent and effectively "stateless".
+    """ Backend for the AJAX GUI web application. Actions are independent and stateless.
+        Each request runs on its own copy of the app with a new engine context, so requests may run on any thread.
         Steno rules may be parsed into a tree of nodes, each of which may have several forms of representation.
         All information for a single node is combined into a display "page" which can be used for GUI updates.
         All display pages for to a single rule or lexer query are further stored in a single data object.
-        This allows for fewer HTTP requests and more opportunities for caching. """
+        This allows for fewer HTTP requests and more opportunities for caching.
+
+        Drawing every page of a large analysis is expensive, and users only ever look at a few of them.
+        With <lazy_pages> set in a request, a display only has the default page and a list of valid references.
+        Each other page is drawn on demand by a "page" action. These arrive in quick succession as the user hovers
+        over the graph, so recent analyses are kept in a small cache shared by every copy of the app.
+
+        A request with a "batch" list instead of an action runs up to <max_batch> actions in order with one set of
+        options, all in one engine context. Their updates are merged into one, with later actions taking priority. """
 
-    def __init__(self, engine:Engine) -> None:
+    # Actions with results that only depend on their arguments and options. Others may be random or change over time.
+    CACHEABLE_ACTIONS = {"query", "query_match", "page"}
+
+    # Groups of actions where a newer request makes older ones obsolete, such as searches while typing.
+    CANCEL_GROUPS = {"search": "search", "search_rules": "search",
+                     "query": "query", "query_match": "query",
+                     "page": "page"}
+
+    def __init__(self, engine:Engine, *, analysis_cache_size=10000, analysis_cache_ttl=300.0, max_batch=8) -> None:
         self._engine = engine
+        self._max_batch = max_batch  # Maximum number of actions in a batch request.
+        self._lazy_pages = False  # If True, displays only include pages that are needed right away.
+        # Recent query states. The limit is on the total number of graph nodes since those are what take up memory.
+        # Page requests for a query come within seconds of it, so there is no use keeping states much longer.
+        self._analyses = SizedLRUCache(analysis_cache_size, self._state_size, max_age=analysis_cache_ttl)
+
+    @staticmethod
+    def _state_size(state:QueryState) -> int:
+        _, graph = state
+        return len(graph) + 1
+
+    def is_cacheable(self, obj:JSONDict) -> bool:
+        if not isinstance(obj, dict):
+            return False
+        batch = obj.get("batch", [obj])
+        return isinstance(batch, list) and all(isinstance(item, dict) and item.get("action") in self.CACHEABLE_ACTIONS
+                                               for item in batch)
+
+    def cancel_group(self, obj:JSONDict) -> Optional[str]:
+        action = obj.get("action") if isinstance(obj, dict) else None
+        return self.CANCEL_GROUPS.get(action) if isinstance(action, str) else None
+
+    def _fork(self, options:dict, lazy_pages:bool) -> "JSONGUIApplication":
+        """ Return a copy of this app with its own engine context set to <options>.
+            Other copies may be running actions on other threads; this one won't touch their state. """
+        app = copy(self)
+        app._engine = self._engine.fork(options)
+        app._lazy_pages = lazy_pages
+        return app
+
+    def _call(self, action:str, args:JSONList) -> Updates:
+        method = getattr(self, "do_" + action)
+        return method(*args)
+
+    def _run_batch(self, req:BatchRequest) -> Updates:
+        """ Perform every action in a batch request in order and merge their updates. """
+        batch = req.batch
+        if not isinstance(batch, list) or not 0 < len(batch) <= self._max_batch:
+            raise ValueError(f'Batch must be a list of 1 to {self._max_batch} actions.')
+        if not all(isinstance(item, dict) for item in batch):
+            raise TypeError('Batch actions must be JSON objects.')
+        actions = [BatchAction(**item) for item in batch]
+        app = self._fork(req.options or {}, req.lazy_pages)
+        updates = Updates()
+        for action in actions:
+            result = app._call(action.action, action.args)
+            updates.update({k: v for k, v in result.items() if v is not None})
+        return updates
 
     def run(self, obj:JSONDict) -> JSONDict:
-        """ Perform a requested app action. Engine state must be reset each time. """
+        """ Perform a requested app action (or batch of actions) in a new request context. """
         if not isinstance(obj, dict):
             raise TypeError('Top level of input data must be a JSON object.')
+        if "batch" in obj:
+            return self._run_batch(BatchRequest(**obj))
         req = Request(**obj)
-        self._engine.set_options(req.options or {})
-        method = getattr(self, "do_" + req.action)
-        return method(*req.args)
+        app = self._fork(req.options or {}, req.lazy_pages)
+        return app._call(req.action, req.args)
 
-    def _match(self, pattern:str, pages:int) -> Matches:
-        results = self._engine.search(pattern, pages)
+    def _match(self, pattern:str, pages=1, cursor=0) -> Matches:
+        start = cursor
+        results, cursor, timed_out = self._engine.search_page(pattern, cursor, pages)
         can_expand = (results.pop(EXPAND_KEY, None) is not None)
+        # Counting only takes a few bisections, so it is cheap even for huge numbers of matches.
+        total = self._engine.count_matches(pattern)
+        if not can_expand:
+            shown = total.high
+        elif not start:
+            # A search from the start has every match before its cursor, so there is nothing more to count.
+            shown = len(results)
+        else:
+            shown = self._engine.count_matches(pattern, cursor).high
+        page_count = self._engine.count_pages(total.high)
         return Matches(pattern=pattern,
                        results=results,
-                       can_expand=can_expand)
+                       can_expand=can_expand,
+                       cursor=cursor,
+                       match_count=total.high,
+                       count_exact=(total.low == total.high),
+                       page=min(self._engine.count_pages(shown), page_count),
+                       page_count=page_count,
+                       timed_out=timed_out)
 
     def _select(self, keys:str, letters:str) -> Selections:
         match, mapping = self._engine.search_selection(keys, letters)
@@ -101,23 +212,60 @@ class JSONGUIApplication(JSONApplication):
                            board=self._engine.draw_board(),
                            rule_id=self._engine.get_example_id())
 
-    def _display(self, keys:str, letters:str) -> Display:
-        """ Run a query and return a full set of display data including all possible selections. """
-        self._engine.run_query(keys, letters)
+    def _run_query(self, keys:str, letters:str) -> None:
+        """ Run a lexer query, or reuse its state if the same query was run recently. """
+        engine = self._engine
+        def analyze() -> QueryState:
+            engine.run_query(keys, letters)
+            return engine.get_query_state()
+        state = self._analyses.get(engine.query_key(keys, letters), analyze)
+        engine.set_query_state(state)
+
+    def _display(self, keys:str, letters:str, *focus_refs:str) -> Display:
+        """ Run a query and return a full set of display data for it. """
+        self._run_query(keys, letters)
+        return self._draw_display(keys, letters, *focus_refs)
+
+    def _draw_display(self, keys:str, letters:str, *focus_refs:str) -> Display:
+        """ Return a full set of display data for the last query including all possible selections.
+            With lazy pages, only include the pages for <focus_refs> and a list of every valid reference. """
         default_page = self._draw_page()
+        all_refs = self._engine.get_refs()
+        page_refs = None
+        if self._lazy_pages:
+            page_refs = all_refs
+            all_refs = [ref for ref in focus_refs if ref in page_refs]
         pages_by_ref = {}
-        for ref in self._engine.get_refs():
+        for ref in all_refs:
             self._engine.select_ref(ref)
             pages_by_ref[ref] = self._draw_page()
         return Display(keys=keys,
                        letters=letters,
                        pages_by_ref=pages_by_ref,
-                       default_page=default_page)
+                       default_page=default_page,
+                       page_refs=page_refs)
 
     def do_search(self, pattern:str, pages:int) -> Updates:
         """ Do a new search and return results (unless the pattern is just whitespace). """
         return Updates(matches=self._match(pattern, pages))
 
+    def do_search_more(self, pattern:str, cursor:int) -> Updates:
+        """ Continue a search from <cursor> and return only the next page of results. """
+        matches = self._match(pattern, 1, cursor)
+        matches.is_more = True
+        return Updates(matches=matches)
+
+    def do_search_rules(self, rule_ids:Sequence[str], match_all:bool, pages:int) -> Updates:
+        """ Search for examples that use every rule in <rule_ids> (or any of them if not <match_all>). """
+        if not isinstance(rule_ids, list) or not all(isinstance(r_id, str) for r_id in rule_ids):
+            raise TypeError('Rule IDs must be a list of strings.')
+        results = self._engine.search_rules(rule_ids, match_all, pages)
+        can_expand = (results.pop(EXPAND_KEY, None) is not None)
+        pattern = (" & " if match_all else " | ").join(rule_ids)
+        return Updates(matches=Matches(pattern=pattern,
+                                       results=results,
+                                       can_expand=can_expand))
+
     def do_query(self, keys:str, letters:str) -> Updates:
         """ Execute and return a full display of a lexer query. """
         return Updates(display=self._display(keys, letters))
@@ -128,6 +276,15 @@ class JSONGUIApplication(JSONApplication):
         return Updates(selections=self._select(keys, letters),
                        display=self._display(keys, letters))
 
+    def do_page(self, keys:str, letters:str, ref:str) -> Updates:
+        """ Return the display page for a single graph node <ref> in a lexer query.
+            The default page is returned for invalid references, as with a full display. """
+        self._run_query(keys, letters)
+        if ref in self._engine.get_refs():
+            self._engine.select_ref(ref)
+        return Updates(page=self._draw_page(),
+                       page_ref=ref)
+
     def do_search_examples(self, link_ref:str) -> Updates:
         """ Search for examples of the named rule and display one at random. """
         pattern = self._engine.random_pattern(link_ref)
@@ -135,13 +292,24 @@ class JSONGUIApplication(JSONApplication):
             return Updates()
         matches = self._match(pattern, 1)
         keys, letters = self._engine.random_translation(matches.results)
+        selections = self._select(keys, letters)
+        self._run_query(keys, letters)
+        example_ref = self._engine.find_ref(link_ref)
         return Updates(matches=matches,
-                       selections=self._select(keys, letters),
-                       display=self._display(keys, letters),
-                       example_ref=self._engine.find_ref(link_ref))
+                       selections=selections,
+                       display=self._draw_display(keys, letters, example_ref),
+                       example_ref=example_ref)
 
 
-def build_app(spectra:Spectra) -> JSONGUIApplication:
+def build_app(spectra:Spectra, *, prewarm_search=False, prewarm_examples=0, regex_timeout:float=None,
+              regex_shards=0, max_batch=8) -> JSONGUIApplication:
+    spectra.search_engine.set_regex_timeout(regex_timeout)
+    spectra.search_engine.set_regex_shards(regex_shards)
     engine = build_engine(spectra)
     engine.load_initial()
-    return JSONGUIApplication(engine)
+    if prewarm_search:
+        # Examples share results with translation search data, so this goes first.
+        engine.prewarm_search()
+    if prewarm_examples:
+        engine.prewarm_examples(prewarm_examples)
+    return JSONGUIApplication(engine, max_batch=max_batch)
@@ -35,6 +35,7 @@ TR_DELIMITER = '->'  # Delimiter between keys and letters of translations shown
 TR_MSG_CHANGED = 'Press Enter to parse any changes.'
 TR_MSG_EDELIMITERS = 'ERROR: An arrow "->" must separate the steno keys and translated text.'
 TR_MSG_EBLANK = 'ERROR: One or both sides is empty.'
+TR_MSG_TIMEOUT = 'Search timed out. Select the last item to continue it.'
 
 CONFIG_SECTION_KEY = "app_qt"  # We only need one config section; this is its key for CFG format.
 
@@ -133,12 +134,23 @@ class QtGUIApplication(GUIHooks):
         self.set_options()
         self.run_query(keys, letters)
 
-    def on_search_input(self, pattern:str, pages:int) -> None:
+    def on_search_input(self, pattern:str) -> None:
         """ Run a translation search and update the GUI with any results. """
         self.set_options()
-        matches = self._engine.search(pattern, pages)
+        matches, cursor, timed_out = self._engine.search_page(pattern)
         can_expand = (matches.pop(EXPAND_KEY, None) is not None)
-        self._gui.set_matches(matches, can_expand=can_expand)
+        self._gui.set_matches(matches, can_expand=can_expand, cursor=cursor)
+        if timed_out:
+            self._gui.set_caption(TR_MSG_TIMEOUT)
+
+    def on_search_more(self, pattern:str, cursor:int) -> None:
+        """ Search for one more page of results starting from <cursor> and add them to the GUI. """
+        self.set_options()
+        matches, cursor, timed_out = self._engine.search_page(pattern, cursor)
+        can_expand = (matches.pop(EXPAND_KEY, None) is not None)
+        self._gui.add_matches(matches, can_expand=can_expand, cursor=cursor)
+        if timed_out:
+            self._gui.set_caption(TR_MSG_TIMEOUT)
 
     def on_search_multiquery(self, match:str, mappings:Sequence[str]) -> None:
         self.set_options()
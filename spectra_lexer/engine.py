@@ -1,6 +1,7 @@
+from copy import copy
 import random
 from types import SimpleNamespace
-from typing import List, Sequence
+from typing import Hashable, List, Sequence, Tuple
 
 from spectra_lexer import Spectra
 from spectra_lexer.resource.rules import StenoRule
@@ -9,7 +10,7 @@ from spectra_lexer.spc_board import BoardDiagram, BoardEngine
 from spectra_lexer.spc_graph import GraphEngine, GraphTree, HTMLGraph
 from spectra_lexer.spc_lexer import StenoAnalyzer
 from spectra_lexer.spc_resource import StenoResourceIO
-from spectra_lexer.spc_search import MatchDict, SearchEngine
+from spectra_lexer.spc_search import MatchCount, MatchDict, SearchEngine, SearchPage
 
 
 class EngineOptions(SimpleNamespace):
@@ -17,6 +18,7 @@ class EngineOptions(SimpleNamespace):
 
     search_mode_strokes: bool = False       # If True, search for strokes instead of translations.
     search_mode_regex: bool = False         # If True, perform search using regex characters.
+    search_mode_chords: bool = False        # If True, search for strokes by key structure (always in strokes mode).
     search_match_limit: int = 100           # Maximum number of matches returned on one page of a search.
     lexer_strict_mode: bool = False         # Only return lexer results that match every key in a translation.
     board_aspect_ratio: float = None        # Aspect ratio for board viewing area (None means pure horizontal layout).
@@ -26,6 +28,9 @@ class EngineOptions(SimpleNamespace):
     graph_compatibility_mode: bool = False  # Force correct spacing in the graph using HTML tables.
 
 
+QueryState = Tuple[StenoRule, GraphTree]  # Analysis of a query along with its graph.
+
+
 class Engine:
     """ Main layer for executing common user actions. """
 
@@ -34,32 +39,58 @@ class Engine:
     _ref: str             # Most recently selected graph node reference.
 
     def __init__(self, io:StenoResourceIO, search_engine:SearchEngine, analyzer:StenoAnalyzer,
-                 graph_engine:GraphEngine, board_engine:BoardEngine, translations_paths=(), examples_path="") -> None:
+                 graph_engine:GraphEngine, board_engine:BoardEngine, translations_paths=(), examples_path="",
+                 search_index_path="", examples_index_path="") -> None:
         self._io = io
         self._search_engine = search_engine
         self._analyzer = analyzer
         self._graph_engine = graph_engine
         self._board_engine = board_engine
-        self._translations_paths = translations_paths  # Starting translation file paths.
-        self._examples_path = examples_path            # User examples index file path.
-        self._opts = EngineOptions()                   # Current user options.
-        self._translations = {}                        # Currently loaded translations (for indexing).
-        self.run_query("", "")                         # Start with a valid (dummy) analysis state.
+        self._translations_paths = translations_paths    # Starting translation file paths.
+        self._examples_path = examples_path              # User examples index file path.
+        self._search_index_path = search_index_path      # Binary search index file path for the starting translations.
+        self._examples_index_path = examples_index_path  # Binary examples index file path for the starting examples.
+        self._opts = EngineOptions()                     # Current user options.
+        self.run_query("", "")                           # Start with a valid (dummy) analysis state.
 
     def set_options(self, options:dict) -> None:
         """ Replace all <options> at once. """
         self._opts = EngineOptions(**options)
 
+    def fork(self, options:dict=None) -> "Engine":
+        """ Return a new engine context with its own <options> and query state, sharing every resource with this one.
+            Contexts may run actions on different threads at once; none of them can see another's state.
+            Resources (translations, examples, etc.) are still shared, so they should not be reloaded meanwhile. """
+        engine = copy(self)
+        engine.set_options(options or {})
+        return engine
+
     def set_translations(self, translations:TranslationsDict) -> None:
-        """ Send a new translations dict to the search engine. Keep a copy in case we need to make an index. """
+        """ Send a new translations dict to the search engine. """
         self._search_engine.set_translations(translations)
-        self._translations = translations
 
     def load_translations(self, *filenames:str) -> None:
         """ Load and merge RTFCRE steno translations from JSON files. """
         translations = self._io.load_json_translations(*filenames)
         self.set_translations(translations)
 
+    def _load_initial_translations(self) -> None:
+        """ Load the starting translations from the binary search index if it is up to date with the JSON files.
+            Otherwise, load them from JSON as usual and try to write a new search index for next time. """
+        filenames = self._translations_paths
+        index_path = self._search_index_path
+        if not index_path:
+            self.load_translations(*filenames)
+            return
+        stamp = self._io.file_stamp(*filenames)
+        if self._search_engine.load_index(index_path, stamp):
+            return
+        self.load_translations(*filenames)
+        try:
+            self._search_engine.save_index(index_path, stamp)
+        except OSError:
+            pass
+
     def set_examples(self, examples:ExamplesDict) -> None:
         """ Send a new examples index dict to the search engine. """
         self._search_engine.set_examples(examples)
@@ -69,10 +100,37 @@ class Engine:
         examples = self._io.load_json_examples(filename)
         self.set_examples(examples)
 
+    def _load_initial_examples(self) -> None:
+        """ Load the starting examples index from its binary form if it is up to date with the JSON file.
+            Otherwise, load it from JSON as usual and try to write a new binary form for next time. """
+        filename = self._examples_path
+        bin_filename = self._examples_index_path
+        if not bin_filename:
+            self.load_examples(filename)
+            return
+        stamp = self._io.file_stamp(filename)
+        try:
+            examples = self._io.load_binary_examples(bin_filename, stamp)
+        except (OSError, ValueError):
+            examples = self._io.load_json_examples(filename)
+            try:
+                self._io.save_binary_examples(bin_filename, examples, stamp)
+            except OSError:
+                pass
+        self.set_examples(examples)
+
+    def prewarm_search(self) -> None:
+        """ Compile all translation search data ahead of time instead of on the first search that needs it. """
+        self._search_engine.prewarm_search()
+
+    def prewarm_examples(self, count:int) -> None:
+        """ Compile search data ahead of time for the <count> rules with the most examples. """
+        self._search_engine.prewarm_examples(count)
+
     def compile_examples(self, filt:TranslationFilter=None) -> None:
         """ Make an examples index for the current translations with an optional <filt>er.
             Set the new index as active and save it as JSON. """
-        pairs = self._translations.items()
+        pairs = self._search_engine.get_translations().items()
         if filt is not None:
             pairs = filt.filter(pairs)
         examples = self._analyzer.compile_index(pairs)
@@ -83,30 +141,59 @@ class Engine:
         """ Load optional startup resources. Ignore I/O errors since any of them may be missing. """
         if self._translations_paths:
             try:
-                self.load_translations(*self._translations_paths)
+                self._load_initial_translations()
             except OSError:
                 pass
         if self._examples_path:
             try:
-                self.load_examples(self._examples_path)
+                self._load_initial_examples()
             except OSError:
                 pass
 
+    def _mode_strokes(self) -> bool:
+        """ Return True if search results map strokes to translations. Chord searches always do. """
+        return self._opts.search_mode_strokes or self._opts.search_mode_chords
+
     def search(self, pattern:str, pages=1) -> MatchDict:
         """ Perform a search based on the current options. """
+        return self.search_page(pattern, 0, pages).matches
+
+    def search_page(self, pattern:str, cursor=0, pages=1) -> SearchPage:
+        """ Perform a search starting from <cursor> and return the results with a cursor for the following page. """
         count = pages * self._opts.search_match_limit
-        mode_strokes = self._opts.search_mode_strokes
+        mode_strokes = self._mode_strokes()
+        mode_regex = self._opts.search_mode_regex
+        mode_chords = self._opts.search_mode_chords
+        return self._search_engine.search_page(pattern, count, cursor, mode_strokes=mode_strokes,
+                                               mode_regex=mode_regex, mode_chords=mode_chords)
+
+    def count_matches(self, pattern:str, cursor:int=None) -> MatchCount:
+        """ Count the matches for a search based on the current options (only those before <cursor> if given). """
+        mode_strokes = self._mode_strokes()
         mode_regex = self._opts.search_mode_regex
-        return self._search_engine.search(pattern, count, mode_strokes=mode_strokes, mode_regex=mode_regex)
+        mode_chords = self._opts.search_mode_chords
+        return self._search_engine.count(pattern, cursor, mode_strokes=mode_strokes,
+                                         mode_regex=mode_regex, mode_chords=mode_chords)
+
+    def count_pages(self, n_matches:int) -> int:
+        """ Return the number of pages it takes to show <n_matches>. Even no matches take one (empty) page. """
+        limit = self._opts.search_match_limit
+        return max(-(-n_matches // limit), 1)
+
+    def search_rules(self, rule_ids:Sequence[str], match_all=True, pages=1) -> MatchDict:
+        """ Search for examples that use all of <rule_ids> (or any of them if <match_all> is False). """
+        count = pages * self._opts.search_match_limit
+        mode_strokes = self._mode_strokes()
+        return self._search_engine.search_rules(rule_ids, count, match_all=match_all, mode_strokes=mode_strokes)
 
     def random_pattern(self, example_id:str) -> str:
         """ Return a valid example search pattern for <example_id> centered on a random translation if one exists. """
-        mode_strokes = self._opts.search_mode_strokes
+        mode_strokes = self._mode_strokes()
         return self._search_engine.random_pattern(example_id, mode_strokes=mode_strokes)
 
     def best_translation(self, match:str, mappings:Sequence[str]) -> Translation:
         """ Return the best translation in a match-mappings pair from search. """
-        if self._opts.search_mode_strokes:
+        if self._mode_strokes():
             # There can only be one mapping in strokes mode.
             keys = match
             letters = mappings[0]
@@ -123,7 +210,7 @@ class Engine:
         return self.best_translation(match, mappings)
 
     def search_selection(self, keys:str, letters:str) -> List[str]:
-        return [keys, letters] if self._opts.search_mode_strokes else [letters, keys]
+        return [keys, letters] if self._mode_strokes() else [letters, keys]
 
     def run_query(self, keys:str, letters:str) -> None:
         """ Run a lexer analysis and build a node graph of every rule in it recursively. """
@@ -131,6 +218,20 @@ class Engine:
         self._graph = self._graph_engine.graph(self._analysis, compressed=self._opts.graph_compressed_layout)
         self._ref = ""
 
+    def query_key(self, keys:str, letters:str) -> Hashable:
+        """ Return a key for the query state of <keys> and <letters> under the current options.
+            Queries with equal keys always produce the same analysis and graph. """
+        return keys, letters, self._opts.lexer_strict_mode, self._opts.graph_compressed_layout
+
+    def get_query_state(self) -> QueryState:
+        """ Return the current analysis and graph. Neither is ever modified, so they may be shared. """
+        return self._analysis, self._graph
+
+    def set_query_state(self, state:QueryState) -> None:
+        """ Restore an analysis and graph from get_query_state() with nothing selected. """
+        self._analysis, self._graph = state
+        self._ref = ""
+
     def get_refs(self) -> List[str]:
         """ Return a list of all valid graph node reference strings. """
         return list(self._graph)
@@ -199,4 +300,7 @@ def build_engine(spectra:Spectra) -> Engine:
     board_engine = spectra.board_engine
     translations_paths = spectra.translations_paths
     index_path = spectra.index_path
-    return Engine(io, search_engine, analyzer, graph_engine, board_engine, translations_paths, index_path)
+    search_index_path = spectra.search_index_path
+    examples_index_path = spectra.examples_index_path
+    return Engine(io, search_engine, analyzer, graph_engine, board_engine,
+                  translations_paths, index_path, search_index_path, examples_index_path)
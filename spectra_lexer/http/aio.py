@@ -0,0 +1,206 @@
+""" Module for servicing HTTP connections with asyncio instead of a thread for each connection. """
+
+import asyncio
+from concurrent.futures import Executor
+from io import BytesIO
+import os
+from socket import socket
+from traceback import format_exc
+from typing import BinaryIO, Optional
+
+from .connect import HTTPConnectionHandler
+from .request import HTTPRequest, HTTPRequestReader
+from .response import HTTPResponseWriter
+from .service import HTTPRequestHandler
+from .status import HTTPError
+from .tcp import LineLogger, TCPServerSocket
+
+# get_event_loop() is deprecated inside coroutines, but Python 3.6 has nothing else.
+_running_loop = getattr(asyncio, "get_running_loop", asyncio.get_event_loop)
+
+
+class AsyncHTTPConnectionHandler(HTTPConnectionHandler):
+    """ Handles asyncio TCP streams by dispatching HTTP requests to a request handler.
+        Requests are parsed and responses are written by the same classes as the blocking handler, but all waiting
+        on the client happens in the event loop. An idle keep-alive connection costs little more than a coroutine.
+        The request handler itself is blocking (and may be CPU-bound), so it runs in <executor>. """
+
+    def __init__(self, req_handler:HTTPRequestHandler, *, server_version:str=None, executor:Executor=None,
+                 max_header_size=65536, max_content_size=1 << 20) -> None:
+        super().__init__(req_handler, server_version=server_version, max_content_size=max_content_size)
+        self._executor = executor                # Runs the request handler (None for the loop's default executor).
+        self._max_header_size = max_header_size  # Maximum combined size of headers in bytes.
+
+    async def handle_stream(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter,
+                            log:LineLogger, idle_timeout:float=None) -> None:
+        """ Process all HTTP requests on an open TCP stream and write log messages until close.
+            If the client sends nothing for <idle_timeout> seconds, close the connection. """
+        try:
+            log("Connection opened.")
+            await self._process(reader, writer, log, idle_timeout)
+            log("Connection terminated.")
+        except asyncio.CancelledError:
+            log("Connection closed by server shutdown.")
+            raise
+        except asyncio.TimeoutError:
+            log("Connection timed out.")
+        except (OSError, asyncio.IncompleteReadError):
+            log("Connection aborted by OS.")
+        except HTTPError:
+            log("Connection terminated by error.")
+        except Exception:
+            log('Connection terminated with exception:')
+            log(format_exc())
+
+    async def _process(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter,
+                       log:LineLogger, idle_timeout:float=None) -> None:
+        """ Process requests and write log messages until connection close or error. """
+        loop = _running_loop()
+        resp_writer = HTTPResponseWriter(writer)
+        while True:
+            request = None
+            try:
+                request = await asyncio.wait_for(self._read_request(reader), idle_timeout)
+                if request is None:
+                    return
+                headers = request.headers
+                if headers.expect_continue():
+                    log(self._handle_continue(request, resp_writer))
+                    await writer.drain()
+                # A client that trickles its content must time out the same as one that trickles its headers.
+                request.content = await asyncio.wait_for(reader.readexactly(headers.content_length()), idle_timeout)
+                response = await loop.run_in_executor(self._executor, self._req_handler, request)
+                # Files are sent separately. Copying them with the response writer would block the event loop.
+                fp = response.content_file
+                response.content_file = None
+                log(self._send(request, response, resp_writer))
+                await writer.drain()
+                if fp is not None:
+                    with fp:
+                        await self._send_file(writer, fp)
+                if not headers.keep_alive():
+                    return
+            except HTTPError as e:
+                log(self._handle_error(request, resp_writer, e))
+                await writer.drain()
+                raise
+            except (asyncio.CancelledError, asyncio.TimeoutError, asyncio.IncompleteReadError, OSError):
+                # The client went idle or away (or the server is shutting down). There is no one to respond to.
+                raise
+            except Exception:
+                # For non-HTTP exceptions, send an internal error response and reraise to log the traceback.
+                e = HTTPError.INTERNAL_SERVER_ERROR()
+                log(self._handle_error(request, resp_writer, e))
+                await writer.drain()
+                raise
+
+    async def _send_file(self, writer:asyncio.StreamWriter, fp:BinaryIO) -> None:
+        """ Send the rest of a binary file. Let the OS send it directly if it can (Python 3.7+).
+            Otherwise, read it in chunks on the executor and wait for each one to drain. """
+        loop = _running_loop()
+        sendfile = getattr(loop, "sendfile", None)
+        if sendfile is not None:
+            await sendfile(writer.transport, fp, fp.tell())
+            return
+        while True:
+            chunk = await loop.run_in_executor(self._executor, fp.read, 65536)
+            if not chunk:
+                return
+            writer.write(chunk)
+            await writer.drain()
+
+    async def _read_request(self, reader:asyncio.StreamReader) -> Optional[HTTPRequest]:
+        """ Read the request line and headers, then parse them with the standard request reader.
+            The content is left unread; it may depend on sending a continue response first.
+            If the client closed the connection before sending anything, return None. """
+        lines = []
+        size_left = self._max_header_size
+        while True:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                # The line went past the stream buffer limit before a newline.
+                raise HTTPError.REQUEST_HEADER_FIELDS_TOO_LARGE()
+            size_left -= len(line)
+            if size_left < 0:
+                raise HTTPError.REQUEST_HEADER_FIELDS_TOO_LARGE()
+            if not line.strip():
+                break
+            lines.append(line)
+        if not lines:
+            return None
+        # There is no content in the buffer yet, so the parsed request will have none.
+        # The reader still checks the content length against the same limit as the blocking handler.
+        return HTTPRequestReader(BytesIO(b''.join(lines)), max_content_size=self._max_content_size).read()
+
+
+class AsyncHTTPServer:
+    """ HTTP server using asyncio streams. The interface matches TCPServer, but it only works with HTTP.
+        Request handlers run in an executor, so they (and the logger) must be thread-safe. """
+
+    def __init__(self, handler:AsyncHTTPConnectionHandler, *, logger:LineLogger=print,
+                 idle_timeout:float=None) -> None:
+        self._handler = handler            # Handler of HTTP connections.
+        self._logger = logger              # Line-based string callable used to log handler messages.
+        self._idle_timeout = idle_timeout  # Timeout in seconds for idle connections (None for no limit).
+        self._loop = None                  # Event loop while the server is running.
+        self._stopped = None               # Event set by shutdown() while the server is running.
+        self._tasks = set()                # Tasks for every open connection.
+
+    def start(self, address:str, port:int) -> None:
+        """ Run an event loop which serves connections on <address:port> until another thread calls shutdown(). """
+        self._run(host=address, port=port, reuse_address=True)
+
+    def serve(self, sock:TCPServerSocket) -> None:
+        """ Run an event loop which serves connections from a listening server socket until shutdown().
+            The socket may be shared with other processes. It is not closed afterward. """
+        # asyncio needs a standard socket object. Give it a duplicate so that closing the server leaves ours open.
+        dup_sock = socket(sock.family, sock.type, sock.proto, os.dup(sock.fileno()))
+        self._run(sock=dup_sock)
+
+    def _run(self, **server_kwargs) -> None:
+        """ Run an event loop which serves connections with <server_kwargs> for asyncio.start_server(). """
+        if self._loop is not None:
+            raise RuntimeError("Server already running.")
+        loop = self._loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self._serve(**server_kwargs))
+        finally:
+            self._loop = self._stopped = None
+            loop.close()
+
+    async def _serve(self, **server_kwargs) -> None:
+        """ Listen for connections until stopped, then cancel every open connection. """
+        self._stopped = asyncio.Event()
+        server = await asyncio.start_server(self._connect, **server_kwargs)
+        try:
+            await self._stopped.wait()
+        finally:
+            server.close()
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            await server.wait_closed()
+
+    def _connect(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter) -> None:
+        """ Start a task to handle a newly established TCP connection. Keep track of it until it is finished. """
+        task = self._loop.create_task(self._handle(reader, writer))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _handle(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter) -> None:
+        """ Send a TCP connection to the handler. Add the client address and port to all log messages.
+            Close the connection when finished. """
+        addr, port, *_ = writer.get_extra_info('peername')
+        def log(message:str) -> None:
+            self._logger(f'{addr}:{port} - {message}')
+        try:
+            await self._handler.handle_stream(reader, writer, log, self._idle_timeout)
+        finally:
+            writer.close()
+
+    def shutdown(self) -> None:
+        """ Halt serving and close any open connections. May be called by another thread. """
+        loop = self._loop
+        if loop is not None and self._stopped is not None:
+            loop.call_soon_threadsafe(self._stopped.set)
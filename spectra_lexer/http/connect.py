@@ -1,31 +1,52 @@
 """ Module for servicing HTTP connections and requests using I/O streams. """
 
+from functools import partial
+from socket import timeout as SocketTimeout
+from threading import Lock
 from traceback import format_exc
-from typing import BinaryIO, Iterator, Optional
+from typing import BinaryIO, Optional
 
 from .request import HTTPRequest, HTTPRequestReader
 from .response import HTTPResponse, HTTPResponseHeaders, HTTPResponseWriter
 from .status import HTTPError
 from .service import HTTPRequestHandler
-from .tcp import LineLogger, TCPConnectionHandler
+from .tcp import ConnectionHandoff, LineLogger, TCPConnectionHandler
+from .websocket import upgrade_response, WebSocketConnection, WebSocketError, WebSocketHandler
 
 
 class HTTPConnectionHandler(TCPConnectionHandler):
     """ Handles TCP connections by dispatching HTTP requests to a request handler.
         Threading is required to prevent one client from hogging the entire server with a persistent connection.
-        To that end, this class is thread-safe to the extent that the request handler and logger are. """
+        To that end, this class is thread-safe to the extent that the request handler and logger are.
+        Requests to upgrade to a WebSocket on a path with a WebSocket handler are given to that handler instead.
+        The connection is handed off to the server to finish, since it may stay open for as long as the client
+        wants. Servers with a thread pool give it a thread of its own, so up to <max_websockets> are allowed
+        (None for no limit). Upgrade requests past that limit get a 503. """
 
-    def __init__(self, req_handler:HTTPRequestHandler, *, server_version:str=None) -> None:
-        self._req_handler = req_handler        # Handler for all HTTP requests. May delegate to subhandlers.
-        self._server_version = server_version  # Optional server version string sent with each response.
+    def __init__(self, req_handler:HTTPRequestHandler, *, server_version:str=None, max_content_size=1 << 20,
+                 max_websockets:int=None) -> None:
+        self._req_handler = req_handler            # Handler for all HTTP requests. May delegate to subhandlers.
+        self._server_version = server_version      # Optional server version string sent with each response.
+        self._max_content_size = max_content_size  # Maximum size of request content in bytes.
+        self._ws_handlers = {}                     # Table of WebSocket handlers by lowercase URI path.
+        self._max_websockets = max_websockets      # Maximum number of open WebSockets (None for no limit).
+        self._ws_count = 0                         # Number of WebSockets open now.
+        self._ws_lock = Lock()                     # Lock for the WebSocket counter.
 
-    def handle_connection(self, stream:BinaryIO, log:LineLogger) -> None:
-        """ Process all HTTP requests on an open TCP stream and write log messages until close. """
+    def add_websocket_route(self, path:str, handler:WebSocketHandler) -> None:
+        self._ws_handlers[path.lower()] = handler
+
+    def handle_connection(self, stream:BinaryIO, log:LineLogger) -> Optional[ConnectionHandoff]:
+        """ Process all HTTP requests on an open TCP stream and write log messages until close.
+            After a WebSocket upgrade, return a handoff function to run the WebSocket handler. """
         try:
             log("Connection opened.")
-            for s in self._process(stream):
-                log(s)
+            ws_handler = self._process(stream, log)
+            if ws_handler is not None:
+                return partial(self._handle_websocket, ws_handler, stream, log)
             log("Connection terminated.")
+        except SocketTimeout:
+            log("Connection timed out.")
         except OSError:
             log("Connection aborted by OS.")
         except HTTPError:
@@ -33,32 +54,91 @@ class HTTPConnectionHandler(TCPConnectionHandler):
         except Exception:
             log('Connection terminated with exception:')
             log(format_exc())
+        return None
+
+    def _handle_websocket(self, ws_handler:WebSocketHandler, stream:BinaryIO, log:LineLogger) -> None:
+        """ Give an upgraded connection to its WebSocket handler until it closes. Count it as closed after. """
+        try:
+            ws_handler.handle_websocket(WebSocketConnection(stream), log)
+            log("Connection terminated.")
+        except SocketTimeout:
+            log("Connection timed out.")
+        except WebSocketError as e:
+            log(f"WebSocket closed by protocol error: {e.args[1]}")
+        except OSError:
+            log("Connection aborted by OS.")
+        except Exception:
+            log('Connection terminated with exception:')
+            log(format_exc())
+        finally:
+            with self._ws_lock:
+                self._ws_count -= 1
 
-    def _process(self, stream:BinaryIO) -> Iterator[str]:
-        """ Process requests and yield log messages until connection close or error. """
-        reader = HTTPRequestReader(stream)
+    def _upgrade(self, request:HTTPRequest, writer:HTTPResponseWriter) -> str:
+        """ Complete a WebSocket handshake if there is room for another one. It counts as open from here on. """
+        response = upgrade_response(request)
+        with self._ws_lock:
+            if self._max_websockets is not None and self._ws_count >= self._max_websockets:
+                raise HTTPError.SERVICE_UNAVAILABLE("too many open WebSockets")
+            self._ws_count += 1
+        try:
+            return self._send(request, response, writer)
+        except BaseException:
+            with self._ws_lock:
+                self._ws_count -= 1
+            raise
+
+    def reject_connection(self, stream:BinaryIO, log:LineLogger) -> None:
+        """ Send a 503 error response without reading any requests. The client may try again later. """
         writer = HTTPResponseWriter(stream)
-        while True:
+        e = HTTPError.SERVICE_UNAVAILABLE("the server is too busy")
+        try:
+            self._handle_error(None, writer, e)
+            log("Connection rejected: server too busy.")
+        except OSError:
+            log("Connection aborted by OS.")
+
+    def _websocket_handler(self, request:HTTPRequest) -> Optional[WebSocketHandler]:
+        """ Return the WebSocket handler for <request> if it asks for an upgrade to one we have. """
+        if request.headers.upgrade() != 'websocket':
+            return None
+        return self._ws_handlers.get(request.uri.path.lower())
+
+    def _process(self, stream:BinaryIO, log:LineLogger) -> Optional[WebSocketHandler]:
+        """ Process requests and write log messages until connection close, error, or a WebSocket upgrade.
+            After an upgrade, return the WebSocket handler to take over the stream. HTTP errors no longer apply. """
+        reader = HTTPRequestReader(stream, max_content_size=self._max_content_size)
+        writer = HTTPResponseWriter(stream)
+        ws_handler = None
+        while ws_handler is None:
             request = None
             try:
                 request = reader.read()
                 if request is None:
-                    return
+                    return None
                 # Examine the headers and look for continue directives first.
                 headers = request.headers
                 if headers.expect_continue():
-                    yield self._handle_continue(request, writer)
-                yield self._handle_request(request, writer)
+                    log(self._handle_continue(request, writer))
+                ws_handler = self._websocket_handler(request)
+                if ws_handler is not None:
+                    log(self._upgrade(request, writer))
+                    continue
+                log(self._handle_request(request, writer))
                 if not headers.keep_alive():
-                    return
+                    return None
             except HTTPError as e:
-                yield self._handle_error(request, writer, e)
+                log(self._handle_error(request, writer, e))
+                raise
+            except SocketTimeout:
+                # The client went idle (usually between keep-alive requests). There is no one to respond to.
                 raise
             except Exception:
                 # For non-HTTP exceptions, send an internal error response and reraise to log the traceback.
                 e = HTTPError.INTERNAL_SERVER_ERROR()
-                yield self._handle_error(request, writer, e)
+                log(self._handle_error(request, writer, e))
                 raise
+        return ws_handler
 
     def _handle_request(self, request:HTTPRequest, writer:HTTPResponseWriter) -> str:
         """ Call the request handler and write its result. """
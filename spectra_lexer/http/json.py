@@ -1,9 +1,14 @@
 """ Module for JSON codecs adapted for HTTP data transmission. """
 
-from json import JSONDecodeError, JSONDecoder, JSONEncoder
-from typing import Dict, List, NoReturn, Tuple, Union
+from json import dumps, JSONDecodeError, JSONDecoder, JSONEncoder
+from queue import Queue
+from threading import Thread
+from traceback import format_exc
+from typing import Dict, Hashable, List, NoReturn, Optional, Tuple, Union
 
 from .service import BinaryDataProcessor
+from .tcp import LineLogger
+from .websocket import WebSocketConnection, WebSocketHandler
 
 # Spec for Python types directly supported by json module.
 JSONType = Union[None, bool, int, float, str, 'JSONTuple', 'JSONList', 'JSONDict']
@@ -34,28 +39,52 @@ class JSONRestrictionError(JSONDecodeError):
 
 
 class RestrictedJSONDecoder(JSONDecoder):
-    """ Checks untrusted JSON data for restrictions before decoding. """
+    """ Checks untrusted JSON data for restrictions before decoding.
+        If <batch_field> is given, a top-level object may hold a list of up to <max_batch> requests in that field.
+        Each one gets the object and array limits of a single request. Only data that mentions the field gets more
+        than that before decoding, and the limits are checked again afterward against the actual batch length. """
 
-    def __init__(self, *, size_limit:int=None, obj_limit:int=None, arr_limit:int=None, **kwargs) -> None:
+    def __init__(self, *, size_limit:int=None, obj_limit:int=None, arr_limit:int=None,
+                 batch_field:str=None, max_batch=1, **kwargs) -> None:
         super().__init__(**kwargs)
-        self._size_limit = size_limit  # Limit, if any, on total size of JSON data in characters.
-        self._obj_limit = obj_limit    # Limit, if any, on total number of objects (recursion included).
-        self._arr_limit = arr_limit    # Limit, if any, on total number of arrays (recursion included).
+        self._size_limit = size_limit    # Limit, if any, on total size of JSON data in characters.
+        self._obj_limit = obj_limit      # Limit, if any, on total number of objects (recursion included).
+        self._arr_limit = arr_limit      # Limit, if any, on total number of arrays (recursion included).
+        self._batch_field = batch_field  # Top-level field name for a list of requests (None if there are no batches).
+        self._max_batch = max_batch      # Maximum number of requests in a batch.
 
     def _reject(self, s:str, reason:str) -> NoReturn:
         raise JSONRestrictionError(f'JSON rejected - {reason}.', s, 0)
 
+    def _check_counts(self, s:str, n_objs:int, n_arrs:int, scale:int) -> None:
+        """ Check the number of objects and arrays against their limits multiplied by <scale>. """
+        if self._obj_limit is not None and n_objs > self._obj_limit * scale:
+            self._reject(s, 'too many objects')
+        if self._arr_limit is not None and n_arrs > self._arr_limit * scale:
+            self._reject(s, 'too many arrays')
+
+    def _batch_length(self, obj:JSONType) -> int:
+        """ Return the number of requests in decoded data (1 if it isn't a batch). """
+        batch = obj.get(self._batch_field) if isinstance(obj, dict) else None
+        return max(len(batch), 1) if isinstance(batch, list) else 1
+
     def decode(self, s:str, **kwargs) -> JSONType:
         """ Validate and decode an untrusted JSON string. """
         if self._size_limit is not None and len(s) > self._size_limit:
             self._reject(s, 'too large')
         # The Python JSON parser is fast, but dumb. It does naive recursion on containers.
         # The stack can be overwhelmed by a long sequence of '{' and/or '[' characters. Do not let this happen.
-        if self._obj_limit is not None and s.count('{') > self._obj_limit:
-            self._reject(s, 'too many objects')
-        if self._arr_limit is not None and s.count('[') > self._arr_limit:
-            self._reject(s, 'too many arrays')
-        return super().decode(s, **kwargs)
+        n_objs = s.count('{')
+        n_arrs = s.count('[')
+        # A batch can't be counted until it is decoded. Until then, only data that might be one gets its limits.
+        scale = 1
+        if self._batch_field is not None and f'"{self._batch_field}"' in s:
+            scale = max(self._max_batch, 1)
+        self._check_counts(s, n_objs, n_arrs, scale)
+        obj = super().decode(s, **kwargs)
+        if scale > 1:
+            self._check_counts(s, n_objs, n_arrs, min(self._batch_length(obj), scale))
+        return obj
 
 
 class JSONApplication:
@@ -64,6 +93,15 @@ class JSONApplication:
     def run(self, obj:JSONType) -> JSONType:
         raise NotImplementedError
 
+    def is_cacheable(self, obj:JSONType) -> bool:
+        """ Return True if running <obj> always has the same result, so the output may be cached. """
+        return False
+
+    def cancel_group(self, obj:JSONType) -> Optional[Hashable]:
+        """ Return a key for requests that supersede each other, or None if <obj> should always run.
+            On a persistent connection, a request cancels any unfinished one before it in the same group. """
+        return None
+
 
 class JSONDataProcessor(BinaryDataProcessor):
     """ Application wrapper that converts JSON-compatible objects to/from binary form. """
@@ -76,10 +114,111 @@ class JSONDataProcessor(BinaryDataProcessor):
         self._decoder = decoder or JSONDecoder()  # JSON decoder: decode(str) -> JSONType.
         self._encoder = encoder or JSONEncoder()  # JSON encoder: encode(JSONType) -> str.
 
-    def process(self, data:bytes) -> bytes:
-        """ Decode the input data, call the application, and return the encoded output data. """
-        str_in = data.decode(self.encoding)
-        obj_in = self._decoder.decode(str_in)
+    def decode(self, data:bytes) -> JSONType:
+        """ Decode the input data into an object for the application. """
+        return self._decoder.decode(data.decode(self.encoding))
+
+    def cache_key(self, obj_in:JSONType) -> Optional[bytes]:
+        """ Return a decoded input object in canonical form (sorted keys and no whitespace) if the app says
+            its output may be cached. Return None if it may not. """
+        if not self._app.is_cacheable(obj_in):
+            return None
+        return dumps(obj_in, sort_keys=True, separators=(',', ':')).encode(self.encoding)
+
+    def process(self, obj_in:JSONType) -> bytes:
+        """ Call the application with a decoded input object and return the encoded output data. """
         obj_out = self._app.run(obj_in)
         str_out = self._encoder.encode(obj_out)
         return str_out.encode(self.encoding)
+
+
+class _WebSocketJob:
+    """ One request received on a WebSocket and waiting to run. """
+
+    def __init__(self, msg_id:JSONType, obj:JSONType) -> None:
+        self.msg_id = msg_id    # ID chosen by the client to match the reply to this request.
+        self.obj = obj          # Decoded request for the application.
+        self.cancelled = False  # If True, a newer request in the same group made this one obsolete.
+
+
+class JSONWebSocketHandler(WebSocketHandler):
+    """ Runs application requests sent as WebSocket text messages. Each request is parsed only once for the
+        life of the connection instead of once per HTTP request, and each reply is a single frame.
+
+        Messages are JSON objects of the form {"id": ID, "request": REQUEST}. Each gets a reply with the same ID:
+        {"id": ID, "result": RESULT}, {"id": ID, "error": MESSAGE}, or {"id": ID, "cancelled": true}.
+        Requests run in order on a worker thread while this one keeps reading. A new request cancels older ones in
+        its cancel group (such as searches while typing) that haven't finished. Those that haven't started are
+        skipped. Those already running are still finished (there is no safe way to interrupt one), but their
+        results are thrown away and never sent. Either way, the client gets a cancellation reply. """
+
+    def __init__(self, app:JSONApplication, decoder:JSONDecoder=None, encoder:JSONEncoder=None) -> None:
+        self._app = app                           # Wrapped application. Must be thread-safe.
+        self._decoder = decoder or JSONDecoder()  # JSON decoder: decode(str) -> JSONType.
+        self._encoder = encoder or JSONEncoder()  # JSON encoder: encode(JSONType) -> str.
+
+    def _reply(self, ws:WebSocketConnection, msg_id:JSONType, **fields:JSONType) -> None:
+        ws.send_text(self._encoder.encode({"id": msg_id, **fields}))
+
+    def _parse(self, text:str) -> _WebSocketJob:
+        obj = self._decoder.decode(text)
+        if not isinstance(obj, dict) or "request" not in obj:
+            raise ValueError('Messages must be JSON objects with a "request" field.')
+        return _WebSocketJob(obj.get("id"), obj["request"])
+
+    def _run(self, ws:WebSocketConnection, job:_WebSocketJob, log:LineLogger) -> None:
+        """ Run one request and reply with the result (unless it was cancelled along the way). """
+        if job.cancelled:
+            self._reply(ws, job.msg_id, cancelled=True)
+            return
+        try:
+            result = self._app.run(job.obj)
+        except Exception:
+            log('WebSocket request failed with exception:')
+            log(format_exc())
+            self._reply(ws, job.msg_id, error="Request failed.")
+            return
+        if job.cancelled:
+            self._reply(ws, job.msg_id, cancelled=True)
+        else:
+            self._reply(ws, job.msg_id, result=result)
+
+    def _work(self, ws:WebSocketConnection, jobs:Queue, log:LineLogger) -> None:
+        """ Run jobs from the queue in order until a None sentinel. Stop early if the connection goes away. """
+        while True:
+            job = jobs.get()
+            if job is None or ws.is_closed():
+                return
+            try:
+                self._run(ws, job, log)
+            except OSError:
+                return
+
+    def handle_websocket(self, ws:WebSocketConnection, log:LineLogger) -> None:
+        """ Read requests and queue them for the worker thread until the client closes the connection. """
+        log("WebSocket opened.")
+        jobs = Queue()
+        latest = {}  # Most recent job in each cancel group.
+        worker = Thread(target=self._work, args=(ws, jobs, log), daemon=True)
+        worker.start()
+        try:
+            while True:
+                text = ws.receive_text()
+                if text is None:
+                    break
+                try:
+                    job = self._parse(text)
+                except ValueError as e:
+                    self._reply(ws, None, error=str(e))
+                    continue
+                group = self._app.cancel_group(job.obj)
+                if group is not None:
+                    old_job = latest.get(group)
+                    if old_job is not None:
+                        old_job.cancelled = True
+                    latest[group] = job
+                jobs.put(job)
+        finally:
+            jobs.put(None)
+            worker.join()
+        log("WebSocket closed.")
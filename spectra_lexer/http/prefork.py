@@ -0,0 +1,121 @@
+""" Module for serving TCP connections from several pre-forked worker processes. """
+
+import gc
+import os
+import signal
+from time import sleep
+from traceback import format_exc
+from typing import Any, Callable
+
+from .tcp import LineLogger, TCPServerSocket
+
+
+ServerFactory = Callable[[], Any]  # Makes a new server with serve(sock) and shutdown() methods in a worker process.
+
+
+class PreforkServer:
+    """ Serves connections from several worker processes forked from this one, which supervises them.
+        Only one process can run Python code at a time, so this is the only way for request handlers to use more
+        than one core. Workers run their own server and share everything loaded before the fork copy-on-write.
+        Workers accept from one shared socket by default. With <reuse_port>, each one binds its own socket instead
+        and the OS balances connections between them (SO_REUSEPORT, Linux only). This requires os.fork (Unix only).
+
+        Every object in use by the time of the fork is moved to a permanent generation with gc.freeze().
+        Otherwise, the first garbage collection in each worker would write to the GC header of every object,
+        making private copies of nearly every page of memory in the parent. """
+
+    def __init__(self, server_factory:ServerFactory, worker_count:int, *, logger:LineLogger=print,
+                 timeout=0.5, reuse_port=False) -> None:
+        self._server_factory = server_factory  # Makes a new server in each worker process.
+        self._worker_count = worker_count      # Number of worker processes to keep running.
+        self._logger = logger                  # Line-based string callable used to log supervisor messages.
+        self._timeout = timeout                # Time in seconds between checks on the workers.
+        self._reuse_port = reuse_port          # If True, each worker binds its own socket with SO_REUSEPORT.
+        self._workers = set()                  # Process IDs of running workers.
+        self._running = False                  # State variable. When False, the workers stop at the next check.
+
+    def start(self, address:str, port:int) -> None:
+        """ Fork the workers to serve connections on <address:port>. Replace any workers that exit unexpectedly
+            until shutdown() is called, then stop every worker. """
+        if self._running:
+            raise RuntimeError("Server already running.")
+        self._running = True
+        sock = None
+        if not self._reuse_port:
+            sock = TCPServerSocket.bind_to(address, port)
+        if hasattr(gc, "freeze"):
+            gc.collect()
+            gc.freeze()
+        try:
+            while self._running:
+                while len(self._workers) < self._worker_count:
+                    self._fork(sock, address, port)
+                sleep(self._timeout)
+                self._reap()
+        finally:
+            self._stop_workers()
+            if sock is not None:
+                sock.close()
+            if hasattr(gc, "unfreeze"):
+                gc.unfreeze()
+
+    def _fork(self, sock:TCPServerSocket, address:str, port:int) -> None:
+        """ Fork a new worker process to serve connections from <sock> (or its own socket on <address:port>). """
+        pid = os.fork()
+        if pid:
+            self._workers.add(pid)
+            self._logger(f"Worker {pid} started.")
+            return
+        # This is the worker. It must never return to the supervisor's code, even on an exception.
+        status = 1
+        try:
+            server = self._server_factory()
+            signal.signal(signal.SIGTERM, lambda *_: server.shutdown())
+            if sock is None:
+                with TCPServerSocket.bind_to(address, port, reuse_port=True) as own_sock:
+                    server.serve(own_sock)
+            else:
+                server.serve(sock)
+            status = 0
+        except KeyboardInterrupt:
+            status = 0
+        except BaseException:
+            self._logger(f"Worker {os.getpid()} failed with exception:")
+            self._logger(format_exc())
+        finally:
+            os._exit(status)
+
+    def _reap(self) -> None:
+        """ Collect the exit status of any workers that have exited. Log them unless they were told to stop.
+            Only wait on our own workers. Other child processes (i.e. from multiprocessing) aren't ours to reap. """
+        for pid in list(self._workers):
+            pid, status = os.waitpid(pid, os.WNOHANG)
+            if pid:
+                self._workers.remove(pid)
+                if self._running:
+                    self._logger(f"Worker {pid} exited unexpectedly with status {status}.")
+
+    def _stop_workers(self) -> None:
+        """ Tell every worker to stop and wait for them. Kill any that take more than a few polling cycles. """
+        for pid in self._workers:
+            self._signal(pid, signal.SIGTERM)
+        for _ in range(10):
+            if not self._workers:
+                return
+            sleep(self._timeout)
+            self._reap()
+        for pid in self._workers:
+            self._signal(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        self._workers.clear()
+
+    @staticmethod
+    def _signal(pid:int, sig:int) -> None:
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def shutdown(self) -> None:
+        """ Stop the workers and halt serving. Must be called by another thread. """
+        self._running = False
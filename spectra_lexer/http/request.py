@@ -37,6 +37,33 @@ class HTTPRequestHeaders:
         """ Return True if the connection should be kept alive after this request. """
         return self._get_lower('Connection').lower() != 'close'
 
+    def upgrade(self) -> str:
+        """ Return the lowercase protocol the client wants to switch to, or an empty string if there is none. """
+        connection_tokens = {token.strip() for token in self._get_lower('Connection').lower().split(",")}
+        if 'upgrade' not in connection_tokens:
+            return ""
+        return self._get_lower('Upgrade').strip().lower()
+
+    def websocket_key(self) -> str:
+        """ Return the client's WebSocket handshake key if the header is present; an empty string otherwise. """
+        return self._get_lower('Sec-WebSocket-Key').strip()
+
+    def websocket_version(self) -> str:
+        """ Return the WebSocket protocol version if the header is present; an empty string otherwise. """
+        return self._get_lower('Sec-WebSocket-Version').strip()
+
+    def none_match(self, etag:str) -> bool:
+        """ Return True unless the If-None-Match header has <etag> (meaning content must be sent/resent).
+            Entity tags are compared weakly, so W/"x" and "x" are the same. An asterisk matches anything. """
+        header = self._get_lower("If-None-Match")
+        if not header:
+            return True
+        tags = {tag.strip() for tag in header.split(",")}
+        if "*" in tags:
+            return False
+        weak_tags = {tag[2:] if tag.startswith("W/") else tag for tag in tags}
+        return (etag[2:] if etag.startswith("W/") else etag) not in weak_tags
+
     def modified_since(self, mtime:float) -> bool:
         """ Return True if one of the following applies (meaning content must be sent/resent):
             - the file modification timestamp <mtime> is later than the If-Modified-Since header.
@@ -97,6 +124,7 @@ class HTTPRequest:
         self.uri = uri          # HTTP URI starting from the server root.
         self.headers = headers  # HTTP request headers, unordered, with lowercase keys.
         self.content = content  # The rest of the data read from the HTTP stream, as a byte string.
+        self.decoded = None     # Content decoded by a data service, kept for any other layer that needs it.
 
 
 class HTTPRequestReader:
@@ -105,9 +133,10 @@ class HTTPRequestReader:
     # Maps two-digit hex strings to corresponding characters in the ASCII range.
     _HEX_SUB = {bytes([b]).hex(): chr(b) for b in range(128)}
 
-    def __init__(self, stream:BinaryIO, max_header_size=65536) -> None:
-        self._stream = stream                    # Readable ISO-8859-1 binary stream.
-        self._max_header_size = max_header_size  # Maximum combined size of headers in bytes.
+    def __init__(self, stream:BinaryIO, max_header_size=65536, max_content_size=1 << 20) -> None:
+        self._stream = stream                      # Readable ISO-8859-1 binary stream.
+        self._max_header_size = max_header_size    # Maximum combined size of headers in bytes.
+        self._max_content_size = max_content_size  # Maximum size of request content in bytes.
 
     def read(self) -> Optional[HTTPRequest]:
         """ Parse HTTP request data from the current stream into a request object.
@@ -142,9 +171,21 @@ class HTTPRequestReader:
             raise HTTPError.BAD_REQUEST(request_line)
         uri_obj = self._parse_uri(uri)
         headers = HTTPRequestHeaders.from_lines(other_lines)
-        content = self._stream.read(headers.content_length())
+        content = self._stream.read(self._content_length(headers))
         return HTTPRequest(method, uri_obj, headers, content)
 
+    def _content_length(self, headers:HTTPRequestHeaders) -> int:
+        """ Check the content length before reading anything. The client must not make us read without limit. """
+        try:
+            length = headers.content_length()
+        except ValueError:
+            raise HTTPError.BAD_REQUEST("Invalid Content-Length.")
+        if length < 0:
+            raise HTTPError.BAD_REQUEST("Invalid Content-Length.")
+        if length > self._max_content_size:
+            raise HTTPError.REQUEST_ENTITY_TOO_LARGE()
+        return length
+
     @classmethod
     def _parse_uri(cls, s:str) -> HTTPRequestURI:
         """ Parse a URI from string form, unquoting special characters. """
@@ -1,4 +1,5 @@
 import email.utils
+from shutil import copyfileobj
 from typing import BinaryIO, Iterator
 
 from .status import HTTPResponseStatus, HTTPStatusMeta
@@ -12,8 +13,8 @@ class HTTPResponseHeaders:
     """ Structure for HTTP response headers (other than the status line). """
 
     # Ordered list of response headers. General headers are first, entity headers are last.
-    HEADER_TYPES = ['Date', 'Server', 'Connection', 'Last-Modified',
-                    'Content-Type', 'Content-Encoding', 'Content-Length']
+    HEADER_TYPES = ['Date', 'Server', 'Connection', 'Upgrade', 'Sec-WebSocket-Accept', 'Vary', 'ETag',
+                    'Last-Modified', 'Content-Type', 'Content-Encoding', 'Content-Length']
 
     def __init__(self) -> None:
         self._d = {}  # String dict with each header.
@@ -27,6 +28,23 @@ class HTTPResponseHeaders:
     def set_connection_close(self) -> None:
         self._d['Connection'] = 'close'
 
+    def set_upgrade(self, protocol:str) -> None:
+        self._d['Connection'] = 'Upgrade'
+        self._d['Upgrade'] = protocol
+
+    def set_websocket_accept(self, accept_key:str) -> None:
+        self._d['Sec-WebSocket-Accept'] = accept_key
+
+    def set_vary(self, header_name:str) -> None:
+        self._d['Vary'] = header_name
+
+    def set_etag(self, etag:str) -> None:
+        self._d['ETag'] = etag
+
+    def etag(self) -> str:
+        """ Return the entity tag if one was set; an empty string otherwise. """
+        return self._d.get('ETag', '')
+
     def set_last_modified(self, mtime:float) -> None:
         self._d['Last-Modified'] = _format_date(mtime)
 
@@ -36,9 +54,19 @@ class HTTPResponseHeaders:
     def set_content_encoding(self, encoding:str) -> None:
         self._d['Content-Encoding'] = encoding
 
+    def content_encoding(self) -> str:
+        """ Return the content encoding if one was set; an empty string otherwise. """
+        return self._d.get('Content-Encoding', '')
+
     def set_content_length(self, length:int) -> None:
         self._d['Content-Length'] = str(length)
 
+    def copy(self) -> "HTTPResponseHeaders":
+        """ Return a copy of these headers that may be changed independently. """
+        headers = HTTPResponseHeaders()
+        headers._d = self._d.copy()
+        return headers
+
     def iter_lines(self) -> Iterator[str]:
         """ Yield each header line in order (without newlines). """
         d = self._d
@@ -50,10 +78,19 @@ class HTTPResponseHeaders:
 class HTTPResponse(metaclass=HTTPStatusMeta):
     """ Structure representing the outcome of an HTTP/1.1 request with a status line, headers, and/or content. """
 
-    def __init__(self, status:HTTPResponseStatus, headers:HTTPResponseHeaders, content=b'') -> None:
-        self.status = status    # Status code.
-        self.headers = headers  # Response headers.
-        self.content = content  # Binary content data.
+    def __init__(self, status:HTTPResponseStatus, headers:HTTPResponseHeaders, content=b'',
+                 content_file:BinaryIO=None) -> None:
+        self.status = status              # Status code.
+        self.headers = headers            # Response headers.
+        self.content = content            # Binary content data.
+        self.content_file = content_file  # Optional open file to send after <content>. It is closed when written.
+
+    def discard_content(self) -> None:
+        """ Remove all content without changing the headers (i.e. for a HEAD request). """
+        self.content = b''
+        if self.content_file is not None:
+            self.content_file.close()
+            self.content_file = None
 
 
 class HTTPResponseWriter:
@@ -68,3 +105,15 @@ class HTTPResponseWriter:
         header_data = '\r\n'.join(header_lines).encode('iso-8859-1', 'strict')
         self._stream.write(header_data)
         self._stream.write(response.content)
+        fp = response.content_file
+        if fp is not None:
+            with fp:
+                self._write_file(fp)
+
+    def _write_file(self, fp:BinaryIO) -> None:
+        """ Write the rest of a binary file to the stream. Let the stream send it directly if it can. """
+        sendfile = getattr(self._stream, 'sendfile', None)
+        if sendfile is not None:
+            sendfile(fp)
+        else:
+            copyfileobj(fp, self._stream)
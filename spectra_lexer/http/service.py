@@ -4,10 +4,13 @@
     Filter  - modifies responses generated by a child request handler.
     Service - generates response objects directly as an endpoint of the request handler chain. """
 
+from collections import OrderedDict
 import gzip
+from hashlib import blake2b
 from mimetypes import MimeTypes
 import os
 from threading import Lock
+from typing import Any, Callable, Hashable, NamedTuple, Optional
 
 from .request import HTTPRequest
 from .response import HTTPResponse, HTTPResponseHeaders
@@ -40,7 +43,7 @@ class HTTPMethodRouter(HTTPRequestHandler):
         response = handler(request)
         # Remove any content body if the method is HEAD.
         if method == "HEAD":
-            response.content = b''
+            response.discard_content()
         return response
 
 
@@ -84,18 +87,44 @@ class HTTPContentTypeRouter(HTTPRequestHandler):
 
 
 class HTTPGzipFilter(HTTPRequestHandler):
-
-    def __init__(self, handler:HTTPRequestHandler, *, compresslevel=9, size_threshold=0) -> None:
+    """ Compresses response content for clients that accept gzip.
+        Levels above 6 cost up to twice the CPU time for output only a few percent smaller, and the time grows with
+        the content size. Unless a fixed <compresslevel> is given, the level is chosen by content size, and drops to
+        the fastest level while more than <busy_count> requests are in progress. Compression holds the GIL, so it
+        is time taken directly from every other request. Responses that are already encoded are left alone. """
+
+    # Compression levels for content of at least a minimum size in bytes (in increasing order of size).
+    # Smaller content gets the base level. Levels 1-3 use a much faster algorithm than 4-9.
+    SIZE_LEVELS = [(32768, 3)]
+
+    def __init__(self, handler:HTTPRequestHandler, *, compresslevel:int=None, base_level=6, size_threshold=0,
+                 busy_count=4) -> None:
         self._handler = handler                # Child request handler.
-        self._compresslevel = compresslevel    # Compression level from 1 (fastest) to 9 (slowest).
+        self._compresslevel = compresslevel    # Fixed compression level from 1 (fastest) to 9 (slowest) if not None.
+        self._base_level = base_level          # Compression level for small content when not fixed or busy.
         self._size_threshold = size_threshold  # Only compress content at least this size in bytes.
-
-    def __call__(self, request:HTTPRequest) -> HTTPResponse:
-        """ Compress the content of the response if it meets our conditions. """
+        self._busy_count = busy_count          # With more requests than this in progress, use the fastest level.
+        self._active = 0                       # Number of requests in progress.
+        self._lock = Lock()                    # Lock for the request counter.
+
+    def _level(self, size:int) -> int:
+        """ Return the compression level for content of <size> bytes under the current load. """
+        if self._compresslevel is not None:
+            return self._compresslevel
+        if self._active > self._busy_count:
+            return 1
+        level = self._base_level
+        for min_size, size_level in self.SIZE_LEVELS:
+            if size >= min_size:
+                level = size_level
+        return level
+
+    def _filter(self, request:HTTPRequest) -> HTTPResponse:
         response = self._handler(request)
         data = response.content
-        if data is not None and request.headers.accept_gzip() and len(data) >= self._size_threshold:
-            gzip_data = gzip.compress(data, self._compresslevel)
+        if (data is not None and request.headers.accept_gzip() and len(data) >= self._size_threshold
+                and not response.headers.content_encoding()):
+            gzip_data = gzip.compress(data, self._level(len(data)))
             # Don't use the compressed data unless it is actually smaller.
             if len(gzip_data) < len(data):
                 response.content = gzip_data
@@ -103,14 +132,54 @@ class HTTPGzipFilter(HTTPRequestHandler):
                 response.headers.set_content_encoding('gzip')
         return response
 
+    def __call__(self, request:HTTPRequest) -> HTTPResponse:
+        """ Compress the content of the response if it meets our conditions. Count the request while it runs. """
+        with self._lock:
+            self._active += 1
+        try:
+            return self._filter(request)
+        finally:
+            with self._lock:
+                self._active -= 1
+
+
+class _StaticFile(NamedTuple):
+    """ In-memory copy of a static file with everything needed to serve it. """
+
+    stamp: tuple                   # Modification time in ns and size from when the file was read.
+    headers: HTTPResponseHeaders   # Headers common to every full response (with no content length or encoding).
+    content: bytes                 # Full contents of the file.
+    gzip_content: Optional[bytes]  # Precompressed contents of the file, or None if compression didn't help.
+
+    def size(self) -> int:
+        """ Return the number of bytes of content kept in memory. """
+        return len(self.content) + len(self.gzip_content or b'')
 
-class HTTPFileService(HTTPRequestHandler):
-    """ Handles requests specific to file retrieval (generally using GET and HEAD methods). """
 
-    def __init__(self, directory:str, index_filename="index.html") -> None:
-        self._directory = directory   # Root directory for public HTTP file requests.
-        self._index = index_filename  # When a directory path is accessed, redirect to this landing page inside it.
-        self._types = MimeTypes()     # Called to find MIME types for files based on their paths.
+def _file_stamp(fs:os.stat_result) -> tuple:
+    """ Return a stamp that changes whenever a file with stats <fs> is rewritten. """
+    return fs.st_mtime_ns, fs.st_size
+
+
+class HTTPFileService(HTTPRequestHandler):
+    """ Handles requests specific to file retrieval (generally using GET and HEAD methods).
+        Static files are few and small, but every page load requests all of them. Files up to <max_file_size>
+        are kept in memory along with a gzip copy, up to <cache_size> bytes in total, evicting the least recently used
+        ones to make room. These are revalidated with a stat() call on each request and reloaded if the file changed.
+        Larger files are streamed from disk.
+        Entity tags are based on the modification time and size, so they are the same for both encodings. """
+
+    def __init__(self, directory:str, index_filename="index.html", *, cache_size=1 << 24, max_file_size=1 << 20,
+                 compresslevel=9) -> None:
+        self._directory = directory          # Root directory for public HTTP file requests.
+        self._index = index_filename         # When a directory path is accessed, redirect to this landing page in it.
+        self._types = MimeTypes()            # Called to find MIME types for files based on their paths.
+        self._cache_size = cache_size        # Maximum total size of cached file contents in bytes.
+        self._max_file_size = max_file_size  # Files larger than this are never cached.
+        self._compresslevel = compresslevel  # Compression level for cached gzip copies from 1 (fastest) to 9 (slowest).
+        self._cache = OrderedDict()          # Cached files by local path from least to most recently used.
+        self._size = 0                       # Current total size of cached file contents.
+        self._lock = Lock()                  # Lock to keep the cache consistent between threads.
 
     def __call__(self, request:HTTPRequest) -> HTTPResponse:
         """ Common file-serving code for GET and HEAD commands. """
@@ -122,21 +191,83 @@ class HTTPFileService(HTTPRequestHandler):
             raise HTTPError.NOT_FOUND(uri_path)
 
     def _file_response(self, file_path:str, request:HTTPRequest) -> HTTPResponse:
-        """ Open a file and send it in the response if it exists and was not cached recently. """
+        """ Send a file in the response if it exists and was not cached recently. Use our own copy if it is current. """
+        fs = os.stat(file_path)
+        with self._lock:
+            cached = self._cache.get(file_path)
+            if cached is not None:
+                self._cache.move_to_end(file_path)
+        if cached is None or cached.stamp != _file_stamp(fs):
+            if fs.st_size > self._max_file_size:
+                return self._stream_response(file_path, request)
+            cached = self._load(file_path)
+        headers = cached.headers.copy()
+        stamp = cached.stamp
+        if not self._must_send(request, stamp, headers.etag()):
+            return HTTPResponse.NOT_MODIFIED(headers)
+        content = cached.content
+        if cached.gzip_content is not None and request.headers.accept_gzip():
+            content = cached.gzip_content
+            headers.set_content_encoding('gzip')
+        headers.set_content_length(len(content))
+        return HTTPResponse.OK(headers, content)
+
+    def _stream_response(self, file_path:str, request:HTTPRequest) -> HTTPResponse:
+        """ Open a file too large to cache and send it straight from disk. """
+        fp = open(file_path, 'rb')
+        try:
+            fs = os.fstat(fp.fileno())
+            stamp = _file_stamp(fs)
+            headers = self._file_headers(file_path, stamp)
+            if not self._must_send(request, stamp, headers.etag()):
+                fp.close()
+                return HTTPResponse.NOT_MODIFIED(headers)
+            headers.set_content_length(fs.st_size)
+            return HTTPResponse.OK(headers, content_file=fp)
+        except Exception:
+            fp.close()
+            raise
+
+    def _load(self, file_path:str) -> _StaticFile:
+        """ Read a file and compress it. Cache the result, evicting the least recently used files if needed. """
         with open(file_path, 'rb') as fp:
             fs = os.fstat(fp.fileno())
-            mtime = fs.st_mtime
-            headers = HTTPResponseHeaders()
-            if not request.headers.modified_since(mtime):
-                response = HTTPResponse.NOT_MODIFIED(headers)
-            else:
-                headers.set_last_modified(mtime)
-                mime_type = self._types.guess_type(file_path)[0]
-                content = fp.read()
-                headers.set_content_type(mime_type)
-                headers.set_content_length(len(content))
-                response = HTTPResponse.OK(headers, content)
-            return response
+            content = fp.read()
+        stamp = _file_stamp(fs)
+        headers = self._file_headers(file_path, stamp)
+        gzip_content = gzip.compress(content, self._compresslevel)
+        if len(gzip_content) < len(content):
+            headers.set_vary('Accept-Encoding')
+        else:
+            gzip_content = None
+        cached = _StaticFile(stamp, headers, content, gzip_content)
+        size = cached.size()
+        with self._lock:
+            old = self._cache.pop(file_path, None)
+            if old is not None:
+                self._size -= old.size()
+            if size <= self._cache_size:
+                self._cache[file_path] = cached
+                self._size += size
+                while self._size > self._cache_size:
+                    _, old = self._cache.popitem(last=False)
+                    self._size -= old.size()
+        return cached
+
+    def _file_headers(self, file_path:str, stamp:tuple) -> HTTPResponseHeaders:
+        """ Return headers for a file version with <stamp> that are the same for every full response. """
+        headers = HTTPResponseHeaders()
+        mtime_ns, size = stamp
+        headers.set_etag(f'W/"{mtime_ns:x}-{size:x}"')
+        headers.set_last_modified(mtime_ns / 1e9)
+        headers.set_content_type(self._types.guess_type(file_path)[0])
+        return headers
+
+    @staticmethod
+    def _must_send(request:HTTPRequest, stamp:tuple, etag:str) -> bool:
+        """ Return True unless the client already has the file version with <stamp> and <etag>. """
+        mtime_ns, _ = stamp
+        return request.headers.none_match(etag) and request.headers.modified_since(mtime_ns / 1e9)
 
     def _translate_path(self, uri_path:str) -> str:
         """ Translate <uri_path> to the local filename syntax.
@@ -157,28 +288,147 @@ class HTTPFileService(HTTPRequestHandler):
 
 
 class BinaryDataProcessor:
-    """ Interface for a processor of raw binary data. Thread-safety is not required. """
+    """ Interface for a processor of raw binary data. Thread-safety is not required.
+        Input is decoded in its own step, so other layers may look at the decoded form without decoding it again. """
 
     output_type: str  # MIME type of output data.
 
-    def process(self, data:bytes) -> bytes:
+    def decode(self, data:bytes) -> Any:
+        """ Decode raw input data for process(). Raise ValueError if it is invalid. """
+        return data
+
+    def process(self, obj:Any) -> bytes:
         raise NotImplementedError
 
 
+def _data_etag(data:bytes) -> str:
+    """ Return a weak entity tag for binary <data>. It is weak so that it still matches after compression. """
+    return f'W/"{blake2b(data, digest_size=16).hexdigest()}"'
+
+
 class HTTPDataService(HTTPRequestHandler):
-    """ Decodes binary data from HTTP content, processes it, and returns an encoded result. """
+    """ Decodes binary data from HTTP content, processes it, and returns an encoded result.
+        Results are tagged with a hash. If the client already has a result with the same tag, it gets a 304 instead. """
 
-    def __init__(self, processor:BinaryDataProcessor) -> None:
-        """ The data processor is a thread-safety boundary, so we need a lock. """
+    def __init__(self, processor:BinaryDataProcessor, *, thread_safe=False) -> None:
+        """ The data processor is a thread-safety boundary, so we need a lock unless it is <thread_safe>. """
         self._processor = processor
-        self._lock = Lock()
+        self._lock = None if thread_safe else Lock()
+
+    def _call(self, method:Callable, arg:Any) -> Any:
+        if self._lock is None:
+            return method(arg)
+        with self._lock:
+            return method(arg)
+
+    def decode(self, request:HTTPRequest) -> Any:
+        """ Return the content of <request> decoded by the processor. It is only decoded once per request,
+            so a layer above this one (such as a cache key function) may use it first at no extra cost. """
+        if request.decoded is None:
+            request.decoded = self._call(self._processor.decode, request.content)
+        return request.decoded
 
     def __call__(self, request:HTTPRequest) -> HTTPResponse:
         """ Process content obtained from a client. If successful, send the returned data back to the client. """
-        data_in = request.content
-        with self._lock:
-            data_out = self._processor.process(data_in)
+        data_out = self._call(self._processor.process, self.decode(request))
         headers = HTTPResponseHeaders()
+        etag = _data_etag(data_out)
+        headers.set_etag(etag)
+        if not request.headers.none_match(etag):
+            return HTTPResponse.NOT_MODIFIED(headers)
         headers.set_content_type(self._processor.output_type)
         headers.set_content_length(len(data_out))
         return HTTPResponse.OK(headers, data_out)
+
+
+CacheKeyFunction = Callable[[HTTPRequest], Optional[bytes]]  # Returns a cache key for a request (or None to bypass).
+
+
+class _CachedResponse(NamedTuple):
+    """ Successful response kept in memory along with a gzip copy of its content. """
+
+    response: HTTPResponse         # Response as it was first sent (with no content encoding).
+    gzip_content: Optional[bytes]  # Compressed content, or None if compression was disabled or didn't help.
+
+
+class HTTPResponseCache(HTTPRequestHandler):
+    """ Caches successful responses from a child request handler, evicting the least recently used ones when their
+        total size goes over a limit in bytes. If a client already has a cached response with the same entity tag,
+        it gets a 304 with no content.
+        With <gzip_level>, a compressed copy of each response is made when it is cached and sent to every client that
+        accepts gzip. It is only made once, so the best level is affordable. This should go below any gzip filter,
+        which will leave the compressed responses alone. Without it, the cache should go above any filters;
+        responses are cached as sent, and compressed and uncompressed ones separately. """
+
+    def __init__(self, handler:HTTPRequestHandler, key_fn:CacheKeyFunction, *, max_size=1 << 25,
+                 gzip_level:int=None) -> None:
+        self._handler = handler        # Child request handler.
+        self._key_fn = key_fn          # Returns a cache key for a request, or None if its response must not be cached.
+        self._max_size = max_size      # Maximum total size of cached keys and content in bytes.
+        self._gzip_level = gzip_level  # Compression level for gzip copies of cached content (None for no copies).
+        self._cache = OrderedDict()    # Cached responses and their sizes from least to most recently used.
+        self._size = 0                 # Current total size of cached keys and content.
+        self._lock = Lock()            # Lock to keep the cache consistent between threads.
+
+    def _get(self, key:Hashable) -> Optional[_CachedResponse]:
+        with self._lock:
+            item = self._cache.get(key)
+            if item is None:
+                return None
+            self._cache.move_to_end(key)
+            return item[0]
+
+    def _add(self, key:Hashable, cached:_CachedResponse, size:int) -> None:
+        if size > self._max_size:
+            return
+        with self._lock:
+            old_item = self._cache.pop(key, None)
+            if old_item is not None:
+                self._size -= old_item[1]
+            self._cache[key] = (cached, size)
+            self._size += size
+            while self._size > self._max_size:
+                _, (_, old_size) = self._cache.popitem(last=False)
+                self._size -= old_size
+
+    def _cache_response(self, key:bytes, response:HTTPResponse, accept_gzip:bool) -> _CachedResponse:
+        """ Cache a copy of a new <response> under <key> with a gzip copy of its content if enabled. """
+        content = response.content
+        gzip_content = None
+        if self._gzip_level is not None:
+            gzip_content = gzip.compress(content, self._gzip_level)
+            if len(gzip_content) >= len(content):
+                gzip_content = None
+        cached = _CachedResponse(HTTPResponse(response.status, response.headers.copy(), content), gzip_content)
+        size = len(key) + len(content) + len(gzip_content or b'')
+        self._add((key, accept_gzip and self._gzip_level is None), cached, size)
+        return cached
+
+    def __call__(self, request:HTTPRequest) -> HTTPResponse:
+        """ Return a copy of a cached response if there is one. Other layers may change the response we return. """
+        key = self._key_fn(request)
+        if key is None:
+            return self._handler(request)
+        accept_gzip = request.headers.accept_gzip()
+        cached = self._get((key, accept_gzip and self._gzip_level is None))
+        if cached is None:
+            response = self._handler(request)
+            if not response.status.is_ok():
+                return response
+            cached = self._cache_response(key, response, accept_gzip)
+        else:
+            etag = cached.response.headers.etag()
+            if etag and not request.headers.none_match(etag):
+                headers = HTTPResponseHeaders()
+                headers.set_etag(etag)
+                return HTTPResponse.NOT_MODIFIED(headers)
+        response = cached.response
+        headers = response.headers.copy()
+        content = response.content
+        if cached.gzip_content is not None:
+            headers.set_vary('Accept-Encoding')
+            if accept_gzip:
+                content = cached.gzip_content
+                headers.set_content_encoding('gzip')
+                headers.set_content_length(len(content))
+        return HTTPResponse(response.status, headers, content)
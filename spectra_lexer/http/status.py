@@ -12,6 +12,10 @@ class HTTPResponseStatus:
     def __init__(self, code:HTTPStatus) -> None:
         self._code = code
 
+    def is_ok(self) -> bool:
+        """ Return True if the response is a normal success (200 OK). """
+        return self._code == HTTPStatus.OK
+
     def has_body(self) -> bool:
         """ Return True if the response should have a content body. """
         return self._code not in self._NO_BODY_CODES
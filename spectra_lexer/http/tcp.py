@@ -1,21 +1,33 @@
 """ Module for creating and listening to TCP/IP socket connections. """
 
-from _socket import socket, SHUT_WR, SO_REUSEADDR, SOL_SOCKET, SOL_TCP, TCP_NODELAY
+from _socket import socket, timeout as SocketTimeout, SHUT_WR, SO_REUSEADDR, SOL_SOCKET, SOL_TCP, TCP_NODELAY
+import _socket
 from io import BufferedReader, RawIOBase
+import os
+from shutil import copyfileobj
+from queue import Empty, Queue
 from select import select
 from threading import Thread
-from typing import BinaryIO, Callable
+from typing import BinaryIO, Callable, Optional
 
-LineLogger = Callable[[str], None]  # Line-based string callable used for log messages.
+LineLogger = Callable[[str], None]      # Line-based string callable used for log messages.
+ConnectionHandoff = Callable[[], None]  # Finishes a long-lived connection after its handler returns.
 
 
 class TCPConnectionHandler:
     """ Interface for a handler of incoming TCP client connections. """
 
-    def handle_connection(self, stream:BinaryIO, log:LineLogger) -> None:
-        """ Handle a TCP connection for its entire duration. It will be closed when this method exits. """
+    def handle_connection(self, stream:BinaryIO, log:LineLogger) -> Optional[ConnectionHandoff]:
+        """ Handle a TCP connection for its entire duration. It will be closed when this method exits,
+            unless it returns a handoff function. That function is called to finish the connection instead
+            (possibly on another thread), which may take as long as it needs. The connection is closed after it. """
         raise NotImplementedError
 
+    def reject_connection(self, stream:BinaryIO, log:LineLogger) -> None:
+        """ Reject a TCP connection because the server is too busy. It will be closed when this method exits.
+            This should only write a short message (if any) and never wait on the client. """
+        log("Connection rejected.")
+
 
 class _SocketReader(RawIOBase):
     """ Aliases socket reading functions to match I/O methods. """
@@ -43,6 +55,29 @@ class _SocketStream(BufferedReader, BinaryIO):
     def writable(self) -> bool:
         return True
 
+    def sendfile(self, fp:BinaryIO) -> None:
+        """ Send the rest of a binary file. With os.sendfile, the kernel copies it straight from the page cache
+            without it ever passing through Python. The socket is non-blocking if it has a timeout, so wait for
+            the client to make room in the send buffer (up to the timeout) every time it fills up. """
+        if not hasattr(os, "sendfile"):
+            copyfileobj(fp, self)
+            return
+        sock_fd = self._sock.fileno()
+        file_fd = fp.fileno()
+        offset = fp.tell()
+        timeout = self._sock.gettimeout()
+        while True:
+            try:
+                sent = os.sendfile(sock_fd, file_fd, offset, 1 << 20)
+            except BlockingIOError:
+                if not select([], [sock_fd], [], timeout)[1]:
+                    raise SocketTimeout("timed out")
+                continue
+            if not sent:
+                break
+            offset += sent
+        fp.seek(offset)
+
     def close(self) -> None:
         super().close()
         try:
@@ -71,10 +106,36 @@ class TCPServerSocket(socket):
         except (InterruptedError, OSError):
             return False
 
-    def accept(self) -> TCPConnection:
-        """ Connect to the client and return an I/O stream along with the client's IP address and TCP port. """
-        fd, (addr, port) = self._accept()
+    @classmethod
+    def bind_to(cls, address:str, port:int, *, reuse_port=False) -> "TCPServerSocket":
+        """ Make a server socket bound to <address:port> and start listening.
+            Set options to avoid delays on small packets. The socket is non-blocking, so it may be shared by several
+            processes; only one of them will accept each connection. With <reuse_port>, several processes may instead
+            bind their own sockets to the same port, and the OS balances connections between them. """
+        sock = cls()
+        try:
+            sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+            if reuse_port:
+                sock.setsockopt(SOL_SOCKET, _socket.SO_REUSEPORT, 1)
+            sock.setsockopt(SOL_TCP, TCP_NODELAY, 1)
+            sock.setblocking(False)
+            sock.bind((address, port))
+            sock.listen()
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def accept(self, timeout:float=None) -> Optional[TCPConnection]:
+        """ Connect to the client and return an I/O stream along with the client's IP address and TCP port.
+            If the client is idle for more than <timeout> seconds, any read or write will raise socket.timeout.
+            Return None if another process sharing the socket accepted the connection first. """
+        try:
+            fd, (addr, port, *_) = self._accept()
+        except BlockingIOError:
+            return None
         sock = socket(fileno=fd)
+        sock.settimeout(timeout)
         stream = _SocketStream(sock)
         return TCPConnection(stream, addr, port)
 
@@ -88,36 +149,59 @@ class TCPServerSocket(socket):
 class TCPServer:
     """ Simple TCP/IP stream server using sockets.  """
 
-    def __init__(self, handler:TCPConnectionHandler, *, logger:LineLogger=print, timeout=0.5) -> None:
-        self._handler = handler  # Handler of TCP/IP connections.
-        self._logger = logger    # Line-based string callable used to log handler messages.
-        self._timeout = timeout  # Timeout in seconds to poll for new socket connections.
-        self._running = False    # State variable. When set to False, the server stops after its current polling cycle.
+    def __init__(self, handler:TCPConnectionHandler, *, logger:LineLogger=print, timeout=0.5,
+                 idle_timeout:float=None) -> None:
+        self._handler = handler            # Handler of TCP/IP connections.
+        self._logger = logger              # Line-based string callable used to log handler messages.
+        self._timeout = timeout            # Timeout in seconds to poll for new socket connections.
+        self._idle_timeout = idle_timeout  # Timeout in seconds for idle connections (None for no limit).
+        self._running = False              # State variable. When False, the server stops after its current poll.
 
     def start(self, address:str, port:int) -> None:
         """ Make a server socket object bound to <address:port> which opens I/O streams for connections.
-            Set options to avoid delays on small packets, then bind and activate the socket.
             Poll the socket for connections until another thread calls shutdown(). """
+        with TCPServerSocket.bind_to(address, port) as sock:
+            self.serve(sock)
+
+    def serve(self, sock:TCPServerSocket) -> None:
+        """ Poll a listening server socket for connections until another thread calls shutdown().
+            The socket may be shared with other processes. It is not closed afterward. """
         if self._running:
             raise RuntimeError("Server already running.")
         self._running = True
-        with TCPServerSocket() as sock:
-            sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-            sock.setsockopt(SOL_TCP, TCP_NODELAY, 1)
-            sock.bind((address, port))
-            sock.listen()
-            while self._running:
-                if sock.poll(self._timeout):
-                    conn = sock.accept()
+        while self._running:
+            if sock.poll(self._timeout):
+                conn = sock.accept(self._idle_timeout)
+                if conn is not None:
                     self.connect(conn)
 
-    def connect(self, conn:TCPConnection) -> None:
-        """ Send a newly established TCP connection stream to the connection handler.
-            Add the client address and port to all log messages. Close the connection when finished. """
+    def _conn_logger(self, conn:TCPConnection) -> LineLogger:
+        """ Return a logger which adds the client address and port of <conn> to all log messages. """
         def log(message:str) -> None:
             self._logger(f'{conn.addr}:{conn.port} - {message}')
+        return log
+
+    def connect(self, conn:TCPConnection) -> None:
+        """ Send a newly established TCP connection stream to the connection handler. Close it when finished,
+            unless the handler hands it off to be finished some other way. """
+        handoff = None
+        try:
+            handoff = self._handler.handle_connection(conn.stream, self._conn_logger(conn))
+        finally:
+            if handoff is None:
+                conn.stream.close()
+        if handoff is not None:
+            self._handoff(conn, handoff)
+
+    def _handoff(self, conn:TCPConnection, handoff:ConnectionHandoff) -> None:
+        """ Finish a connection that was handed off by the handler and close it. By default, use the same thread. """
         with conn.stream:
-            self._handler.handle_connection(conn.stream, log)
+            handoff()
+
+    def reject(self, conn:TCPConnection) -> None:
+        """ Send a newly established TCP connection stream to the connection handler for rejection and close it. """
+        with conn.stream:
+            self._handler.reject_connection(conn.stream, self._conn_logger(conn))
 
     def shutdown(self) -> None:
         """ Halt serving and close any open sockets and files. Must be called by another thread. """
@@ -129,3 +213,63 @@ class ThreadedTCPServer(TCPServer):
 
     def connect(self, *args) -> None:
         Thread(target=super().connect, args=args, daemon=True).start()
+
+
+class PooledTCPServer(TCPServer):
+    """ Handles connections with a fixed pool of worker threads. The handler and logger must be thread-safe.
+        New connections wait in a bounded queue for a free worker. If the queue is full, the connection is rejected
+        right away on the accepting thread. This sheds load under a burst instead of starting unlimited threads.
+        Connections handed off by the handler (such as WebSockets) may last indefinitely, so each one gets a new
+        thread and its worker goes back to the pool. The handler must put its own limit on those.
+        An idle keep-alive connection holds its worker, so there must be an idle timeout. Otherwise, a few clients
+        that never send another request could hold every worker, and everyone else would get a 503. """
+
+    DEFAULT_IDLE_TIMEOUT = 30.0  # Default time limit in seconds for an idle connection to hold a worker.
+
+    def __init__(self, handler:TCPConnectionHandler, *, worker_count=16, queue_size=64,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, **kwargs) -> None:
+        if idle_timeout is None or idle_timeout <= 0:
+            raise ValueError("A worker pool requires an idle timeout.")
+        super().__init__(handler, idle_timeout=idle_timeout, **kwargs)
+        self._worker_count = worker_count  # Number of worker threads. Each handles one connection at a time.
+        self._queue_size = queue_size      # Maximum number of connections waiting for a worker.
+        self._queue = Queue()              # Accepted connections waiting for a worker. None tells a worker to exit.
+
+    def _work(self) -> None:
+        """ Handle connections from the queue until told to exit. """
+        while True:
+            conn = self._queue.get()
+            if conn is None:
+                return
+            super().connect(conn)
+
+    def _handoff(self, conn:TCPConnection, handoff:ConnectionHandoff) -> None:
+        Thread(target=super()._handoff, args=(conn, handoff), daemon=True).start()
+
+    def serve(self, sock:TCPServerSocket) -> None:
+        """ Start the worker threads before serving. Once serving stops, reject any connections still waiting.
+            Workers finish their current connections before exiting. They are daemons and will not block exit. """
+        if self._running:
+            raise RuntimeError("Server already running.")
+        for _ in range(self._worker_count):
+            Thread(target=self._work, daemon=True).start()
+        try:
+            super().serve(sock)
+        finally:
+            while True:
+                try:
+                    conn = self._queue.get_nowait()
+                except Empty:
+                    break
+                if conn is not None:
+                    self.reject(conn)
+            for _ in range(self._worker_count):
+                self._queue.put(None)
+
+    def connect(self, conn:TCPConnection) -> None:
+        """ Queue <conn> for the next free worker, or reject it now if too many are waiting.
+            Only the accepting thread adds to the queue, so its size can't be any larger than it looks. """
+        if self._queue.qsize() >= self._queue_size:
+            self.reject(conn)
+        else:
+            self._queue.put(conn)
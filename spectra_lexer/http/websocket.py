@@ -0,0 +1,209 @@
+""" Module for the WebSocket protocol (RFC 6455) on the server side of an upgraded HTTP connection. """
+
+from base64 import b64decode, b64encode
+from hashlib import sha1
+from socket import timeout as SocketTimeout
+from struct import pack, unpack
+from threading import Lock
+from typing import BinaryIO, NoReturn, Optional, Tuple
+
+from .request import HTTPRequest
+from .response import HTTPResponse, HTTPResponseHeaders
+from .status import HTTPError
+from .tcp import LineLogger
+
+_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"  # Fixed string appended to each client key in the handshake.
+
+# Frame opcodes.
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+# Close status codes.
+CLOSE_NORMAL = 1000
+CLOSE_GOING_AWAY = 1001
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_INVALID_DATA = 1007
+CLOSE_TOO_BIG = 1009
+
+
+class WebSocketError(Exception):
+    """ Raised if the client breaks the protocol. The first arg is the close status code that was sent. """
+
+
+def upgrade_response(request:HTTPRequest) -> HTTPResponse:
+    """ Check a client's opening handshake and return the 101 response that completes it. """
+    headers = request.headers
+    if request.method.upper() != "GET":
+        raise HTTPError.BAD_REQUEST("WebSocket handshakes must use GET.")
+    if headers.websocket_version() != "13":
+        raise HTTPError.BAD_REQUEST("Only WebSocket version 13 is supported.")
+    key = headers.websocket_key()
+    try:
+        valid_key = len(b64decode(key, validate=True)) == 16
+    except ValueError:
+        valid_key = False
+    if not valid_key:
+        raise HTTPError.BAD_REQUEST("Invalid WebSocket key.")
+    accept = b64encode(sha1((key + _GUID).encode('ascii')).digest()).decode('ascii')
+    resp_headers = HTTPResponseHeaders()
+    resp_headers.set_upgrade("websocket")
+    resp_headers.set_websocket_accept(accept)
+    return HTTPResponse.SWITCHING_PROTOCOLS(resp_headers)
+
+
+def _unmask(data:bytes, mask:bytes) -> bytes:
+    """ XOR <data> with a repeating 4-byte <mask>. Doing it as one big int operation keeps the loop in C. """
+    n = len(data)
+    if not n:
+        return data
+    key = (mask * (n // 4 + 1))[:n]
+    return (int.from_bytes(data, "little") ^ int.from_bytes(key, "little")).to_bytes(n, "little")
+
+
+class WebSocketConnection:
+    """ Reads and writes WebSocket messages over the binary stream of an upgraded HTTP connection.
+        Fragmented messages are reassembled, pings are answered, and the close handshake is done here.
+        Sending is thread-safe, so another thread may send messages while one is receiving them.
+
+        Clients may stay connected long after they last sent anything. If the stream times out while waiting
+        for a frame, the client is sent a ping. Only if it doesn't answer by the next timeout is it dropped. """
+
+    def __init__(self, stream:BinaryIO, *, max_message_size=1 << 20) -> None:
+        self._stream = stream                      # Binary I/O stream of an upgraded connection.
+        self._max_message_size = max_message_size  # Maximum size of a reassembled message in bytes.
+        self._send_lock = Lock()                   # Lock to keep frames from different threads separate.
+        self._closed = False                       # True once a close frame has been sent.
+
+    def _read(self, size:int) -> bytes:
+        data = self._stream.read(size)
+        if len(data) < size:
+            raise ConnectionResetError("Connection closed without a close frame.")
+        return data
+
+    def _fail(self, code:int, reason:str) -> NoReturn:
+        """ Close the connection with an error <code> and raise it. """
+        self.close(code, reason)
+        raise WebSocketError(code, reason)
+
+    def _read_first_byte(self) -> int:
+        """ Wait for the start of the next frame. Ping an idle client at the first timeout. """
+        pinged = False
+        while True:
+            try:
+                return self._read(1)[0]
+            except SocketTimeout:
+                if pinged:
+                    raise
+                self.send(OP_PING)
+                pinged = True
+
+    def _read_frame(self) -> Tuple[bool, int, bytes]:
+        """ Read one frame from the client and return its FIN bit, opcode, and unmasked payload. """
+        b0 = self._read_first_byte()
+        b1 = self._read(1)[0]
+        fin = bool(b0 & 0x80)
+        opcode = b0 & 0x0F
+        if b0 & 0x70:
+            self._fail(CLOSE_PROTOCOL_ERROR, "No extensions were negotiated.")
+        if not b1 & 0x80:
+            self._fail(CLOSE_PROTOCOL_ERROR, "Client frames must be masked.")
+        length = b1 & 0x7F
+        if opcode & 0x8 and (length > 125 or not fin):
+            self._fail(CLOSE_PROTOCOL_ERROR, "Invalid control frame.")
+        if length == 126:
+            length, = unpack("!H", self._read(2))
+        elif length == 127:
+            length, = unpack("!Q", self._read(8))
+        if length > self._max_message_size:
+            self._fail(CLOSE_TOO_BIG, "Message too big.")
+        mask = self._read(4)
+        payload = _unmask(self._read(length), mask)
+        return fin, opcode, payload
+
+    def receive(self) -> Optional[Tuple[int, bytes]]:
+        """ Return the opcode (OP_TEXT or OP_BINARY) and payload of the next complete message from the client.
+            Return None once the client closes the connection. """
+        msg_opcode = None
+        fragments = []
+        size = 0
+        while True:
+            fin, opcode, payload = self._read_frame()
+            if opcode == OP_CLOSE:
+                code = unpack("!H", payload[:2])[0] if len(payload) >= 2 else CLOSE_NORMAL
+                self.close(code)
+                return None
+            if opcode == OP_PING:
+                self.send(OP_PONG, payload)
+                continue
+            if opcode == OP_PONG:
+                continue
+            if opcode == OP_CONTINUATION:
+                if msg_opcode is None:
+                    self._fail(CLOSE_PROTOCOL_ERROR, "Continuation frame without a message.")
+            elif opcode in (OP_TEXT, OP_BINARY):
+                if msg_opcode is not None:
+                    self._fail(CLOSE_PROTOCOL_ERROR, "New message before the last one finished.")
+                msg_opcode = opcode
+            else:
+                self._fail(CLOSE_PROTOCOL_ERROR, "Unknown opcode.")
+            size += len(payload)
+            if size > self._max_message_size:
+                self._fail(CLOSE_TOO_BIG, "Message too big.")
+            fragments.append(payload)
+            if fin:
+                return msg_opcode, b''.join(fragments)
+
+    def receive_text(self) -> Optional[str]:
+        """ Return the next message from the client as text, or None once the client closes the connection. """
+        message = self.receive()
+        if message is None:
+            return None
+        opcode, payload = message
+        if opcode != OP_TEXT:
+            self._fail(CLOSE_INVALID_DATA, "Only text messages are accepted.")
+        try:
+            return payload.decode('utf-8')
+        except UnicodeDecodeError:
+            self._fail(CLOSE_INVALID_DATA, "Text messages must be UTF-8.")
+
+    def send(self, opcode:int, payload=b'') -> None:
+        """ Send a single unmasked frame with a complete message. Nothing may be sent after a close frame. """
+        n = len(payload)
+        if n < 126:
+            header = pack("!BB", 0x80 | opcode, n)
+        elif n < 65536:
+            header = pack("!BBH", 0x80 | opcode, 126, n)
+        else:
+            header = pack("!BBQ", 0x80 | opcode, 127, n)
+        with self._send_lock:
+            if self._closed:
+                return
+            if opcode == OP_CLOSE:
+                self._closed = True
+            self._stream.write(header + payload)
+
+    def is_closed(self) -> bool:
+        """ Return True if a close frame was sent. Nothing more can be sent after that. """
+        return self._closed
+
+    def send_text(self, text:str) -> None:
+        self.send(OP_TEXT, text.encode('utf-8'))
+
+    def close(self, code=CLOSE_NORMAL, reason="") -> None:
+        """ Send a close frame with a status <code> unless one was already sent. """
+        try:
+            self.send(OP_CLOSE, pack("!H", code) + reason.encode('utf-8')[:123])
+        except OSError:
+            pass
+
+
+class WebSocketHandler:
+    """ Interface for a handler of WebSocket connections upgraded from HTTP. """
+
+    def handle_websocket(self, ws:WebSocketConnection, log:LineLogger) -> None:
+        """ Exchange messages on <ws> for its entire duration. The connection will be closed when this exits. """
+        raise NotImplementedError
@@ -2,6 +2,7 @@ function SpectraClient() {
 
     const TR_DELIM = '->';          // Delimiter between keys and letters of translations shown in title bar.
     const MORE_TEXT = '[more...]';  // Text displayed as the final match, allowing the user to expand the search.
+    const TIMEOUT_TEXT = '[timed out, more...]';  // Text displayed instead if the search ran out of time.
 
     const OPT_SELECTOR = 'input[name="w_boardopts"]';  // CSS selector for board option radio elements.
 
@@ -66,22 +67,21 @@ function SpectraClient() {
     const displayLink = elementById("w_link");
 
     let lastMatches = {};
-    let lastPageCount = 1;
-    function doSearch() {
+    let lastCursor = 0;
+    function newSearch() {
         let input = searchInput.value;
-        sendRequest("search", [input, lastPageCount]);
+        sendRequest("search", [input, 1]);
     }
-    function newSearch() {
-        lastPageCount = 1;
-        doSearch();
+    function moreSearch() {
+        let input = searchInput.value;
+        sendRequest("search_more", [input, lastCursor]);
     }
     function querySelection(match, mappings) {
         sendRequest("query_match", [match, mappings]);
     }
     function onSelectMatch(match) {
-        if (match == MORE_TEXT) {
-            lastPageCount++;
-            doSearch();
+        if (match == MORE_TEXT || match == TIMEOUT_TEXT) {
+            moreSearch();
         } else {
             let mappings = lastMatches[match];
             mappingList.update(mappings);
@@ -128,10 +128,30 @@ function SpectraClient() {
     });
 
     let currentPages = {};
+    let currentPageRefs = new Set();
     let currentDefaultPage = null;
+    let currentTranslation = null;
     let lastNodeRef = null;
+    async function fetchPage(nodeRef) {
+        // Pages not sent with the display are requested one at a time. Drop any that are stale when they arrive.
+        let pages = currentPages;
+        let value = await sendRequest("page", [...currentTranslation, nodeRef], false, false);
+        if (value && value.page) {
+            pages[nodeRef] = value.page;
+            if (pages === currentPages && nodeRef == lastNodeRef) {
+                setPage(value.page);
+            }
+        }
+    }
     function graphAction(nodeRef, isFocused) {
-        let page = currentPages[nodeRef] || currentDefaultPage;
+        let page = currentPages[nodeRef];
+        if (!page && currentPageRefs.has(nodeRef)) {
+            lastNodeRef = nodeRef;
+            graphFocused = isFocused;
+            fetchPage(nodeRef);
+            return;
+        }
+        page = page || currentDefaultPage;
         if (page) {
             lastNodeRef = nodeRef;
             graphFocused = isFocused;
@@ -156,14 +176,15 @@ function SpectraClient() {
         return false;
     });
 
-    function updateMatches({pattern, results, can_expand}) {
+    function updateMatches({pattern, results, can_expand, cursor, is_more, timed_out}) {
         if (pattern != searchInput.value) {
             searchInput.value = pattern;
         }
-        lastMatches = results;
-        let keys = Object.keys(results);
+        lastMatches = is_more ? {...lastMatches, ...results} : results;
+        lastCursor = cursor;
+        let keys = Object.keys(lastMatches);
         if (can_expand) {
-            keys.push(MORE_TEXT);
+            keys.push(timed_out ? TIMEOUT_TEXT : MORE_TEXT);
         }
         matchList.update(keys);
         // If the new list does not have the previous selection, reset the mappings.
@@ -185,10 +206,12 @@ function SpectraClient() {
             mappingList.selectText(mapping);
         }
     }
-    function updateDisplay({keys, letters, pages_by_ref, default_page}) {
+    function updateDisplay({keys, letters, pages_by_ref, default_page, page_refs}) {
         let title = keys + ' ' + TR_DELIM + ' ' + letters;
         currentPages = pages_by_ref;
+        currentPageRefs = new Set(page_refs || []);
         currentDefaultPage = default_page;
+        currentTranslation = [keys, letters];
         if (title != displayTitle.value) {
             displayTitle.value = title;
             lastNodeRef = null;
@@ -214,9 +237,53 @@ function SpectraClient() {
         }
     }
 
+    // Requests go over a WebSocket when one is open. A newer search cancels an older one still running,
+    // and the reply to a cancelled request has no result. Plain HTTP requests are the fallback.
+    let socket = null;
+    let socketCalls = new Map();
+    let socketLastId = 0;
+    function openSocket() {
+        if (!window.WebSocket) {
+            return;
+        }
+        let scheme = (window.location.protocol == 'https:' ? 'wss://' : 'ws://');
+        let ws = new WebSocket(scheme + window.location.host + '/ws');
+        ws.addEventListener("open", () => {
+            socket = ws;
+        });
+        ws.addEventListener("message", e => {
+            let {id, result, error, cancelled} = JSON.parse(e.data);
+            let call = socketCalls.get(id);
+            if (call) {
+                socketCalls.delete(id);
+                call(result, error, cancelled);
+            }
+        });
+        ws.addEventListener("close", () => {
+            socket = null;
+            for (let call of socketCalls.values()) {
+                call(null, 'WebSocket closed', false);
+            }
+            socketCalls.clear();
+        });
+    }
+    function socketRequest(request) {
+        return new Promise((resolve, reject) => {
+            let id = ++socketLastId;
+            socketCalls.set(id, (result, error, cancelled) => {
+                if (error) {
+                    reject(new Error(error));
+                } else {
+                    resolve(cancelled ? null : result);
+                }
+            });
+            socket.send(JSON.stringify({id, request}));
+        });
+    }
+
     let queryOptions = {};
     let cache = new Map();
-    async function sendRequest(action, args, ignoreCache=false) {
+    async function sendRequest(action, args, ignoreCache=false, update=true) {
         let boardOpts = JSON.parse(document.querySelector(OPT_SELECTOR + ':checked').value);
         let options = {search_mode_strokes: searchModeStrokes.checked,
                        search_mode_regex: searchModeRegex.checked,
@@ -224,24 +291,38 @@ function SpectraClient() {
                        board_show_compound: boardOpts[0],
                        board_show_letters: boardOpts[1],
                        ...queryOptions};
-        let requestBody = JSON.stringify({action, args, options});
+        let requestObj = {action, args, options, lazy_pages: true};
+        let requestBody = JSON.stringify(requestObj);
         try {
             let value = cache.get(requestBody);
             if (!value || ignoreCache) {
-                let request = {method: 'POST',
-                               body: requestBody,
-                               headers: {'Content-Type': 'application/json'}};
-                let response = await fetch('/request', request);
-                value = await response.json();
+                if (socket) {
+                    value = await socketRequest(requestObj);
+                    if (!value) {
+                        return null;  // Cancelled by a newer request.
+                    }
+                } else {
+                    let request = {method: 'POST',
+                                   body: requestBody,
+                                   headers: {'Content-Type': 'application/json'}};
+                    let response = await fetch('/request', request);
+                    value = await response.json();
+                }
                 cache.set(requestBody, value);
             }
-            updateGUI(value);
+            if (update) {
+                updateGUI(value);
+            }
+            return value;
         } catch(e) {
             displayDesc.innerHTML = '<span style="color: #D00000;">CONNECTION ERROR</span>';
             console.error(e);
+            return null;
         }
     }
 
+    openSocket();
+
     // Parse JSON-based options from the URL query string, then execute startup actions.
     let params = new URLSearchParams(window.location.search);
     for (let [k, v] of params) {
@@ -1,36 +1,76 @@
 """ Main module for the HTTP web application. """
 
+from concurrent.futures import ThreadPoolExecutor
 import os
 import sys
+from typing import Optional
 
 from spectra_lexer import Spectra, SpectraOptions
 from spectra_lexer.app_json import build_app
+from spectra_lexer.http.aio import AsyncHTTPConnectionHandler, AsyncHTTPServer
 from spectra_lexer.http.connect import HTTPConnectionHandler
-from spectra_lexer.http.json import JSONApplication, JSONDataProcessor, RestrictedJSONDecoder
+from spectra_lexer.http.json import JSONApplication, JSONDataProcessor, JSONWebSocketHandler, RestrictedJSONDecoder
+from spectra_lexer.http.request import HTTPRequest
 from spectra_lexer.http.service import HTTPDataService, HTTPFileService, HTTPGzipFilter, \
-    HTTPContentTypeRouter, HTTPMethodRouter, HTTPPathRouter
-from spectra_lexer.http.tcp import ThreadedTCPServer
+    HTTPContentTypeRouter, HTTPMethodRouter, HTTPPathRouter, HTTPRequestHandler, HTTPResponseCache
+from spectra_lexer.http.prefork import PreforkServer
+from spectra_lexer.http.tcp import PooledTCPServer, ThreadedTCPServer
 
 SERVER_VERSION = f"Spectra/0.6 Python/{sys.version.split()[0]}"
 HTTP_PUBLIC_DEFAULT = os.path.join(os.path.split(__file__)[0], "http_public")
+JSON_ACTION_LIMIT = 20  # Limit on JSON objects and arrays (each) in a request for one app action.
 
 
-def build_dispatcher(app:JSONApplication, root_dir=".") -> HTTPConnectionHandler:
-    """ Build an HTTP server object customized to Spectra's requirements. """
-    decoder = RestrictedJSONDecoder(size_limit=100000, obj_limit=20, arr_limit=20)
-    processor = JSONDataProcessor(app, decoder)
-    data_service = HTTPDataService(processor)
-    compressed_service = HTTPGzipFilter(data_service, size_threshold=1000)
+def build_decoder(max_batch=1) -> RestrictedJSONDecoder:
+    """ Build a JSON decoder for untrusted requests. If the app accepts batches of up to <max_batch> actions,
+        each one gets the object and array limits of a single request. The app must reject larger batches itself;
+        the limits alone can't count actions. """
+    return RestrictedJSONDecoder(size_limit=100000, obj_limit=JSON_ACTION_LIMIT, arr_limit=JSON_ACTION_LIMIT,
+                                 batch_field="batch", max_batch=max_batch)
+
+
+def build_router(app:JSONApplication, root_dir=".", *, cache_size=0, gzip_level:int=None,
+                 max_batch=1) -> HTTPRequestHandler:
+    """ Build an HTTP request handler customized to Spectra's requirements.
+        If <cache_size> is more than 0, cache up to that many bytes of JSON responses for actions that allow it.
+        JSON responses are compressed at a fixed <gzip_level> if given, otherwise at a level adapted to their size
+        and the server load. Cached responses are compressed once at the best level (or <gzip_level>).
+        Batch requests may have up to <max_batch> actions. """
+    processor = JSONDataProcessor(app, build_decoder(max_batch))
+    # The app runs each request in its own engine context, so requests need no lock.
+    data_service = json_service = HTTPDataService(processor, thread_safe=True)
+    if cache_size > 0:
+        def cache_key(request:HTTPRequest) -> Optional[bytes]:
+            # The service keeps the decoded request, so it won't decode it again to process it.
+            try:
+                obj_in = data_service.decode(request)
+            except ValueError:
+                return None
+            return processor.cache_key(obj_in)
+        json_service = HTTPResponseCache(json_service, cache_key, max_size=cache_size, gzip_level=gzip_level or 9)
+    json_service = HTTPGzipFilter(json_service, compresslevel=gzip_level, size_threshold=1000)
     file_service = HTTPFileService(root_dir)
     type_router = HTTPContentTypeRouter()
-    type_router.add_route("application/json", compressed_service)
+    type_router.add_route("application/json", json_service)
     post_router = HTTPPathRouter()
     post_router.add_route("/request", type_router)
     method_router = HTTPMethodRouter()
     method_router.add_route("GET", file_service)
     method_router.add_route("HEAD", file_service)
     method_router.add_route("POST", post_router)
-    return HTTPConnectionHandler(method_router, server_version=SERVER_VERSION)
+    return method_router
+
+
+def build_dispatcher(app:JSONApplication, root_dir=".", *, cache_size=0, gzip_level:int=None,
+                     max_batch=1, max_websockets:int=None) -> HTTPConnectionHandler:
+    """ Build an HTTP server object customized to Spectra's requirements.
+        The app also takes requests over a WebSocket at /ws. These skip HTTP parsing entirely, and newer searches
+        cancel older ones that haven't finished yet, so the client can search on every keystroke.
+        Each WebSocket has threads of its own outside of any worker pool. At most <max_websockets> may be open. """
+    router = build_router(app, root_dir, cache_size=cache_size, gzip_level=gzip_level, max_batch=max_batch)
+    dispatcher = HTTPConnectionHandler(router, server_version=SERVER_VERSION, max_websockets=max_websockets)
+    dispatcher.add_websocket_route("/ws", JSONWebSocketHandler(app, build_decoder(max_batch)))
+    return dispatcher
 
 
 def main() -> int:
@@ -38,13 +78,52 @@ def main() -> int:
     opts = SpectraOptions("Run Spectra as an HTTP web server.")
     opts.add("http-addr", "", "IP address or hostname for server.")
     opts.add("http-port", 80, "TCP port to listen for connections.")
+    opts.add("http-async", 0, "If 1, serve from one asyncio event loop (no WebSockets). Requests run on http-threads.")
+    opts.add("http-threads", 0, "Number of worker threads for connections (0 for a new thread per connection).")
+    opts.add("http-queue", 64, "Number of connections that may wait for a worker thread before new ones get a 503.")
+    opts.add("http-websockets", 64, "Maximum number of open WebSockets (0 for no limit). They don't use http-threads.")
+    opts.add("http-timeout", 0.0, "Time limit in seconds for an idle connection to stay open (0 for no limit). "
+                                  "With http-threads, there is always a limit (30 seconds if not set here), "
+                                  "or idle clients could hold every worker.")
+    opts.add("http-processes", 0, "Number of worker processes to fork after loading (0 to serve from this one).")
+    opts.add("http-reuse-port", 0, "If 1, worker processes bind their own sockets with SO_REUSEPORT (Linux only).")
     opts.add("http-dir", HTTP_PUBLIC_DEFAULT, "Root directory for public HTTP file service.")
+    opts.add("http-cache-mb", 32, "Size limit in MB for cached responses to repeated JSON queries (0 for no cache).")
+    opts.add("http-gzip-level", 0, "Fixed gzip level from 1-9 for JSON responses (0 to adapt to size and load).")
+    opts.add("http-max-batch", 8, "Maximum number of actions in one batch request.")
+    opts.add("prewarm-examples", 0, "Number of rules with the most examples to make searchable on startup.")
+    opts.add("regex-timeout", 0.5, "Time limit in seconds for one regex search (0 for no limit).")
+    opts.add("regex-shards", 0, "Number of processes for parallel regex search of large dictionaries (0 for none).")
     spectra = Spectra(opts)
     log = spectra.logger.log
     log("Loading HTTP server...")
-    app = build_app(spectra)
-    dispatcher = build_dispatcher(app, opts.http_dir)
-    server = ThreadedTCPServer(dispatcher, logger=log)
+    fork = opts.http_processes and hasattr(os, "fork")
+    # Search data is normally compiled on first use. Worker processes would each compile their own copy.
+    app = build_app(spectra, prewarm_search=bool(fork), prewarm_examples=opts.prewarm_examples,
+                    regex_timeout=opts.regex_timeout or None, regex_shards=opts.regex_shards,
+                    max_batch=opts.http_max_batch)
+    idle_timeout = opts.http_timeout or None
+    router_kwargs = dict(cache_size=opts.http_cache_mb << 20, gzip_level=opts.http_gzip_level or None,
+                         max_batch=opts.http_max_batch)
+    def make_server():
+        if opts.http_async:
+            # Only the request handlers need threads. Idle connections just wait in the event loop.
+            executor = ThreadPoolExecutor(opts.http_threads or None)
+            router = build_router(app, opts.http_dir, **router_kwargs)
+            dispatcher = AsyncHTTPConnectionHandler(router, server_version=SERVER_VERSION, executor=executor)
+            return AsyncHTTPServer(dispatcher, logger=log, idle_timeout=idle_timeout)
+        dispatcher = build_dispatcher(app, opts.http_dir, max_websockets=opts.http_websockets or None,
+                                      **router_kwargs)
+        if opts.http_threads:
+            return PooledTCPServer(dispatcher, logger=log,
+                                   idle_timeout=idle_timeout or PooledTCPServer.DEFAULT_IDLE_TIMEOUT,
+                                   worker_count=opts.http_threads, queue_size=opts.http_queue)
+        return ThreadedTCPServer(dispatcher, logger=log, idle_timeout=idle_timeout)
+    if fork:
+        # Each worker process makes its own server after the fork. Resources loaded so far are shared.
+        server = PreforkServer(make_server, opts.http_processes, logger=log, reuse_port=bool(opts.http_reuse_port))
+    else:
+        server = make_server()
     log("Server started.")
     try:
         server.start(opts.http_addr, opts.http_port)
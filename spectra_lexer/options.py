@@ -28,6 +28,10 @@ class SpectraOptions(CmdlineOptions):
                  "JSON translation files to load on start.")
         self.add("index", self.USER_PATH_PREFIX + "index.json",
                  "JSON index file to load on start and/or write to.")
+        self.add("search-index", self.USER_PATH_PREFIX + "search_index.bin",
+                 "Binary search index file written from the translations for fast startup (empty to disable).")
+        self.add("examples-index", self.USER_PATH_PREFIX + "examples_index.bin",
+                 "Binary examples index file written from the JSON index for fast startup (empty to disable).")
         self.add("config", self.USER_PATH_PREFIX + "config.cfg",
                  "Config CFG/INI file to load at start and/or write to.")
         converter = PrefixPathConverter()
@@ -65,6 +69,18 @@ class SpectraOptions(CmdlineOptions):
         """ Return the full file path to the examples index, adding directories if it doesn't exist. """
         return self._convert_path(self.index, make_dirs=True)
 
+    def search_index_path(self) -> str:
+        """ Return the full file path to the binary search index (if enabled), adding directories if necessary. """
+        if not self.search_index:
+            return ""
+        return self._convert_path(self.search_index, make_dirs=True)
+
+    def examples_index_path(self) -> str:
+        """ Return the full file path to the binary examples index (if enabled), adding directories if necessary. """
+        if not self.examples_index:
+            return ""
+        return self._convert_path(self.examples_index, make_dirs=True)
+
     def config_path(self) -> str:
         """ Return the full file path to the config file, adding directories if it doesn't exist. """
         return self._convert_path(self.config, make_dirs=True)
@@ -27,9 +27,12 @@ class GUIHooks:
     def on_translation_submit(self, text:str) -> None:
         """ Do a lexer query on user input text. """
 
-    def on_search_input(self, pattern:str, pages:int) -> None:
+    def on_search_input(self, pattern:str) -> None:
         """ Do a translation/examples search and update the GUI. """
 
+    def on_search_more(self, pattern:str, cursor:int) -> None:
+        """ Continue a translation search from <cursor> and add the next page of results to the GUI. """
+
     def on_search_query(self, match:str, mapping:str) -> None:
         """ Do an ordinary lexer query and update the GUI. """
 
@@ -73,8 +76,11 @@ class GUIController:
     def set_selections(self, match:str, mapping:str) -> None:
         self._search.select(match, mapping)
 
-    def set_matches(self, matches:SearchResults, *, can_expand=False) -> None:
-        self._search.update_results(matches, can_expand=can_expand)
+    def set_matches(self, matches:SearchResults, *, can_expand=False, cursor=0) -> None:
+        self._search.update_results(matches, can_expand=can_expand, cursor=cursor)
+
+    def add_matches(self, matches:SearchResults, *, can_expand=False, cursor=0) -> None:
+        self._search.extend_results(matches, can_expand=can_expand, cursor=cursor)
 
     def set_title(self, text:str) -> None:
         self._w_title.setText(text)
@@ -147,6 +153,7 @@ class GUIController:
     def connect(self, hooks:GUIHooks) -> None:
         """ Connect Qt signals (through a lambda if none of their arguments are used). """
         self._search.searchRequested.connect(hooks.on_search_input)
+        self._search.searchMoreRequested.connect(hooks.on_search_more)
         self._search.queryRequested.connect(hooks.on_search_query)
         self._search.queryAllRequested.connect(hooks.on_search_multiquery)
         self._w_title.textEdited.connect(noargs(hooks.on_translation_edit))
@@ -74,9 +74,10 @@ class SearchListWidget(QListView):
 class SearchPanel(QObject):
     """ Controls the three main search widgets. """
 
-    searchRequested = pyqtSignal([str, int])     # Emitted when a search operation is needed to refresh the lists.
-    queryRequested = pyqtSignal([str, str])      # Emitted when a query should be made with a single translation.
-    queryAllRequested = pyqtSignal([str, list])  # Emitted when a query should be made with multiple translations.
+    searchRequested = pyqtSignal([str])           # Emitted when a search operation is needed to refresh the lists.
+    searchMoreRequested = pyqtSignal([str, int])  # Emitted with a cursor when the user asks for another page.
+    queryRequested = pyqtSignal([str, str])       # Emitted when a query should be made with a single translation.
+    queryAllRequested = pyqtSignal([str, list])   # Emitted when a query should be made with multiple translations.
 
     def __init__(self, w_input:QLineEdit, w_matches:SearchListWidget, w_mappings:SearchListWidget) -> None:
         super().__init__(w_input)
@@ -84,7 +85,7 @@ class SearchPanel(QObject):
         self._w_matches = w_matches
         self._w_mappings = w_mappings
         self._matches = {}
-        self._page_count = 1
+        self._cursor = 0
         w_input.textEdited.connect(self.invalidate)
         w_matches.itemSelected.connect(self._on_user_select_match)
         w_mappings.itemSelected.connect(self._on_user_select_mapping)
@@ -101,20 +102,15 @@ class SearchPanel(QObject):
     def _select_mapping(self, mapping:str) -> None:
         self._w_mappings.selectByValue(mapping)
 
-    def _send_search(self) -> None:
-        """ Run a new search with the current input text and page count. """
-        input_text = self._w_input.text()
-        self.searchRequested.emit(input_text, self._page_count)
-
     def _new_search(self) -> None:
-        """ Reset the page count and run a new search. """
-        self._page_count = 1
-        self._send_search()
+        """ Run a new search with the current input text. """
+        input_text = self._w_input.text()
+        self.searchRequested.emit(input_text)
 
     def _expanded_search(self) -> None:
-        """ Add another page and run a new search. """
-        self._page_count += 1
-        self._send_search()
+        """ Continue the last search from the cursor to get another page. """
+        input_text = self._w_input.text()
+        self.searchMoreRequested.emit(input_text, self._cursor)
 
     def _on_user_select_match(self, match:str) -> None:
         """ If the user clicked "more", search again with another page.
@@ -151,10 +147,12 @@ class SearchPanel(QObject):
     def update_input(self, value:str) -> None:
         self._w_input.setText(value)
 
-    def update_results(self, matches:SearchResults, *, can_expand=False) -> None:
+    def update_results(self, matches:SearchResults, *, can_expand=False, cursor=0) -> None:
         """ Replace the current set of search results. Add a special item to allow search expansion on click.
+            Save the <cursor> so that expansion only needs to search for the next page.
             If there was only one match, select it and proceed with a query as if the user had clicked it. """
         self._matches = matches
+        self._cursor = cursor
         match_list = list(matches)
         if can_expand:
             match_list.append(MORE_TEXT)
@@ -165,6 +163,10 @@ class SearchPanel(QObject):
             self._select_match(match)
             self._on_user_select_match(match)
 
+    def extend_results(self, matches:SearchResults, *, can_expand=False, cursor=0) -> None:
+        """ Add another page of search results after the current ones. """
+        self.update_results({**self._matches, **matches}, can_expand=can_expand, cursor=cursor)
+
     def select(self, match:str, mapping:str) -> None:
         """ Set the current selections to <match> and <mapping> if possible. Do not send queries. """
         if match in self._matches:
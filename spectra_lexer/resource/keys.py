@@ -1,5 +1,5 @@
 from collections import defaultdict
-from typing import Container, Mapping
+from typing import Container, List, Mapping
 
 from . import FrozenStruct
 
@@ -118,6 +118,24 @@ class StenoKeyConverter:
         """ Transform an s-keys string back to RTFCRE. """
         return self._stroke_map(s, self._stroke_skeys_to_rtfcre)
 
+    def rtfcre_to_masks(self, s:str) -> List[int]:
+        """ Transform an RTFCRE steno key string into a list of bitmasks, one for each stroke.
+            Each s-key sets the bit at its steno ordinal, so chord containment is a simple AND.
+            Unlike the string conversions, unknown characters are not dropped. They raise ValueError instead. """
+        sk_order = self._sk_order
+        aliases = self._aliases
+        masks = []
+        for stroke in s.split(self._sep):
+            skeys = self._stroke_convert_case(stroke)
+            for c in skeys:
+                if aliases.get(ord(c)) is None:
+                    raise ValueError(f"Invalid steno key: {c!r}")
+            mask = 0
+            for k in skeys.translate(aliases):
+                mask |= 1 << sk_order[k]
+            masks.append(mask)
+        return masks
+
 
 def converter_from_keymap(keymap:StenoKeyLayout) -> StenoKeyConverter:
     """ Use a key layout to compute the necessary fields for a converter. Use sets for the fastest membership tests. """
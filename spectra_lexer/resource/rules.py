@@ -1,4 +1,5 @@
 from collections import Counter
+from threading import local
 from typing import Iterable, Sequence
 
 from . import FrozenStruct
@@ -64,33 +65,50 @@ class StenoRule(FrozenStruct):
             assert not -counter, f"Rule {self.id} has fewer keys than its child rules: {-counter}"
 
 
+class _RulemapStack(local):
+    """ Stack of rulemaps under construction. Each thread has its own, so rules may be built on several at once. """
+
+    def __init__(self) -> None:
+        self.head = []   # Current rulemap; the head of the stack.
+        self.stack = []  # The rest of the stack.
+
+
 class StenoRuleFactory:
 
     def __init__(self, *, rule_cls=StenoRule) -> None:
         self._rule_cls = rule_cls
-        self._head = []   # Current rulemap; the head of the stack.
-        self._stack = []  # The rest of the stack.
+        self._rulemaps = _RulemapStack()  # Thread-local rulemap stack.
+
+    def __getstate__(self) -> dict:
+        """ Thread-local data can't be pickled (i.e. for multiprocessing). Copies start with an empty stack. """
+        return {"rule_cls": self._rule_cls}
+
+    def __setstate__(self, state:dict) -> None:
+        self.__init__(**state)
 
     def push(self) -> None:
         """ Push a new rulemap onto the stack. """
-        self._stack.append(self._head)
-        self._head = []
+        rulemaps = self._rulemaps
+        rulemaps.stack.append(rulemaps.head)
+        rulemaps.head = []
 
     def build(self, keys:str, letters:str, info="", alt="", r_id="", **flags:bool) -> StenoRule:
         """ Pop the current rulemap from the stack and build a new rule using it. """
-        rulemap = tuple(self._head)
-        self._head = self._stack.pop()
+        rulemaps = self._rulemaps
+        rulemap = tuple(rulemaps.head)
+        rulemaps.head = rulemaps.stack.pop()
         return self._rule_cls(keys=keys, letters=letters, info=info, alt=alt, id=r_id, rulemap=rulemap, **flags)
 
     def connect(self, child:StenoRule, start:int, length:int) -> None:
         """ Add a <child> rule to the rulemap at <start>. Must be done in order. <length> may be 0. """
         item = self._rule_cls.Connection(child=child, start=start, length=length)
-        self._head.append(item)
+        self._rulemaps.head.append(item)
 
     def connect_rest(self, child:StenoRule, end:int) -> None:
         """ Add a <child> rule to the rulemap covering all distance from the previous child to <end>. """
-        if self._head:
-            last_item = self._head[-1]
+        head = self._rulemaps.head
+        if head:
+            last_item = head[-1]
             last_child_end = last_item.start + last_item.length
         else:
             last_child_end = 0
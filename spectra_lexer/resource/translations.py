@@ -1,5 +1,6 @@
 """ Defines data types for JSON-compatible steno translations. """
 
+from sys import intern
 from typing import Dict, Iterable, Tuple
 
 Translation = Tuple[str, str]                  # A steno translation as a pair of strings: (RTFCRE keys, letters).
@@ -9,6 +10,19 @@ RuleID = str                                   # Rule ID data type. Must be a st
 ExamplesDict = Dict[RuleID, TranslationsDict]  # Dictionary mapping rule identifiers to example translation dicts.
 
 
+def intern_translations(translations:TranslationsDict) -> TranslationsDict:
+    """ Return a copy of <translations> with every string interned. The JSON parser makes a new string object
+        for every value (and every key in a different file), so the same text loaded from several dictionaries
+        and the examples index would otherwise be stored many times over. """
+    return dict(zip(map(intern, translations), map(intern, translations.values())))
+
+
+def intern_examples(examples:ExamplesDict) -> ExamplesDict:
+    """ Return a copy of <examples> with every string interned. Each example is usually also a translation,
+        so after interning both, every example dict refers to the strings in the translations dict. """
+    return {intern(r_id): intern_translations(translations) for r_id, translations in examples.items()}
+
+
 class TranslationFilter:
     """ Filter for RTFCRE steno translations based on string size. """
 
@@ -0,0 +1,93 @@
+""" Module for caching search data with a limit on its total size. """
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from typing import Callable, Generic, Hashable, NamedTuple, Optional, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class CacheInfo(NamedTuple):
+    """ Usage statistics for a cache (similar to functools.lru_cache). """
+
+    hits: int      # Number of lookups that found an existing value.
+    misses: int    # Number of lookups that had to create a new value.
+    size: int      # Current total size of all cached values.
+    max_size: int  # Limit on the total size before values are evicted.
+    count: int     # Current number of cached values.
+
+
+class SizedLRUCache(Generic[K, V]):
+    """ Least-recently-used cache with a limit on the total size of its values instead of their number.
+        This works better than a fixed count when the values vary in size by orders of magnitude.
+        With <max_age>, values also expire that many seconds after they are cached, however often they are used. """
+
+    def __init__(self, max_size:int, sizefn:Callable[[V], int]=len, *, max_age:float=None) -> None:
+        self._max_size = max_size   # Maximum total size of cached values. Least recently used ones are evicted first.
+        self._sizefn = sizefn       # Returns the size of a value in arbitrary units (by default, its length).
+        self._max_age = max_age     # Time in seconds before a cached value expires (None for never).
+        self._data = OrderedDict()  # Cached values with sizes and expiry times from least to most recently used.
+        self._size = 0              # Current total size of cached values.
+        self._hits = 0              # Number of lookups which were found in the cache.
+        self._misses = 0            # Number of lookups which had to create a value.
+        self._lock = Lock()         # Lock to keep the bookkeeping consistent between threads.
+
+    def get(self, key:K, factory:Callable[[], V]) -> V:
+        """ Return the value cached under <key>, or call <factory> to make a new one and cache it.
+            The factory is called outside the lock, so two threads might occasionally make the same value. """
+        with self._lock:
+            item = self._get_item(key)
+            if item is not None:
+                self._hits += 1
+                self._data.move_to_end(key)
+                return item[0]
+            self._misses += 1
+        value = factory()
+        self.add(key, value)
+        return value
+
+    def _get_item(self, key:K) -> Optional[tuple]:
+        """ Return the item cached under <key>, or None if there isn't one. Remove it first if it has expired.
+            The lock must be held. """
+        item = self._data.get(key)
+        if item is not None and item[2] is not None and item[2] <= monotonic():
+            self._data.pop(key)
+            self._size -= item[1]
+            item = None
+        return item
+
+    def add(self, key:K, value:V) -> None:
+        """ Cache <value> under <key>. Evict the least recently used values until the total size is within the limit.
+            A value that is larger than the limit on its own is not cached at all. """
+        size = self._sizefn(value)
+        expires = None if self._max_age is None else monotonic() + self._max_age
+        with self._lock:
+            old_item = self._data.pop(key, None)
+            if old_item is not None:
+                self._size -= old_item[1]
+            if size > self._max_size:
+                return
+            self._data[key] = (value, size, expires)
+            self._size += size
+            while self._size > self._max_size:
+                _, (_, old_size, _) = self._data.popitem(last=False)
+                self._size -= old_size
+
+    def __contains__(self, key:K) -> bool:
+        with self._lock:
+            return self._get_item(key) is not None
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def clear(self) -> None:
+        """ Remove all values. The usage statistics are kept. """
+        with self._lock:
+            self._data.clear()
+            self._size = 0
+
+    def info(self) -> CacheInfo:
+        """ Return the current usage statistics. """
+        return CacheInfo(self._hits, self._misses, self._size, self._max_size, len(self._data))
@@ -0,0 +1,134 @@
+""" Module for a memory-compact replacement for the sorted item lists used by string search indices. """
+
+from array import array
+from collections.abc import Sequence
+from itertools import accumulate, chain
+from typing import Iterable, Iterator, List, Tuple
+
+StringItem = Tuple[str, str]   # A (simkey, key) string pair.
+StringItemIter = Iterable[StringItem]
+StringItemList = List[StringItem]
+
+
+class CompactStringItemList(Sequence):
+    """ Sorted sequence of (simkey, key) string pairs packed into a single string with array offsets.
+
+        A plain list of tuples costs over 100 bytes per item in object overhead alone: the list slot, the tuple,
+        and separate string objects for the simkey and key. Here each item costs 12 bytes of offsets in addition
+        to its characters. The key strings are concatenated first. Each simkey that is not equal to its key follows
+        after those, and each one that is equal just points to the characters of its key instead.
+
+        This is a drop-in replacement for the list used by SimilarKeyIndex, with the following differences:
+        - Items are strings that are created on access, so it is only suitable for read-mostly indices.
+        - It is always sorted. New items from += are merged into sorted order; sort() does nothing.
+        - Insertion and deletion rebuild the entire buffer. They are O(n) like a list, but much slower. """
+
+    def __init__(self, items:StringItemIter=()) -> None:
+        self._buf = ""                     # Concatenated keys, followed by simkeys that differ from their keys.
+        self._key_ends = array('I', [0])   # Buffer offsets for each key. Key i spans [key_ends[i], key_ends[i+1]).
+        self._sk_starts = array('I')       # Buffer offset for the start of each simkey.
+        self._sk_ends = array('I')         # Buffer offset for the end of each simkey.
+        if items:
+            self._pack(sorted(items))
+
+    def _pack(self, items:StringItemList) -> None:
+        """ Replace the contents of the buffer with sorted <items>. """
+        keys = [k for _, k in items]
+        key_ends = array('I', [0])
+        key_ends.extend(accumulate(map(len, keys)))
+        sk_starts = array('I')
+        sk_ends = array('I')
+        extra_simkeys = []
+        pos = key_ends[-1]
+        for i, (sk, k) in enumerate(items):
+            if sk == k:
+                sk_starts.append(key_ends[i])
+                sk_ends.append(key_ends[i + 1])
+            else:
+                sk_starts.append(pos)
+                pos += len(sk)
+                sk_ends.append(pos)
+                extra_simkeys.append(sk)
+        self._buf = "".join(chain(keys, extra_simkeys))
+        self._key_ends = key_ends
+        self._sk_starts = sk_starts
+        self._sk_ends = sk_ends
+
+    def _unpack(self) -> StringItemList:
+        return list(self)
+
+    def bisect_item(self, item:tuple, lo=0, hi:int=None) -> int:
+        """ Find the leftmost index of <item> (or the place it *would* be) between <lo> and <hi>.
+            <item> may be a 1-tuple with only a simkey, which compares less than any item with that simkey.
+            Only the simkey is sliced out of the buffer at each step unless the key is needed to break a tie. """
+        if hi is None:
+            hi = len(self)
+        buf = self._buf
+        sk_starts = self._sk_starts
+        sk_ends = self._sk_ends
+        key_ends = self._key_ends
+        sk, *k = item
+        while lo < hi:
+            mid = (lo + hi) // 2
+            sk_mid = buf[sk_starts[mid]:sk_ends[mid]]
+            if sk_mid < sk or (sk_mid == sk and k and buf[key_ends[mid]:key_ends[mid + 1]] < k[0]):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def iter_keys(self, start:int, stop:int) -> Iterator[str]:
+        """ Return an iterator over key strings between indices <start> and <stop>. All loops are run in C. """
+        key_ends = self._key_ends
+        return map(self._buf.__getitem__, map(slice, key_ends[start:stop], key_ends[start + 1:stop + 1]))
+
+    def iter_simkeys(self, start:int, stop:int) -> Iterator[str]:
+        """ Return an iterator over simkey strings between indices <start> and <stop>. """
+        return map(self._buf.__getitem__, map(slice, self._sk_starts[start:stop], self._sk_ends[start:stop]))
+
+    def __len__(self) -> int:
+        return len(self._sk_starts)
+
+    def __getitem__(self, idx):
+        """ Return an item tuple by index, or a list of them by slice (like a list would). """
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            if step != 1:
+                return self._unpack()[idx]
+            if stop < start:
+                stop = start
+            return list(zip(self.iter_simkeys(start, stop), self.iter_keys(start, stop)))
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('item index out of range')
+        buf = self._buf
+        sk = buf[self._sk_starts[idx]:self._sk_ends[idx]]
+        k = buf[self._key_ends[idx]:self._key_ends[idx + 1]]
+        return sk, k
+
+    def __iter__(self) -> Iterator[StringItem]:
+        n = len(self)
+        return zip(self.iter_simkeys(0, n), self.iter_keys(0, n))
+
+    def __iadd__(self, items:StringItemIter) -> "CompactStringItemList":
+        """ Merge new items into sorted order. """
+        self._pack(sorted(chain(self, items)))
+        return self
+
+    def __delitem__(self, idx:int) -> None:
+        items = self._unpack()
+        del items[idx]
+        self._pack(items)
+
+    def insert(self, idx:int, item:StringItem) -> None:
+        """ Insert an item at an index which must keep the sequence in sorted order (i.e. from bisection). """
+        items = self._unpack()
+        items.insert(idx, item)
+        self._pack(items)
+
+    def clear(self) -> None:
+        self._pack([])
+
+    def sort(self) -> None:
+        """ The items are always sorted. """
@@ -1,11 +1,24 @@
 """ Module for similar-key search operations, further specialized to string keys. """
 
 from bisect import bisect_left, insort_left
+from collections import OrderedDict
+from functools import lru_cache
 from itertools import islice, repeat
 from operator import itemgetter, methodcaller
 import random
 import re
-from typing import Callable, Generic, Iterable, List, TypeVar
+import sys
+from threading import Lock
+from time import perf_counter
+from typing import Callable, FrozenSet, Generic, Iterable, List, NamedTuple, Optional, Tuple, TypeVar
+
+from .compact import CompactStringItemList
+from .shards import ShardedRegexSearcher
+
+try:
+    from re import _parser as _sre_parser  # Python 3.11+
+except ImportError:
+    import sre_parse as _sre_parser
 
 K = TypeVar("K")    # Original key type.
 SK = TypeVar("SK")  # Similarity-transformed key (simkey) type.
@@ -17,6 +30,26 @@ K_ITEMGETTER = itemgetter(1)   # Extracts keys from item tuples.
 SK_ITEMGETTER = itemgetter(0)  # Extracts simkeys from item tuples.
 
 
+class SortedItemList(list):
+    """ Sorted list of tuples: the similarity function output paired with the original key.
+        This is the default item storage for a SimilarKeyIndex. Any other storage must be a sequence of the same
+        tuples with list-like methods for mutation, and it must implement these methods for searching as well. """
+
+    def bisect_item(self, item:tuple, lo=0, hi:int=None) -> int:
+        """ Find the leftmost list index of <item> (or the place it *would* be) between <lo> and <hi>. """
+        if hi is None:
+            hi = len(self)
+        return bisect_left(self, item, lo, hi)
+
+    def iter_keys(self, start:int, stop:int) -> Iterable_K:
+        """ Return an iterator over keys between list indices <start> and <stop>. """
+        return map(K_ITEMGETTER, self[start:stop])
+
+    def iter_simkeys(self, start:int, stop:int) -> Iterable_SK:
+        """ Return an iterator over simkeys between list indices <start> and <stop>. """
+        return map(SK_ITEMGETTER, self[start:stop])
+
+
 class SimilarKeyIndex(Generic[K, SK]):
     """
     Abstract search index using a sorted key list. This allows lookups for keys that are "similar" to a
@@ -51,8 +84,11 @@ class SimilarKeyIndex(Generic[K, SK]):
     +-------------------+-----------------+------+
     """
 
-    def __init__(self) -> None:
-        self._list = []  # Sorted list of tuples: the similarity function output paired with the original key.
+    def __init__(self, items=None) -> None:
+        """ <items> may be existing sorted item storage (such as from a file) to use instead of an empty list. """
+        if items is None:
+            items = SortedItemList()
+        self._list = items  # Sorted list of (simkey, key) tuples. Subclasses may use other storage.
 
     def simfn(self, k:K) -> SK:
         """ The similarity function maps raw keys that share some property to the same "simkey". Must be overridden. """
@@ -63,44 +99,57 @@ class SimilarKeyIndex(Generic[K, SK]):
             The default implementation is a straight call to map(). This is usually good enough. """
         return map(self.simfn, keys)
 
-    def _index_left(self, sk:SK) -> int:
-        """ Find the leftmost list index of <sk> (or the place it *would* be) using bisection search. """
+    def _index_left(self, sk:SK, lo=0, hi:int=None) -> int:
+        """ Find the leftmost list index of <sk> (or the place it *would* be) using bisection search.
+            The search may be restricted to indices between <lo> and <hi> if the result is known to be there. """
         # Out of all tuples with an equal first value, the 1-tuple with this value compares less than any 2-tuple.
-        return bisect_left(self._list, (sk,))
+        return self._list.bisect_item((sk,), lo, hi)
 
     def _index_exact(self, k:K) -> int:
         """ Find the exact list index of the key <k> using bisection search (if it exists). """
         sk = self.simfn(k)
-        return bisect_left(self._list, (sk, k))
+        return self._list.bisect_item((sk, k))
+
+    def position(self, k:K) -> int:
+        """ Return the list index of the key <k>, or the index where it would be inserted if it is not present.
+            This is a valid cursor for resuming a search with <k> as the first result. """
+        return self._index_exact(k)
 
     def insert(self, k:K) -> None:
         """ Find where <k> should go in the list and insert it. """
         sk = self.simfn(k)
         insort_left(self._list, (sk, k))
+        self._invalidate()
 
     def remove(self, k:K) -> None:
         """ Find where <k> is in the list and remove it. """
         idx = self._index_exact(k)
         del self._list[idx]
+        self._invalidate()
 
     def clear(self) -> None:
         self._list.clear()
+        self._invalidate()
 
     def update(self, keys:Iterable_K) -> None:
         """ Add all <keys> to the list at once using the map function and sort it. """
         keys = list(keys)
         self._list += zip(self.mapfn(keys), keys)
         self._list.sort()
+        self._invalidate()
+
+    def _invalidate(self) -> None:
+        """ Called after any change to the list. Subclasses that keep information about list indices must discard it. """
 
-    def _iter_keys(self, idx_start=0, count:int=None, *, getter=K_ITEMGETTER) -> Iterable_K:
+    def _iter_keys(self, idx_start=0, count:int=None) -> Iterable_K:
         """ Return an iterator over keys starting at <idx_start> with an optional limit of <count>. """
-        items = self._list
-        if count is not None:
-            idx_end = idx_start + count
-            items = items[idx_start:idx_end]
-        elif idx_start:
-            items = items[idx_start:]
-        return map(getter, items)
+        idx_end = len(self) if count is None else idx_start + count
+        return self._list.iter_keys(idx_start, idx_end)
+
+    def _iter_simkeys(self, idx_start=0, count:int=None) -> Iterable_SK:
+        """ Return an iterator over simkeys starting at <idx_start> with an optional limit of <count>. """
+        idx_end = len(self) if count is None else idx_start + count
+        return self._list.iter_simkeys(idx_start, idx_end)
 
     def __len__(self) -> int:
         return len(self._list)
@@ -108,12 +157,16 @@ class SimilarKeyIndex(Generic[K, SK]):
     def __iter__(self) -> Iterable_K:
         return self._iter_keys()
 
+    def iter_items(self) -> Iterable[Tuple[SK, K]]:
+        """ Return an iterator over every (simkey, key) item in sorted order. """
+        return iter(self._list)
+
     def get_similar_keys(self, k:K, count:int=None) -> List_K:
         """ Return a list of at most <count> keys that compare equal to <k> under the similarity function. """
         sk_start = self.simfn(k)
         idx_start = self._index_left(sk_start)
         nkeys = 0
-        for sk in self._iter_keys(idx_start, count, getter=SK_ITEMGETTER):
+        for sk in self._iter_simkeys(idx_start, count):
             if sk != sk_start:
                 break
             nkeys += 1
@@ -142,17 +195,266 @@ StringList = List[str]
 
 
 class RegexError(Exception):
-    """ Raised if there's a syntax error in a regex search. """
-
-
+    """ Raised if there's a syntax error in a regex search, or if the pattern is too complex to run safely. """
+
+
+class RegexTimeout(Exception):
+    """ Raised if a regex search runs past its deadline. Every match before the scanned list index is included. """
+
+    def __init__(self, keys:StringList, idx_scanned:int) -> None:
+        super().__init__("Regex search timed out.")
+        self.keys = keys                # Matches found before the deadline in order.
+        self.idx_scanned = idx_scanned  # List index where the search stopped.
+
+
+REGEX_MAX_LENGTH = 1000  # Maximum length of a regex search pattern.
+
+
+def _iter_subpatterns(av) -> Iterable:
+    """ Yield every parsed subpattern in the arguments of a parsed regex opcode. """
+    if isinstance(av, _sre_parser.SubPattern):
+        yield av
+    elif isinstance(av, (list, tuple)):
+        for x in av:
+            yield from _iter_subpatterns(x)
+
+
+_REPEAT_OPS = {_sre_parser.MAX_REPEAT, _sre_parser.MIN_REPEAT, getattr(_sre_parser, "POSSESSIVE_REPEAT", None)}
+_GROUP_OPS = {_sre_parser.SUBPATTERN, getattr(_sre_parser, "ATOMIC_GROUP", None)}
+_ASSERT_OPS = {_sre_parser.ASSERT, _sre_parser.ASSERT_NOT}
+
+
+class _CharSet(NamedTuple):
+    """ Set of characters (as case-folded code points) that some part of a regex may match.
+        A negated set has every character *except* the ones given. """
+
+    negated: bool
+    chars: FrozenSet[int]
+
+    def union(self, other:"_CharSet") -> "_CharSet":
+        if not self.negated and not other.negated:
+            return _CharSet(False, self.chars | other.chars)
+        if self.negated and other.negated:
+            return _CharSet(True, self.chars & other.chars)
+        pos, neg = (other, self) if self.negated else (self, other)
+        return _CharSet(True, neg.chars - pos.chars)
+
+    def isdisjoint(self, other:"_CharSet") -> bool:
+        if self.negated and other.negated:
+            return False
+        if not self.negated and not other.negated:
+            return self.chars.isdisjoint(other.chars)
+        pos, neg = (other, self) if self.negated else (self, other)
+        return pos.chars <= neg.chars
+
+
+def _fold(c:int) -> int:
+    """ Case-fold a code point. Case is always ignored, so patterns with the I flag need no special handling. """
+    lower = chr(c).lower()
+    return ord(lower) if len(lower) == 1 else c
+
+
+def _excluded(codes:Iterable[int]) -> FrozenSet[int]:
+    """ Case-fold the code points excluded by a negated set. A folded code point is only excluded if every case of
+        it is. Otherwise, [^a] would seem to exclude A. """
+    codes = set(codes)
+    return frozenset([_fold(c) for c in codes if {ord(v) for v in (chr(c).lower(), chr(c).upper())
+                                                  if len(v) == 1} <= codes])
+
+
+_NO_CHARS = _CharSet(False, frozenset())
+_ANY_CHAR = _CharSet(True, frozenset())
+_SPACE = frozenset(map(_fold, [c for c in range(0x3001) if chr(c).isspace()]))
+_ASCII_WORD = frozenset(map(ord, "abcdefghijklmnopqrstuvwxyz0123456789_"))
+_ASCII_DIGITS = frozenset(map(ord, "0123456789"))
+_ASCII_SYMBOLS = frozenset(range(0x21, 0x80)) - _ASCII_WORD - frozenset(range(ord("A"), ord("Z") + 1))
+# Character class categories. The space classes are exact. The others are supersets, good enough for overlap tests.
+_CATEGORIES = {_sre_parser.CATEGORY_SPACE:     (_CharSet(False, _SPACE), True),
+               _sre_parser.CATEGORY_NOT_SPACE: (_CharSet(True, _SPACE), True),
+               _sre_parser.CATEGORY_DIGIT:     (_CharSet(True, _SPACE | _ASCII_SYMBOLS), False),
+               _sre_parser.CATEGORY_WORD:      (_CharSet(True, _SPACE | _ASCII_SYMBOLS), False),
+               _sre_parser.CATEGORY_NOT_DIGIT: (_CharSet(True, _ASCII_DIGITS), False),
+               _sre_parser.CATEGORY_NOT_WORD:  (_CharSet(True, _ASCII_WORD), False)}
+_MAX_RANGE = 256  # Ranges in character classes larger than this are treated as any character.
+
+
+def _class_chars(items:list) -> _CharSet:
+    """ Return the characters matched by the items of a parsed character class (or a superset of them). """
+    negate = False
+    exact = True
+    codes = set()
+    cs = _NO_CHARS
+    for op, av in items:
+        if op == _sre_parser.NEGATE:
+            negate = True
+        elif op == _sre_parser.LITERAL:
+            codes.add(av)
+        elif op == _sre_parser.RANGE and av[1] - av[0] <= _MAX_RANGE:
+            codes.update(range(av[0], av[1] + 1))
+        elif op == _sre_parser.CATEGORY and av in _CATEGORIES:
+            category_cs, category_exact = _CATEGORIES[av]
+            cs = cs.union(category_cs)
+            exact = exact and category_exact
+        else:
+            cs = _ANY_CHAR
+            exact = False
+    if not negate:
+        return cs.union(_CharSet(False, frozenset(map(_fold, codes))))
+    # The complement of a superset is too small, so only exact classes may be negated.
+    if not exact:
+        return _ANY_CHAR
+    if cs.negated:
+        return _CharSet(False, cs.chars)
+    return _CharSet(True, cs.chars | _excluded(codes))
+
+
+def _item_chars(op, av) -> Optional[_CharSet]:
+    """ Return the characters matched by a single-character regex item, or None if it is not one. """
+    if op == _sre_parser.LITERAL:
+        return _CharSet(False, frozenset([_fold(av)]))
+    if op == _sre_parser.NOT_LITERAL:
+        return _CharSet(True, _excluded([av]))
+    if op == _sre_parser.ANY:
+        return _ANY_CHAR
+    if op == _sre_parser.IN:
+        return _class_chars(av)
+    return None
+
+
+def _group_items(op, av) -> list:
+    """ Return the items inside a group, which are in the last argument unless the group is atomic. """
+    return av if op != _sre_parser.SUBPATTERN else av[-1]
+
+
+def _first_chars(items) -> Tuple[_CharSet, bool]:
+    """ Return the characters that may start a match of the sequence <items>, and whether it may match nothing. """
+    first = _NO_CHARS
+    for op, av in items:
+        chars = _item_chars(op, av)
+        if chars is not None:
+            return first.union(chars), False
+        if op in _REPEAT_OPS:
+            chars, nullable = _first_chars(av[2])
+            nullable = nullable or av[0] == 0
+        elif op in _GROUP_OPS:
+            chars, nullable = _first_chars(_group_items(op, av))
+        elif op == _sre_parser.BRANCH:
+            chars = _NO_CHARS
+            nullable = False
+            for alt in av[1]:
+                alt_chars, alt_nullable = _first_chars(alt)
+                chars = chars.union(alt_chars)
+                nullable = nullable or alt_nullable
+        elif op == _sre_parser.AT or op in _ASSERT_OPS:
+            # Anchors and lookarounds don't consume anything.
+            chars, nullable = _NO_CHARS, True
+        else:
+            # Backreferences and anything else could start with any character (or nothing).
+            chars, nullable = _ANY_CHAR, True
+        first = first.union(chars)
+        if not nullable:
+            return first, False
+    return first, True
+
+
+def _first_chars_then(items, follow:_CharSet) -> _CharSet:
+    """ Return the characters that may start a match of <items> followed by something starting with <follow>. """
+    first, nullable = _first_chars(items)
+    return first.union(follow) if nullable else first
+
+
+def _all_chars(items) -> _CharSet:
+    """ Return every character that may be matched anywhere in the sequence <items>. """
+    cs = _NO_CHARS
+    for op, av in items:
+        chars = _item_chars(op, av)
+        if chars is None:
+            if op == _sre_parser.AT or op in _ASSERT_OPS:
+                continue
+            chars = _ANY_CHAR
+            subpatterns = list(_iter_subpatterns(av))
+            if subpatterns and op != _sre_parser.GROUPREF_EXISTS:
+                chars = _NO_CHARS
+                for sub in subpatterns:
+                    chars = chars.union(_all_chars(sub))
+        cs = cs.union(chars)
+    return cs
+
+
+def _has_ambiguous_loop(items, follow:_CharSet=_ANY_CHAR, in_loop=False) -> bool:
+    """ Return True if some loop in a parsed regex could match the same text by more than one path.
+        Backtracking over a loop like that takes exponential time on a failed match, such as (a+)+ or (a|aa)*.
+        Inside a loop, that happens if a variable repeat could match a character that can also come right after it,
+        or if two alternatives of a branch could start with the same character. Loops that are not nested in
+        another one, such as .*.*x, can only take polynomial time. Search deadlines are enough for those. """
+    items = list(items)
+    for i, (op, av) in enumerate(items):
+        if _item_chars(op, av) is not None or op == _sre_parser.AT:
+            continue
+        item_follow = _first_chars_then(items[i + 1:], follow)
+        if op in _REPEAT_OPS:
+            lo, hi, body = av
+            if in_loop and lo != hi:
+                body_chars = _all_chars(body) if hi > 1 else _first_chars_then(body, item_follow)
+                if not body_chars.isdisjoint(item_follow):
+                    return True
+            if hi > 1:
+                body_first, nullable = _first_chars(body)
+                if nullable:
+                    return True
+                # The body may be followed by another pass through the loop.
+                if _has_ambiguous_loop(body, body_first.union(item_follow), True):
+                    return True
+            elif _has_ambiguous_loop(body, item_follow, in_loop):
+                return True
+        elif op == _sre_parser.BRANCH:
+            alts = av[1]
+            if in_loop:
+                seen = _NO_CHARS
+                for alt in alts:
+                    alt_first = _first_chars_then(alt, item_follow)
+                    if not alt_first.isdisjoint(seen):
+                        return True
+                    seen = seen.union(alt_first)
+            if any(_has_ambiguous_loop(alt, item_follow, in_loop) for alt in alts):
+                return True
+        elif op in _GROUP_OPS:
+            if _has_ambiguous_loop(_group_items(op, av), item_follow, in_loop):
+                return True
+        elif op in _ASSERT_OPS:
+            if _has_ambiguous_loop(av[1], _ANY_CHAR, in_loop):
+                return True
+        elif any(_has_ambiguous_loop(sub, item_follow, in_loop) for sub in _iter_subpatterns(av)):
+            return True
+    return False
+
+
+@lru_cache(maxsize=256)
 def _regex_matcher(pattern:str) -> Callable:
-    """ Compile a regular expression pattern and return a match predicate function. """
+    """ Compile a regular expression pattern and return a match predicate function.
+        Backtracking takes exponential time on patterns with ambiguous nested repeats such as (a+)+ or (a|aa)*,
+        and one key can stall a search indefinitely with no chance to check a deadline, so these are rejected.
+        Compiled patterns are cached since incremental searches recompile the same ones many times. """
+    if len(pattern) > REGEX_MAX_LENGTH:
+        raise RegexError(f"Regular expressions are limited to {REGEX_MAX_LENGTH} characters.")
     try:
+        parsed = _sre_parser.parse(pattern)
+        if _has_ambiguous_loop(parsed):
+            raise RegexError(pattern + " has ambiguous nested repeats and could take too long to match.")
         return re.compile(pattern).match
-    except re.error as e:
+    except (re.error, RecursionError) as e:
         raise RegexError(pattern + " is not a valid regular expression.") from e
 
 
+class _SearchRecord:
+    """ Record of a finished regex search. Any key before the scanned list index which
+        matches a narrower pattern (such as one extended with literal characters) must be one of its keys. """
+
+    def __init__(self, keys:StringList, idx_scanned:int) -> None:
+        self.keys = keys                # Every match found by the filter in order.
+        self.idx_scanned = idx_scanned  # List index where the filter stopped.
+
+
 class StringKeyIndex(SimilarKeyIndex[str, str]):
     """ A similar-key index with special search methods for string keys.
         In order for the standard optimizations involving literal prefixes to work, the similarity function must
@@ -162,31 +464,149 @@ class StringKeyIndex(SimilarKeyIndex[str, str]):
     # Will always return at least the empty string (which is a prefix of everything).
     _LITERAL_PREFIX_MATCH = _regex_matcher(r'[\w \"#%\',\-:;<=>@`~]*')
 
+    # Regex matcher for a pattern ending with a backslash escape that could be changed by appending more digits.
+    _OPEN_ESCAPE_SEARCH = re.compile(r'\\\d*$').search
+
     # Case-insensitive search is the most common use case.
     simfn = staticmethod(str.lower)
 
-    def _iter_prefix_keys(self, prefix:str, count:int=None) -> StringIter:
-        """ Return an iterator over possible matches for <prefix>, up an optional limit of <count>. """
+    memo_size = 16           # Number of recent searches remembered to narrow later searches for extended patterns.
+    regex_block_size = 2048  # Number of keys matched between deadline checks in a regex search with a timeout.
+    shard_min_size = 50000   # Minimum number of keys in a regex search range to search it in parallel shards.
+
+    def __init__(self, items=None, *, compact=False, shard_count=0) -> None:
+        """ If <compact> is True, pack the keys into a compact string buffer instead of a list of tuples.
+            This uses far less memory for large indices, but access is slower and insertion is *much* slower.
+            If <shard_count> is more than 1, large regex searches run in parallel over that many contiguous shards
+            of the list. Each shard is copied to its own process when first needed, so this takes a lot of memory. """
+        if items is None and compact:
+            items = CompactStringItemList()
+        super().__init__(items)
+        self._memo = OrderedDict()       # LRU memo of recent regex search records keyed by pattern.
+        self._memo_lock = Lock()         # Lock for memo updates. Searches may run on several threads at once.
+        self._shard_count = shard_count  # Number of shards for parallel regex search (0 or 1 to disable).
+        self._shards = None              # Shard worker processes, started by the first regex search that needs them.
+        self._shard_lock = Lock()        # Lock for starting and stopping the shard processes.
+
+    def _invalidate(self) -> None:
+        """ Any change to the list makes the memoized search records invalid. The shards must be copied again. """
+        with self._memo_lock:
+            self._memo.clear()
+        self._close_shards()
+
+    def _close_shards(self) -> None:
+        """ Stop the shard worker processes (if any). They will be started again with new copies if needed. """
+        with self._shard_lock:
+            if self._shards is not None:
+                self._shards.close()
+                self._shards = None
+
+    def _get_shards(self, length:int) -> Optional[ShardedRegexSearcher]:
+        """ Return the shard searcher if it is enabled and a search range of <length> keys is large enough to use it.
+            If the worker processes can't be started, disable it and print a message to stderr. """
+        if self._shard_count < 2 or length < self.shard_min_size:
+            return None
+        with self._shard_lock:
+            if self._shards is None:
+                try:
+                    self._shards = ShardedRegexSearcher(list(self._iter_keys(0, len(self))), self._shard_count)
+                except Exception:
+                    print("Parallel regex search failed to start. Using a single process...", file=sys.stderr)
+                    self._shard_count = 0
+            return self._shards
+
+    def _memo_get(self, key:str) -> Optional[_SearchRecord]:
+        """ Look up a memoized search record and mark it as recently used. """
+        with self._memo_lock:
+            record = self._memo.get(key)
+            if record is not None:
+                self._memo.move_to_end(key)
+            return record
+
+    def _memo_set(self, key:str, record:_SearchRecord) -> None:
+        """ Memoize a search record and discard the least recently used one if the memo is full. """
+        with self._memo_lock:
+            self._memo[key] = record
+            self._memo.move_to_end(key)
+            if len(self._memo) > self.memo_size:
+                self._memo.popitem(last=False)
+
+    def _prefix_range(self, prefix:str) -> Tuple[int, int]:
+        """ Return the start and end list indices of possible matches for <prefix>. """
         sk_start = self.simfn(prefix)
         if not sk_start:
             # If the prefix is empty after transformation, it could possibly match anything.
-            idx_start = 0
-        else:
-            # All matches will be found in the sort order between the prefix itself (inclusive) and
-            # the prefix with one added to the ordinal of its final character (exclusive).
-            sk_end = sk_start[:-1] + chr(ord(sk_start[-1]) + 1)
-            idx_start = self._index_left(sk_start)
-            idx_end = self._index_left(sk_end)
-            length = idx_end - idx_start
-            count = length if count is None else min(count, length)
+            return 0, len(self)
+        # All matches will be found in the sort order between the prefix itself (inclusive) and
+        # the prefix with one added to the ordinal of its final character (exclusive).
+        sk_end = sk_start[:-1] + chr(ord(sk_start[-1]) + 1)
+        idx_start = self._index_left(sk_start)
+        idx_end = self._index_left(sk_end, idx_start)
+        return idx_start, idx_end
+
+    def _regex_record(self, pattern:str) -> Optional[_SearchRecord]:
+        """ Return the record of a recent regex search whose matches must include every match for <pattern>.
+            This is true of any pattern that <pattern> extends by appending only literal characters,
+            unless the old pattern ends with an escape sequence that the new characters could change. """
+        for i in range(len(pattern), 0, -1):
+            if i < len(pattern) and not self._LITERAL_PREFIX_MATCH(pattern[i]).group():
+                break
+            old_pattern = pattern[:i]
+            record = self._memo_get(old_pattern)
+            if record is not None:
+                if i < len(pattern) and self._OPEN_ESCAPE_SEARCH(old_pattern):
+                    break
+                return record
+        return None
+
+    def _iter_prefix_keys(self, prefix:str, count:int=None, start=0) -> StringIter:
+        """ Return an iterator over possible matches for <prefix>, up an optional limit of <count>.
+            Matches before the list index <start> are skipped. """
+        idx_start, idx_end = self._prefix_range(prefix)
+        if idx_start < start:
+            idx_start = start
+        length = max(idx_end - idx_start, 0)
+        count = length if count is None else min(count, length)
         return self._iter_keys(idx_start, count)
 
-    def prefix_match_keys(self, prefix:str, count:int=None) -> StringList:
-        """ Return a list of keys where the simkey starts with <prefix>, up an optional limit of <count>. """
-        return list(self._iter_prefix_keys(prefix, count))
-
-    def regex_match_keys(self, pattern:str, count:int=None) -> StringList:
-        """ Return a list of at most <count> keys that match the regex <pattern> from the start. """
+    def prefix_match_keys(self, prefix:str, count:int=None, *, start=0) -> StringList:
+        """ Return a list of keys where the simkey starts with <prefix>, up an optional limit of <count>.
+            If <start> is given, the search resumes from that list index (usually a cursor from position()). """
+        return list(self._iter_prefix_keys(prefix, count, start))
+
+    def prefix_count(self, prefix:str, *, start=0, stop:int=None) -> int:
+        """ Return the exact number of keys where the simkey starts with <prefix> between list indices <start> and
+            <stop>. This only takes two bisections, so it is O(log n) no matter how many keys match. """
+        idx_start, idx_end = self._prefix_range(prefix)
+        if stop is not None and stop < idx_end:
+            idx_end = stop
+        return max(idx_end - max(idx_start, start), 0)
+
+    def regex_count_bounds(self, pattern:str, *, start=0, stop:int=None) -> Tuple[int, int]:
+        """ Return lower and upper bounds on the number of keys that match the regex <pattern> between list indices
+            <start> and <stop>. Matching every key could take a long time, so only cheap information is used.
+            The upper bound is the number of keys with the literal prefix of the pattern (O(log n) as above).
+            The lower bound comes from a memoized search for the same pattern, if there is one.
+            If that search scanned every possible match, the bounds are equal and the count is exact. """
+        literal_prefix = self._LITERAL_PREFIX_MATCH(pattern).group()
+        if literal_prefix != pattern:
+            _regex_matcher(pattern)
+        upper = self.prefix_count(literal_prefix, start=start, stop=stop)
+        lower = 0
+        with self._memo_lock:
+            record = self._memo.get(pattern)
+        if record is not None and not start and stop is None:
+            lower = len(record.keys)
+            _, idx_end = self._prefix_range(literal_prefix)
+            if record.idx_scanned >= idx_end:
+                upper = lower
+        return lower, upper
+
+    def regex_match_keys(self, pattern:str, count:int=None, *, start=0, timeout:float=None) -> StringList:
+        """ Return a list of at most <count> keys that match the regex <pattern> from the start.
+            If <start> is given, the search resumes from that list index (usually a cursor from position()).
+            If <timeout> is given, raise RegexTimeout with the matches so far if the search takes longer (in seconds).
+            The deadline is checked between blocks of keys, so a search may run over by one block. """
         # First, figure out how much of the pattern string from the start is literal (no regex special characters).
         # If all matches must start with a literal prefix, we can narrow the range of our search.
         literal_prefix = self._LITERAL_PREFIX_MATCH(pattern).group()
@@ -196,17 +616,66 @@ class StringKeyIndex(SimilarKeyIndex[str, str]):
             match_op = methodcaller("startswith", pattern)
         else:
             match_op = _regex_matcher(pattern)
+        idx_first, idx_end = self._prefix_range(literal_prefix)
+        idx_start = max(idx_first, start)
+        # Only searches from the start with a limited count are memoized. Others could take too much memory.
+        can_memoize = (not start and count is not None)
+        candidates = ()
+        if can_memoize:
+            # Recheck the matches from an earlier pattern and skip the keys it has already rejected.
+            last_record = self._regex_record(pattern)
+            if last_record is not None:
+                candidates = last_record.keys
+                idx_start = max(idx_start, last_record.idx_scanned)
         # Run the match filter until <count> entries have been produced (if None, search the entire key list).
-        keys = self._iter_prefix_keys(literal_prefix)
-        return list(islice(filter(match_op, keys), count))
+        # Without a deadline, do it all in one block. Otherwise, check the time after each block.
+        matches = list(islice(filter(match_op, candidates), count))
+        block_size = max(idx_end - idx_start, 0) if timeout is None else self.regex_block_size
+        deadline = None if timeout is None else perf_counter() + timeout
+        idx = idx_start
+        timed_out = False
+        if literal_prefix != pattern and (count is None or len(matches) < count):
+            # Large searches may run in parallel shards. If the workers fail, do it here instead.
+            shards = self._get_shards(idx_end - idx_start)
+            if shards is not None:
+                try:
+                    shard_matches, idx = shards.search(pattern, idx_start, idx_end,
+                                                       None if count is None else count - len(matches), deadline)
+                    matches += shard_matches
+                    timed_out = (idx < idx_end and (count is None or len(matches) < count))
+                except Exception:
+                    print("Parallel regex search failed. Using a single process...", file=sys.stderr)
+                    self._close_shards()
+                    self._shard_count = 0
+        while not timed_out and idx < idx_end and (count is None or len(matches) < count):
+            idx_block_end = min(idx + block_size, idx_end)
+            keys = self._iter_keys(idx, idx_block_end - idx)
+            matches += islice(filter(match_op, keys), None if count is None else count - len(matches))
+            idx = idx_block_end
+            if deadline is not None and idx < idx_end and perf_counter() > deadline:
+                timed_out = True
+                break
+        if count is not None and len(matches) >= count:
+            idx_scanned = self._index_exact(matches[-1]) + 1 if matches else idx_first
+        else:
+            idx_scanned = idx if timed_out else idx_end
+        if can_memoize:
+            # A partial search still has every match before the point where it stopped.
+            self._memo_set(pattern, _SearchRecord(matches, idx_scanned))
+        if timed_out:
+            raise RegexTimeout(matches, idx_scanned)
+        return matches
 
 
 class StripCaseIndex(StringKeyIndex):
     """ String index with similarity functions that ignore case and/or certain ending characters. """
 
-    def __init__(self, strip_chars=" ") -> None:
-        super().__init__()
-        self._strip_chars = strip_chars  # Characters to ignore at the ends of strings during search.
+    def __init__(self, strip_chars=" ", *args, intern_simkeys=False, **kwargs) -> None:
+        """ If <intern_simkeys> is True, simkeys are interned when added in bulk. str.lower() always makes a new
+            string, but most simkeys for text are equal to their (interned) keys, so they can share the same object. """
+        super().__init__(*args, **kwargs)
+        self._strip_chars = strip_chars        # Characters to ignore at the ends of strings during search.
+        self._intern_simkeys = intern_simkeys  # If True, share simkey strings with any equal interned strings.
 
     def simfn(self, s:str) -> str:
         """ Similarity function that removes case and strips a user-defined set of characters. """
@@ -214,4 +683,7 @@ class StripCaseIndex(StringKeyIndex):
 
     def mapfn(self, s_iter:StringIter) -> StringIter:
         """ Mapping the built-in string methods separately provides a good speed boost for large dictionaries. """
-        return map(str.lower, map(str.strip, s_iter, repeat(self._strip_chars)))
+        simkeys = map(str.lower, map(str.strip, s_iter, repeat(self._strip_chars)))
+        if self._intern_simkeys:
+            simkeys = map(sys.intern, simkeys)
+        return simkeys
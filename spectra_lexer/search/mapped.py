@@ -0,0 +1,452 @@
+""" Module for search data in binary file formats which are memory-mapped and searched in place.
+    Each file starts with a signature and a JSON header, followed by aligned arrays of offsets and UTF-8 strings. """
+
+from array import array
+from collections.abc import ItemsView, Mapping, Sequence
+import json
+import mmap
+import os
+import struct
+import sys
+from typing import Dict, Iterable, Iterator, List, Tuple
+from zlib import crc32
+
+from .cache import SizedLRUCache
+from .compact import StringItem, StringItemList
+
+StringTuple = Tuple[str, ...]
+# A section of string search data: sorted (simkey, key) items, a tuple of value strings for each item,
+# and the name of the section with the keys that those values refer to.
+SearchFileSection = Tuple[StringItemList, List[StringTuple], str]
+StringPair = Tuple[str, str]
+ExamplesMapping = Mapping  # Mapping of rule IDs to a mapping of example translations (like an ExamplesDict).
+
+_HEADER_SIZE = struct.Struct('<I')  # Size field for the JSON header after the signature.
+_ALIGN = 4                          # Alignment in bytes for arrays of offsets.
+_ARRAY_TYPE = 'I'                   # Array type code for unsigned offsets of at least 32 bits.
+
+
+def _encode(s:str) -> bytes:
+    """ UTF-8 preserves code point order in bytewise comparisons (even for lone surrogates from JSON files). """
+    return s.encode('utf-8', 'surrogatepass')
+
+
+def _decode(b:bytes) -> str:
+    return b.decode('utf-8', 'surrogatepass')
+
+
+def _aligned(pos:int) -> int:
+    return -(-pos // _ALIGN) * _ALIGN
+
+
+def _table_size(n:int) -> int:
+    """ Return a power of two hash table size that is at most half full with <n> keys. """
+    size = 1
+    while size < 2 * n:
+        size *= 2
+    return size
+
+
+class MappedStringItemList(Sequence):
+    """ Read-only sorted sequence of (simkey, key) string pairs stored as UTF-8 in a memory-mapped file.
+        This may be used as the item storage for a SimilarKeyIndex with the same similarity function that sorted it.
+        Items are located by bisection over the raw bytes, so only the parts of the file that are actually searched
+        ever need to be read from disk. Strings are decoded on access. """
+
+    def __init__(self, buf:mmap.mmap, key_ends:memoryview, sk_starts:memoryview, sk_ends:memoryview,
+                 key_table:memoryview) -> None:
+        self._buf = buf              # Mapped file contents. Slices return bytes.
+        self._key_ends = key_ends    # File offsets for each key. Key i spans [key_ends[i], key_ends[i+1]).
+        self._sk_starts = sk_starts  # File offset for the start of each simkey.
+        self._sk_ends = sk_ends      # File offset for the end of each simkey.
+        self._key_table = key_table  # Hash table of key indices plus one (zero is empty) with linear probing.
+
+    def bisect_item(self, item:tuple, lo=0, hi:int=None) -> int:
+        """ Find the leftmost index of <item> (or the place it *would* be) between <lo> and <hi>.
+            <item> may be a 1-tuple with only a simkey, which compares less than any item with that simkey. """
+        if hi is None:
+            hi = len(self)
+        buf = self._buf
+        sk_starts = self._sk_starts
+        sk_ends = self._sk_ends
+        key_ends = self._key_ends
+        sk, *k = map(_encode, item)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            sk_mid = buf[sk_starts[mid]:sk_ends[mid]]
+            if sk_mid < sk or (sk_mid == sk and k and buf[key_ends[mid]:key_ends[mid + 1]] < k[0]):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find_key(self, k:str) -> int:
+        """ Return the index of the exact key <k> using the hash table, or -1 if it isn't present.
+            This is much faster than bisection since there is usually only one string comparison. """
+        buf = self._buf
+        key_ends = self._key_ends
+        table = self._key_table
+        mask = len(table) - 1
+        b = _encode(k)
+        i = crc32(b) & mask
+        while True:
+            entry = table[i]
+            if not entry:
+                return -1
+            idx = entry - 1
+            if buf[key_ends[idx]:key_ends[idx + 1]] == b:
+                return idx
+            i = (i + 1) & mask
+
+    def key(self, idx:int) -> str:
+        """ Return only the key string at <idx>. """
+        return _decode(self._buf[self._key_ends[idx]:self._key_ends[idx + 1]])
+
+    def iter_keys(self, start:int, stop:int) -> Iterator[str]:
+        """ Return an iterator over key strings between indices <start> and <stop>. """
+        key_ends = self._key_ends
+        slices = map(slice, key_ends[start:stop], key_ends[start + 1:stop + 1])
+        return map(_decode, map(self._buf.__getitem__, slices))
+
+    def iter_simkeys(self, start:int, stop:int) -> Iterator[str]:
+        """ Return an iterator over simkey strings between indices <start> and <stop>. """
+        slices = map(slice, self._sk_starts[start:stop], self._sk_ends[start:stop])
+        return map(_decode, map(self._buf.__getitem__, slices))
+
+    def __len__(self) -> int:
+        return len(self._sk_starts)
+
+    def __getitem__(self, idx):
+        """ Return an item tuple by index, or a list of them by slice (like a list would). """
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            return [self[i] for i in range(start, stop, step)]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('item index out of range')
+        sk = _decode(self._buf[self._sk_starts[idx]:self._sk_ends[idx]])
+        return sk, self.key(idx)
+
+    def __iter__(self) -> Iterator[StringItem]:
+        n = len(self)
+        return zip(self.iter_simkeys(0, n), self.iter_keys(0, n))
+
+    def _read_only(self, *args) -> None:
+        raise TypeError('Memory-mapped search data is read-only.')
+
+    __iadd__ = __delitem__ = insert = clear = sort = _read_only
+
+
+class MappedMultiDict(Mapping):
+    """ Read-only mapping of string keys to tuples of string values from a memory-mapped file.
+        Each value is stored as a reference to a key in another item list
+        (e.g. a translation refers to the index of its strokes in the stroke list). """
+
+    def __init__(self, items:MappedStringItemList, val_ends:memoryview, val_refs:memoryview,
+                 val_items:MappedStringItemList) -> None:
+        self._items = items          # Sorted key storage.
+        self._val_ends = val_ends    # Ranges in <val_refs> for each key. Key i has [val_ends[i], val_ends[i+1]).
+        self._val_refs = val_refs    # Indices of value strings in <val_items>.
+        self._val_items = val_items  # Sorted value storage.
+
+    def __getitem__(self, k:str) -> StringTuple:
+        if not isinstance(k, str):
+            raise KeyError(k)
+        idx = self._items.find_key(k)
+        if idx < 0:
+            raise KeyError(k)
+        refs = self._val_refs[self._val_ends[idx]:self._val_ends[idx + 1]]
+        return tuple(map(self._val_items.key, refs))
+
+    def __iter__(self) -> Iterator[str]:
+        return self._items.iter_keys(0, len(self._items))
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+class SearchFileError(ValueError):
+    """ Raised if a file is not in the expected format (or is from an incompatible version). """
+
+
+def _machine_info() -> list:
+    """ Return the properties of this machine that the binary arrays depend on. """
+    return [sys.byteorder, array(_ARRAY_TYPE).itemsize]
+
+
+class _MappedFile:
+    """ Abstract reader for a memory-mapped binary file. The general format is:
+
+        signature   - 16 bytes including a version number. Each file type has its own.
+        header size - Little-endian unsigned 32-bit integer.
+        header      - JSON object with a user tag, machine compatibility info, and the sizes of the arrays.
+        arrays      - Starting at the next aligned position, arrays of native unsigned integers.
+        strings     - UTF-8 strings with absolute file offsets in the arrays. """
+
+    MAGIC = b''  # File signature. The last character is the format version.
+
+    def __init__(self, buf:mmap.mmap, header:dict, data_start:int) -> None:
+        self.tag = header['tag']       # Arbitrary string used to identify the source of the data.
+        self._buf = buf                # Mapped file contents.
+        self._view = memoryview(buf)   # View of the file to cast arrays from.
+        self._pos = data_start         # Position of the next array to read.
+
+    def _next_array(self, length:int) -> memoryview:
+        """ Return a view of the next array in order with <length> items. """
+        end = self._pos + length * array(_ARRAY_TYPE).itemsize
+        if end > len(self._buf):
+            raise SearchFileError('Mapped file is truncated.')
+        a = self._view[self._pos:end].cast(_ARRAY_TYPE)
+        self._pos = end
+        return a
+
+    @classmethod
+    def open(cls, filename:str):
+        """ Map a file into memory read-only and check its header. """
+        with open(filename, 'rb') as fp:
+            buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic = cls.MAGIC
+        offset = len(magic) + _HEADER_SIZE.size
+        if buf[:len(magic)] != magic:
+            raise SearchFileError(filename + ' is not in the expected format.')
+        header_size, = _HEADER_SIZE.unpack(buf[len(magic):offset])
+        try:
+            header = json.loads(buf[offset:offset + header_size])
+        except ValueError as e:
+            raise SearchFileError(filename + ' has a corrupt header.') from e
+        if not isinstance(header, dict):
+            raise SearchFileError(filename + ' has a corrupt header.')
+        if header.get('machine') != _machine_info():
+            raise SearchFileError(filename + ' was written on an incompatible machine.')
+        data_start = _aligned(offset + header_size)
+        try:
+            return cls(buf, header, data_start)
+        except (AttributeError, KeyError, TypeError) as e:
+            # The header is valid JSON, but it is missing fields or has the wrong types.
+            raise SearchFileError(filename + ' has an invalid header.') from e
+
+    @classmethod
+    def _header_bytes(cls, tag:str, **fields) -> bytes:
+        """ Return the complete header for a new file with <fields>, padded to the start of the arrays. """
+        header = {'tag': tag, 'machine': _machine_info(), **fields}
+        header_json = json.dumps(header).encode('utf-8')
+        header_bytes = cls.MAGIC + _HEADER_SIZE.pack(len(header_json)) + header_json
+        return header_bytes + bytes(_aligned(len(header_bytes)) - len(header_bytes))
+
+    @staticmethod
+    def _write(filename:str, header_bytes:bytes, arrays:Iterable[array], strings:Iterable[bytes]) -> None:
+        """ Write a file under a temporary name first, so that a reader will never see a partial file. """
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as fp:
+            fp.write(header_bytes)
+            for a in arrays:
+                a.tofile(fp)
+            fp.writelines(strings)
+        os.replace(tmp_filename, filename)
+
+
+class MappedSearchFile(_MappedFile):
+    """ Reader for named sections of search data. For each section in order, there are arrays for key ends,
+        simkey starts, simkey ends, a key hash table, value ends, and value references. Value references are
+        item indices in another section. Key hash table entries are item indices plus one (zero is empty).
+
+        Simkeys that are equal to their keys share the same bytes. The file is only valid for indices
+        with the same similarity function (and Unicode database) as the one that created it. """
+
+    MAGIC = b'SPECTRA-SEARCH-1'
+
+    def __init__(self, buf:mmap.mmap, header:dict, data_start:int) -> None:
+        super().__init__(buf, header, data_start)
+        self._items = {}   # Item lists by section name.
+        self._values = {}  # Value arrays and referenced section name by section name.
+        for name, (size, n_refs, table_size, ref_name) in header['sections'].items():
+            key_ends, sk_starts, sk_ends, key_table, val_ends, val_refs = map(
+                self._next_array, [size + 1, size, size, table_size, size + 1, n_refs])
+            self._items[name] = MappedStringItemList(self._buf, key_ends, sk_starts, sk_ends, key_table)
+            self._values[name] = (val_ends, val_refs, ref_name)
+
+    def items(self, name:str) -> MappedStringItemList:
+        """ Return the sorted item list for section <name>. """
+        return self._items[name]
+
+    def multidict(self, name:str) -> MappedMultiDict:
+        """ Return a mapping of keys to values for section <name>. """
+        val_ends, val_refs, ref_name = self._values[name]
+        return MappedMultiDict(self._items[name], val_ends, val_refs, self._items[ref_name])
+
+    @classmethod
+    def save(cls, filename:str, tag:str, sections:Dict[str, SearchFileSection]) -> None:
+        """ Save named <sections> of search data to a file. """
+        header_sections = {}
+        for name, (items, values, ref_name) in sections.items():
+            n_refs = sum(map(len, values))
+            header_sections[name] = [len(items), n_refs, _table_size(len(items)), ref_name]
+        header_bytes = cls._header_bytes(tag, sections=header_sections)
+        # The strings go after the arrays, which have sizes that are known in advance.
+        pos = len(header_bytes)
+        for size, n_refs, table_size, _ in header_sections.values():
+            pos += (4 * size + 2 + n_refs + table_size) * array(_ARRAY_TYPE).itemsize
+        arrays = []
+        strings = []
+        for items, values, ref_name in sections.values():
+            item_arrays, pos = _pack_items(items, pos, strings)
+            arrays += item_arrays
+            arrays += _pack_values(values, sections[ref_name][0])
+        cls._write(filename, header_bytes, arrays, strings)
+
+
+def _pack_items(items:StringItemList, pos:int, strings:List[bytes]) -> Tuple[List[array], int]:
+    """ Add the UTF-8 keys and distinct simkeys of <items> to <strings> starting at file offset <pos>.
+        Return arrays with the offsets of each string and a hash table of the keys, along with the ending offset. """
+    key_ends = array(_ARRAY_TYPE, [pos])
+    key_table = array(_ARRAY_TYPE, bytes(_table_size(len(items)) * key_ends.itemsize))
+    mask = len(key_table) - 1
+    for idx, (_, k) in enumerate(items, 1):
+        b = _encode(k)
+        strings.append(b)
+        pos += len(b)
+        key_ends.append(pos)
+        i = crc32(b) & mask
+        while key_table[i]:
+            i = (i + 1) & mask
+        key_table[i] = idx
+    sk_starts = array(_ARRAY_TYPE)
+    sk_ends = array(_ARRAY_TYPE)
+    for i, (sk, k) in enumerate(items):
+        if sk == k:
+            sk_starts.append(key_ends[i])
+            sk_ends.append(key_ends[i + 1])
+        else:
+            b = _encode(sk)
+            strings.append(b)
+            sk_starts.append(pos)
+            pos += len(b)
+            sk_ends.append(pos)
+    return [key_ends, sk_starts, sk_ends, key_table], pos
+
+
+def _pack_values(values:List[StringTuple], ref_items:StringItemList) -> List[array]:
+    """ Return arrays with the ranges of each item's values and their references to keys in <ref_items>. """
+    ref_positions = {k: i for i, (_, k) in enumerate(ref_items)}
+    val_ends = array(_ARRAY_TYPE, [0])
+    val_refs = array(_ARRAY_TYPE)
+    for v in values:
+        val_refs.extend(map(ref_positions.__getitem__, v))
+        val_ends.append(len(val_refs))
+    return [val_ends, val_refs]
+
+
+class _MappedExampleItems(ItemsView):
+    """ Items view that decodes translations in order without making a dict. """
+
+    def __iter__(self) -> Iterator[StringPair]:
+        return self._mapping.iter_items()
+
+
+class MappedExampleDict(Mapping):
+    """ Read-only mapping of example translations for one rule. Nothing is decoded until it is accessed. """
+
+    def __init__(self, examples:"MappedExamplesFile", rule_id:str, tr_ids:memoryview) -> None:
+        self._examples = examples  # File with the translation string table.
+        self._rule_id = rule_id    # Rule ID that owns the posting list.
+        self._tr_ids = tr_ids      # Posting list of translation IDs.
+
+    def item_at(self, i:int) -> StringPair:
+        """ Return the translation at posting list index <i> without decoding any others. """
+        return self._examples.translation(self._tr_ids[i])
+
+    def posting_list(self) -> memoryview:
+        """ Return the IDs of every translation in the rule. MappedExamplesFile.translation() decodes them. """
+        return self._tr_ids
+
+    def __getitem__(self, k:str) -> str:
+        return self._examples.decoded(self._rule_id, self._tr_ids)[k]
+
+    def __iter__(self) -> Iterator[str]:
+        return map(self._examples.tr_keys, self._tr_ids)
+
+    def iter_items(self) -> Iterator[StringPair]:
+        return map(self._examples.translation, self._tr_ids)
+
+    def items(self) -> ItemsView:
+        return _MappedExampleItems(self)
+
+    def __len__(self) -> int:
+        return len(self._tr_ids)
+
+
+class MappedExamplesFile(_MappedFile, Mapping):
+    """ Reader for an examples index as a mapping of rule IDs to example translations.
+        Each translation used by any rule is stored once in a string table and given an integer ID.
+        The arrays are the string table offsets (keys and letters alternate) and the posting lists of translation
+        IDs for each rule in order. The header has a directory with the range of each rule's posting list,
+        so rule IDs and example counts are known without loading anything else from the file. """
+
+    MAGIC = b'SPECTRA-EXAMPLE1'
+    DECODED_CACHE_SIZE = 100000  # Maximum total number of translations kept in decoded dicts.
+
+    def __init__(self, buf:mmap.mmap, header:dict, data_start:int) -> None:
+        super().__init__(buf, header, data_start)
+        self._rules = header['rules']  # Directory of rule IDs with the start and end index of each posting list.
+        self._str_ends = self._next_array(2 * header['translations'] + 1)
+        self._postings = self._next_array(header['postings'])
+        # Decoded translation dicts for the rules with the most recent key lookups.
+        self._decoded = SizedLRUCache(self.DECODED_CACHE_SIZE)
+
+    def tr_keys(self, tr_id:int) -> str:
+        """ Return the keys of the translation with <tr_id>. """
+        str_ends = self._str_ends
+        i = 2 * tr_id
+        return _decode(self._buf[str_ends[i]:str_ends[i + 1]])
+
+    def translation(self, tr_id:int) -> StringPair:
+        """ Return the (keys, letters) pair for the translation with <tr_id>. """
+        str_ends = self._str_ends
+        i = 2 * tr_id
+        buf = self._buf
+        return _decode(buf[str_ends[i]:str_ends[i + 1]]), _decode(buf[str_ends[i + 1]:str_ends[i + 2]])
+
+    def decoded(self, rule_id:str, tr_ids:memoryview) -> Dict[str, str]:
+        """ Return a dict of the translations in the posting list <tr_ids> for <rule_id>.
+            Key lookups need the whole list decoded, so the dict is cached for later lookups in the same rule. """
+        return self._decoded.get(rule_id, lambda: dict(map(self.translation, tr_ids)))
+
+    def __getitem__(self, rule_id:str) -> MappedExampleDict:
+        start, end = self._rules[rule_id]
+        return MappedExampleDict(self, rule_id, self._postings[start:end])
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._rules)
+
+    def __len__(self) -> int:
+        return len(self._rules)
+
+    def __contains__(self, rule_id:object) -> bool:
+        return rule_id in self._rules
+
+    @classmethod
+    def save(cls, filename:str, tag:str, examples:ExamplesMapping) -> None:
+        """ Save an examples index to a file. """
+        tr_ids = {}
+        rules = {}
+        postings = array(_ARRAY_TYPE)
+        for rule_id, translations in examples.items():
+            start = len(postings)
+            for item in translations.items():
+                tr_id = tr_ids.get(item)
+                if tr_id is None:
+                    tr_id = tr_ids[item] = len(tr_ids)
+                postings.append(tr_id)
+            rules[rule_id] = [start, len(postings)]
+        header_bytes = cls._header_bytes(tag, rules=rules, translations=len(tr_ids), postings=len(postings))
+        pos = len(header_bytes) + (2 * len(tr_ids) + 1 + len(postings)) * postings.itemsize
+        str_ends = array(_ARRAY_TYPE, [pos])
+        strings = []
+        for pair in tr_ids:
+            for s in pair:
+                b = _encode(s)
+                strings.append(b)
+                pos += len(b)
+                str_ends.append(pos)
+        cls._write(filename, header_bytes, [str_ends, postings], strings)
@@ -1,8 +1,8 @@
 """ Contains functions for creating multi-valued dictionaries from normal ones.
-    Values are stored in tuples to protect against accidental in-place mutation. """
+    Values are stored in tuples to protect against accidental in-place mutation.
+    Since the tuples are immutable, equal ones may be shared between multidicts. """
 
-from collections import defaultdict
-from typing import Dict, Mapping, Tuple, TypeVar
+from typing import Dict, Mapping, Optional, Tuple, TypeVar
 
 K = TypeVar("K")
 V = TypeVar("V")
@@ -11,16 +11,44 @@ MultiDict_KV = Dict[K, Tuple[V, ...]]  # Multidict of keys mapped to tuples of m
 MultiDict_VK = Dict[V, Tuple[K, ...]]  # Multidict of values mapped to tuples of matching keys.
 
 
-def forward_multidict(mapping:Mapping_KV) -> MultiDict_KV:
+def _share_tuples(d:dict, base:Optional[Mapping]) -> None:
+    """ Replace any value tuple in <d> with the one under the same key in <base> if they are equal.
+        A multidict made from a subset of another's data can save most of its memory this way. """
+    if base:
+        for k, t in d.items():
+            t_base = base.get(k)
+            if t_base == t:
+                d[k] = t_base
+
+
+def forward_multidict(mapping:Mapping_KV, base:MultiDict_KV=None) -> MultiDict_KV:
     """ Convert a mapping to a tuple-based multidict. 'forward' means the mapping direction is unchanged.
-        This means each key will only have one value. zip() with one argument packs each value into a 1-tuple. """
-    return dict(zip(mapping, zip(mapping.values())))
+        This means each key will only have one value. zip() with one argument packs each value into a 1-tuple.
+        Tuples from an optional <base> multidict are shared. """
+    d = dict(zip(mapping, zip(mapping.values())))
+    _share_tuples(d, base)
+    return d
 
 
-def reverse_multidict(mapping:Mapping_KV) -> MultiDict_VK:
+def reverse_multidict(mapping:Mapping_KV, base:MultiDict_VK=None) -> MultiDict_VK:
     """ Convert a mapping to a tuple-based multidict where the mapping direction is reversed.
-        Multiple keys may map to the same value, so a multidict is necessary to do this right. """
-    rd = defaultdict(tuple)
+        Multiple keys may map to the same value, so a multidict is necessary to do this right.
+        Adding to a tuple copies all of it, which takes quadratic time for common values with many keys.
+        Most values have only one key, so those go straight into a 1-tuple. Values with more keys
+        get a list instead, and these are frozen into tuples at the end.
+        Tuples from an optional <base> multidict are shared. """
+    rd = {}
+    multiples = []
     for k, v in mapping.items():
-        rd[v] += (k,)
+        keys = rd.get(v)
+        if keys is None:
+            rd[v] = (k,)
+        elif type(keys) is tuple:
+            rd[v] = [*keys, k]
+            multiples.append(v)
+        else:
+            keys.append(k)
+    for v in multiples:
+        rd[v] = tuple(rd[v])
+    _share_tuples(rd, base)
     return rd
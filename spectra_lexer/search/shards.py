@@ -0,0 +1,114 @@
+""" Module for running regex searches over very large sorted key lists in parallel. """
+
+from itertools import compress, islice
+import re
+from threading import Lock
+from time import perf_counter
+from typing import List, Sequence, Tuple
+import weakref
+
+StringList = List[str]
+
+
+def _shard_worker(conn, keys:StringList) -> None:
+    """ Keep one shard of <keys> resident in this process and search it on request until the pipe is closed.
+        Each job is a regex pattern with a range of shard indices and a maximum count of matches to send back. """
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, OSError):
+            return
+        if job is None:
+            return
+        job_id, pattern, start, stop, count = job
+        # The pattern was already checked by the parent process. These loops all run in C.
+        match = re.compile(pattern).match
+        shard_keys = keys[start:stop]
+        matches = list(islice(compress(shard_keys, map(match, shard_keys)), count))
+        try:
+            conn.send((job_id, matches))
+        except OSError:
+            return
+
+
+def _shutdown(conns:list, procs:list) -> None:
+    """ Tell every worker to exit and close its pipe, then make sure they are gone.
+        Closing the pipe isn't enough by itself; forked workers may hold copies of each other's pipe ends. """
+    for conn in conns:
+        try:
+            conn.send(None)
+        except OSError:
+            pass
+        conn.close()
+    for proc in procs:
+        proc.join(1.0)
+        if proc.is_alive():
+            proc.terminate()
+
+
+class ShardedRegexSearcher:
+    """ Runs regex searches over a sorted key list split into contiguous shards, with each shard kept resident
+        in its own worker process. The keys are only sent once when the workers start.
+
+        A search sends a job to every shard that overlaps the range of list indices to scan, then collects
+        the results in shard order. Since the shards are contiguous, concatenating them keeps the sort order.
+        Collection stops as soon as there are enough matches; the results of later shards are discarded.
+        Only one search runs at a time; other threads wait for it since the workers are busy anyway. """
+
+    def __init__(self, keys:Sequence[str], shard_count:int) -> None:
+        # multiprocessing is fairly large, so don't import it until we have to.
+        from multiprocessing import Pipe, Process
+        n = len(keys)
+        shard_size = max(-(-n // shard_count), 1)
+        self._bounds = [(lo, min(lo + shard_size, n)) for lo in range(0, n, shard_size)]  # Range of each shard.
+        self._conns = []     # Pipe connections to each worker in shard order.
+        self._lock = Lock()  # Lock to keep one search's jobs and results together.
+        self._job_id = 0     # ID of the current job. Results from older jobs are stale and must be discarded.
+        procs = []
+        for lo, hi in self._bounds:
+            parent_conn, child_conn = Pipe()
+            proc = Process(target=_shard_worker, args=(child_conn, list(keys[lo:hi])), daemon=True)
+            proc.start()
+            child_conn.close()
+            self._conns.append(parent_conn)
+            procs.append(proc)
+        self._finalizer = weakref.finalize(self, _shutdown, self._conns, procs)
+
+    def _recv(self, conn, deadline:float=None):
+        """ Receive the results of the current job from <conn>, discarding any from older jobs.
+            Return None if they aren't ready by <deadline>. """
+        while True:
+            if deadline is not None and not conn.poll(max(deadline - perf_counter(), 0.0)):
+                return None
+            job_id, matches = conn.recv()
+            if job_id == self._job_id:
+                return matches
+
+    def search(self, pattern:str, start:int, stop:int, count:int=None,
+               deadline:float=None) -> Tuple[StringList, int]:
+        """ Return a list of at most <count> keys that match the regex <pattern> between list indices <start> and
+            <stop>, along with the list index where scanning stopped. This is <stop> unless <count> was reached or
+            the time passed <deadline>. In that case, every match before that index is still included. """
+        with self._lock:
+            self._job_id += 1
+            jobs = []
+            for conn, (lo, hi) in zip(self._conns, self._bounds):
+                if lo < stop and hi > start:
+                    conn.send((self._job_id, pattern, max(start, lo) - lo, min(stop, hi) - lo, count))
+                    jobs.append((conn, hi))
+            matches = []
+            idx_scanned = start
+            for conn, hi in jobs:
+                shard_matches = self._recv(conn, deadline)
+                if shard_matches is None:
+                    break
+                matches += shard_matches
+                if count is not None and len(matches) >= count:
+                    del matches[count:]
+                    break
+                idx_scanned = min(hi, stop)
+            return matches, idx_scanned
+
+    def close(self) -> None:
+        """ Shut down every worker process. """
+        self._finalizer()
@@ -0,0 +1,202 @@
+""" Module for searching steno keys by the structure of their strokes rather than their text. """
+
+from typing import Callable, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+StrokeMasks = Sequence[int]                  # Bitmasks for each stroke in a key string. Each bit is one steno key.
+MaskFunction = Callable[[str], StrokeMasks]  # Splits a key string into strokes and converts each one into a bitmask.
+                                             # Raises ValueError if the string has characters that aren't keys.
+ChordFilter = Tuple[Optional[int], int]      # Stroke position (or None for any stroke) paired with a chord bitmask.
+
+
+class StrokeQueryError(Exception):
+    """ Raised if a stroke structure query has invalid syntax. """
+
+
+class StrokeQuery:
+    """ Parsed stroke structure query. A key matches if it passes every filter. """
+
+    def __init__(self, chords:Sequence[ChordFilter]=(), min_strokes=1, max_strokes:int=None) -> None:
+        self.chords = chords            # Each chord's keys must all be in one stroke at a position (or any position).
+        self.min_strokes = min_strokes  # Minimum number of strokes.
+        self.max_strokes = max_strokes  # Maximum number of strokes (None for no limit).
+
+    def required_bits(self) -> int:
+        """ Return a bitmask of every steno key that must appear somewhere in a match. """
+        bits = 0
+        for _, mask in self.chords:
+            bits |= mask
+        return bits
+
+    def matches(self, masks:StrokeMasks) -> bool:
+        """ Return True if a key with these stroke <masks> passes every filter. """
+        n = len(masks)
+        if n < self.min_strokes or (self.max_strokes is not None and n > self.max_strokes):
+            return False
+        for pos, chord in self.chords:
+            if pos is None:
+                for m in masks:
+                    if m & chord == chord:
+                        break
+                else:
+                    return False
+            elif not -n <= pos < n or masks[pos] & chord != chord:
+                return False
+        return True
+
+
+def parse_stroke_query(pattern:str, maskfn:MaskFunction) -> StrokeQuery:
+    """ Parse a stroke structure query from whitespace-separated terms. Every term must match.
+        CHORD    - Some stroke contains every key in CHORD, e.g. "TK -LG" finds TK in one stroke and -LG in one stroke.
+        N:CHORD  - Stroke N contains every key in CHORD. The first stroke is 1; negative N counts from the end.
+        =N <N >N - The number of strokes is equal to, less than, or greater than N. """
+    chords = []
+    min_strokes = 1
+    max_strokes = None
+    for term in pattern.split():
+        op = term[0]
+        if op in "=<>":
+            try:
+                n = int(term[1:])
+            except ValueError:
+                raise StrokeQueryError(f"Invalid stroke count: {term}")
+            if op != ">":
+                max_strokes = min(max_strokes, n) if max_strokes is not None else n
+                if op == "<":
+                    max_strokes -= 1
+            if op != "<":
+                min_strokes = max(min_strokes, n + (op == ">"))
+            continue
+        pos = None
+        if ":" in term:
+            pos_str, term = term.split(":", 1)
+            try:
+                pos = int(pos_str)
+            except ValueError:
+                raise StrokeQueryError(f"Invalid stroke position: {pos_str}")
+            if not pos:
+                raise StrokeQueryError("Stroke positions start at 1.")
+            if pos > 0:
+                pos -= 1
+        try:
+            masks = maskfn(term)
+        except ValueError:
+            raise StrokeQueryError(f"Invalid steno keys: {term}")
+        if len(masks) != 1:
+            raise StrokeQueryError(f"Chords must have exactly one stroke: {term}")
+        if not masks[0]:
+            raise StrokeQueryError(f"Chords must have at least one key: {term}")
+        chords.append((pos, masks[0]))
+    return StrokeQuery(chords, min_strokes, max_strokes)
+
+
+def _iter_set_bits(bitset:int, start=0) -> Iterator[int]:
+    """ Yield the position of every set bit in <bitset> from <start> up. The scanning is done by str.find in C. """
+    digits = format(bitset, "b")[::-1]
+    find = digits.find
+    i = find("1", start)
+    while i >= 0:
+        yield i
+        i = find("1", i + 1)
+
+
+class StrokeMaskIndex:
+    """ Index of key strings by the bitmasks of their strokes, for queries such as
+        "entries whose second stroke contains -FRPB" or "entries with TK and -LG in any stroke".
+
+        Each key is stored as a tuple with one bitmask per stroke. A query checks those masks directly, but only for
+        candidate keys with every required steno key in *some* stroke. For each steno key, the set of positions of
+        entries that use it is kept as a bitset in one large int. Intersecting those is done in C, and is usually
+        enough to skip the vast majority of entries without touching them in Python.
+
+        Keys with characters that aren't steno keys are given no strokes at all, so they never match a query. """
+
+    def __init__(self, keys:Iterable[str], maskfn:MaskFunction) -> None:
+        self._keys = list(keys)                                          # Indexed keys in their original order.
+        self._masks = [self._key_masks(maskfn, k) for k in self._keys]  # Stroke bitmasks for each key in order.
+        self._key_sets = self._build_key_sets(self._masks)               # Bitsets of entry positions for each key bit.
+
+    @staticmethod
+    def _key_masks(maskfn:MaskFunction, k:str) -> StrokeMasks:
+        try:
+            return tuple(maskfn(k))
+        except ValueError:
+            return ()
+
+    @staticmethod
+    def _build_key_sets(all_masks:List[StrokeMasks]) -> List[int]:
+        """ Set the bits for each entry in one bytearray per steno key, then convert them to ints all at once.
+            ORing bits into ints one at a time would copy the whole int every time (quadratic time). """
+        arrays = []
+        size = (len(all_masks) + 7) // 8
+        for i, masks in enumerate(all_masks):
+            union = 0
+            for m in masks:
+                union |= m
+            byte_idx = i >> 3
+            byte_bit = 1 << (i & 7)
+            while union:
+                low_bit = union & -union
+                b = low_bit.bit_length() - 1
+                while b >= len(arrays):
+                    arrays.append(bytearray(size))
+                arrays[b][byte_idx] |= byte_bit
+                union ^= low_bit
+        return [int.from_bytes(a, "little") for a in arrays]
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def key(self, idx:int) -> str:
+        """ Return the key at position <idx>. """
+        return self._keys[idx]
+
+    def _candidate_bitset(self, query:StrokeQuery) -> Optional[int]:
+        """ Return a bitset of the positions which have every steno key required by <query>.
+            Return None if there are no required keys (so every position is a candidate). """
+        bits = query.required_bits()
+        if not bits:
+            return None
+        key_sets = self._key_sets
+        bitset = -1
+        while bits:
+            low_bit = bits & -bits
+            b = low_bit.bit_length() - 1
+            if b >= len(key_sets):
+                return 0
+            bitset &= key_sets[b]
+            bits ^= low_bit
+        return bitset
+
+    def _candidates(self, query:StrokeQuery, start:int) -> Iterable[int]:
+        """ Return an iterable of candidate positions for <query> from <start> onward. """
+        bitset = self._candidate_bitset(query)
+        if bitset is None:
+            return range(start, len(self._keys))
+        return _iter_set_bits(bitset, start)
+
+    def count_bound(self, query:StrokeQuery, stop:int=None) -> int:
+        """ Return an upper bound on the number of keys before position <stop> that match <query>.
+            This only counts candidates with the required keys, which takes a few big int operations in C. """
+        n = len(self._keys)
+        if stop is None or stop > n:
+            stop = n
+        bitset = self._candidate_bitset(query)
+        if bitset is None:
+            return stop
+        return bin(bitset & ((1 << stop) - 1)).count("1")
+
+    def search(self, query:StrokeQuery, count:int=None, start=0) -> List[int]:
+        """ Return the positions of at most <count> keys from position <start> onward that match <query>. """
+        if count is None:
+            count = len(self._keys)
+        found = []
+        if count <= 0:
+            return found
+        all_masks = self._masks
+        matches = query.matches
+        for i in self._candidates(query, start):
+            if matches(all_masks[i]):
+                found.append(i)
+                if len(found) >= count:
+                    break
+        return found
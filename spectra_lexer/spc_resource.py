@@ -1,3 +1,5 @@
+import json
+import os
 from typing import List
 
 from spectra_lexer.resource.board import StenoBoardDefinitions
@@ -5,7 +7,8 @@ from spectra_lexer.resource.json import JSONDictionaryIO
 from spectra_lexer.resource.keys import StenoKeyLayout
 from spectra_lexer.resource.rules import StenoRuleFactory, StenoRule
 from spectra_lexer.resource.sub import TextSubstitutionParser
-from spectra_lexer.resource.translations import ExamplesDict, TranslationsDict
+from spectra_lexer.resource.translations import ExamplesDict, intern_examples, intern_translations, TranslationsDict
+from spectra_lexer.search.mapped import MappedExamplesFile
 
 
 class StenoRuleParser:
@@ -58,9 +61,10 @@ class StenoResourceIO:
     """ Top-level IO for steno resources. All structures are parsed from JSON in some form.
         Built-in assets include a key layout, rules, and board graphics. """
 
-    def __init__(self, rule_factory:StenoRuleFactory) -> None:
-        self._rule_factory = rule_factory  # Steno rule object factory.
-        self._io = JSONDictionaryIO()      # I/O for JSON/CSON files.
+    def __init__(self, rule_factory:StenoRuleFactory, *, intern_strings=True) -> None:
+        self._rule_factory = rule_factory      # Steno rule object factory.
+        self._io = JSONDictionaryIO()          # I/O for JSON/CSON files.
+        self._intern_strings = intern_strings  # If True, intern every string in loaded translations and examples.
 
     def load_keymap(self, filename:str) -> StenoKeyLayout:
         """ Load a steno key layout from CSON. """
@@ -87,8 +91,19 @@ class StenoResourceIO:
         for filename in filenames:
             d = self._io.load_json_dict(filename)
             translations.update(d)
+        if self._intern_strings:
+            translations = intern_translations(translations)
         return translations
 
+    def file_stamp(self, *filenames:str) -> str:
+        """ Return a string that identifies the current version of each file by its path, size, and modification time.
+            If any of the files are changed, the stamp will almost certainly change as well. """
+        stamps = []
+        for filename in filenames:
+            st = os.stat(filename)
+            stamps.append([os.path.abspath(filename), st.st_size, st.st_mtime_ns])
+        return json.dumps(stamps)
+
     def save_json_translations(self, filename:str, translations:TranslationsDict) -> None:
         """ Save RTFCRE steno translations as a dict in JSON. """
         self._io.save_json_dict(filename, translations)
@@ -99,8 +114,23 @@ class StenoResourceIO:
         for v in examples.values():
             if not isinstance(v, dict):
                 raise TypeError(filename + ' does not contain a nested string dictionary.')
+        if self._intern_strings:
+            examples = intern_examples(examples)
         return examples
 
     def save_json_examples(self, filename:str, examples:ExamplesDict) -> None:
         """ Save an examples index as a dict of dicts in JSON. """
         self._io.save_json_dict(filename, examples)
+
+    def load_binary_examples(self, filename:str, tag="") -> MappedExamplesFile:
+        """ Memory-map an examples index from a binary file. It acts like a read-only dict of dicts,
+            but the translations for a rule are only read from the file when they are accessed.
+            Raise ValueError if the file is invalid or it was not saved with the same <tag>. """
+        examples = MappedExamplesFile.open(filename)
+        if examples.tag != tag:
+            raise ValueError(filename + ' is out of date.')
+        return examples
+
+    def save_binary_examples(self, filename:str, examples:ExamplesDict, tag="") -> None:
+        """ Save an examples index to a binary file with an identifying <tag> (such as a file stamp). """
+        MappedExamplesFile.save(filename, tag, examples)
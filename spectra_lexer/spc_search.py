@@ -1,68 +1,274 @@
-from typing import Dict, Tuple
+from array import array
+from bisect import bisect_left
+from collections import ChainMap
+from heapq import nsmallest
+import random
+from threading import Lock
+from typing import Callable, Dict, Iterable, List, NamedTuple, Sequence, Tuple
+import unicodedata
 
-from spectra_lexer.resource.translations import ExamplesDict, RuleID, TranslationsDict
-from spectra_lexer.search.index import RegexError, StringKeyIndex, StripCaseIndex
+from spectra_lexer.resource.translations import ExamplesDict, RuleID, Translation, TranslationsDict
+from spectra_lexer.search.cache import CacheInfo, SizedLRUCache
+from spectra_lexer.search.index import RegexError, RegexTimeout, StringKeyIndex, StripCaseIndex
+from spectra_lexer.search.mapped import MappedSearchFile
 from spectra_lexer.search.multidict import forward_multidict, reverse_multidict
+from spectra_lexer.search.strokes import MaskFunction, parse_stroke_query, StrokeMaskIndex, StrokeQueryError
 
 MatchTuple = Tuple[str, ...]                   # JSON-compatible sequence of search results.
 MatchDict = Dict[str, MatchTuple]              # JSON-compatible dict of search results.
 SearchData = Tuple[MatchDict, StringKeyIndex]  # Key search index paired with a standard dictionary for value lookup.
+Postings = Sequence[int]                       # Sorted example translation IDs for one rule.
+
+
+class SearchPage(NamedTuple):
+    """ One page of search results with a cursor to resume the search from. """
+
+    matches: MatchDict       # Search results. Unmatched keys are sentinels.
+    cursor: int              # Index position after the last result.
+    timed_out: bool = False  # If True, the search ran out of time. It may be expanded to resume from <cursor>.
+
+
+class MatchCount(NamedTuple):
+    """ Lower and upper bounds on the number of matches for a search. The count is exact if they are equal. """
+
+    low: int
+    high: int
+
 
 # Reserved sentinel keys in every search dict. These (and only these) map to an empty tuple of values.
 EXPAND_KEY = '[more...]'           # If present, repeating the search with a higher count will return more items.
 BAD_REGEX_KEY = '[INVALID REGEX]'  # If present, the search input could not be compiled as a regular expression.
-_SENTINEL_MAP = {k: () for k in (EXPAND_KEY, BAD_REGEX_KEY)}
+BAD_QUERY_KEY = '[INVALID QUERY]'  # If present, the search input could not be parsed as a stroke structure query.
+_SENTINEL_MAP = {k: () for k in (EXPAND_KEY, BAD_REGEX_KEY, BAD_QUERY_KEY)}
 _EMPTY_DATA = (_SENTINEL_MAP, StringKeyIndex())
 
+
+def _data_size(data:SearchData) -> int:
+    """ Return the size of search data in number of entries. Empty data still takes some memory. """
+    return len(data[1]) + 1
+
+
+def _number_examples(examples:ExamplesDict) -> Tuple[List[Translation], Dict[RuleID, Postings]]:
+    """ Give each distinct translation in <examples> an integer ID.
+        Return a list of the translations by ID and a sorted array of IDs for each rule. """
+    ids = {}
+    postings = {}
+    for rule_id, translations in examples.items():
+        rule_postings = [ids.setdefault(item, len(ids)) for item in translations.items()]
+        rule_postings.sort()
+        postings[rule_id] = array('I', rule_postings)
+    return list(ids), postings
+
+
+def _intersect_postings(small:Postings, large:Postings) -> List[int]:
+    """ Return the IDs in both sorted sequences, where <small> is the shorter one. Each lookup in <large> is a binary
+        search starting from where the last one ended, so this takes O(len(small) * log(len(large))) time. """
+    matches = []
+    n = len(large)
+    lo = 0
+    for tr_id in small:
+        lo = bisect_left(large, tr_id, lo)
+        if lo == n:
+            break
+        if large[lo] == tr_id:
+            matches.append(tr_id)
+    return matches
+
+
 INDEX_DELIM = ';;'  # Delimiter between rule ID and query for example searches. Mostly arbitrary.
 
 
 class SearchEngine:
     """ A hybrid forward+reverse steno translation search engine with support for rule example lookup. """
 
-    def __init__(self, strip_strokes:str, strip_text:str) -> None:
-        self._strip_strokes = strip_strokes  # Characters to ignore during stroke search.
-        self._strip_text = strip_text        # Characters to ignore during text search.
-        self._tr_strokes = _EMPTY_DATA       # Forward translation search data (strokes -> text).
-        self._tr_text = _EMPTY_DATA          # Reverse translation search data (text -> strokes).
+    def __init__(self, strip_strokes:str, strip_text:str, *, compact=False, examples_cache_size=200000,
+                 stroke_maskfn:MaskFunction=None, regex_timeout:float=None, regex_shards=0,
+                 intern_strings=True) -> None:
+        self._strip_strokes = strip_strokes    # Characters to ignore during stroke search.
+        self._strip_text = strip_text          # Characters to ignore during text search.
+        self._stroke_maskfn = stroke_maskfn    # Converts strokes to key bitmasks for chord search (or None).
+        self._regex_timeout = regex_timeout    # Time limit for a regex search in seconds (None for no limit).
+        self._regex_shards = regex_shards      # Number of processes for parallel regex search of translations.
+        self._intern_strings = intern_strings  # If True, simkeys share objects with equal interned strings.
+        self._compact = compact                # If True, translation indices use compact (but slower) storage.
+        self._translations = {}                # Source for translation search data (None if loaded from a file).
+        self._tr_strokes = _EMPTY_DATA         # Forward translation search data (strokes -> text).
+        self._tr_text = _EMPTY_DATA            # Reverse translation search data (text -> strokes).
+        self._tr_chords = None                 # Stroke structure index in forward data order (built on demand).
+        self._tr_lock = Lock()                 # Lock for compiling translation search data on demand.
+        # Cache of example search data for each rule ID and mode. The size limit is a total number of entries.
+        self._examples_cache = SizedLRUCache(examples_cache_size, _data_size)
+        # Cache of sorted translation IDs for each rule ID in co-occurrence queries on memory-mapped examples.
+        self._postings_cache = SizedLRUCache(examples_cache_size)
+        self._tr_list = []        # Example translations by integer ID (if the examples don't have IDs of their own).
+        self._rule_postings = {}  # Sorted arrays of the IDs above for each rule ID.
+        # Cache of example key sequences for each rule ID to pick random translations in O(1) time.
+        self._sample_cache = SizedLRUCache(examples_cache_size)
         self._examples_raw = {}              # Contains steno rule IDs mapped to dicts of example translations.
-        self._examples_cache = {}            # Cache of example search data for each rule ID and mode.
 
-    def _compile_data(self, translations:TranslationsDict, mode_strokes:bool) -> SearchData:
-        """ Compile string search data for <translations> in the correct direction for <mode_strokes>. """
+    def _compile_data(self, translations:TranslationsDict, mode_strokes:bool, *,
+                      compact=False, shard_count=0, base:MatchDict=None) -> SearchData:
+        """ Compile string search data for <translations> in the correct direction for <mode_strokes>.
+            Result tuples equal to those in a <base> dict in the same direction are shared with it. """
         if mode_strokes:
-            d = forward_multidict(translations)
+            d = forward_multidict(translations, base)
             strip_chars = self._strip_strokes
         else:
-            d = reverse_multidict(translations)
+            d = reverse_multidict(translations, base)
             strip_chars = self._strip_text
-        index = StripCaseIndex(strip_chars)
+        # Compact indices copy every string into one buffer, so there is nothing to share with them.
+        intern_simkeys = self._intern_strings and not compact
+        index = StripCaseIndex(strip_chars, compact=compact, shard_count=shard_count, intern_simkeys=intern_simkeys)
         index.update(d)
         d.update(_SENTINEL_MAP)
         return (d, index)
 
     def set_translations(self, translations:TranslationsDict) -> None:
-        """ Create new translation search data from the <translations> mapping. """
-        self._tr_strokes = self._compile_data(translations, mode_strokes=True)
-        self._tr_text = self._compile_data(translations, mode_strokes=False)
+        """ Replace the <translations> mapping. Search data for each direction is only compiled when it is first used.
+            Many sessions never search in stroke mode, and some never search at all (only lookup in one mode). """
+        with self._tr_lock:
+            self._translations = translations
+            self._tr_strokes = self._tr_text = self._tr_chords = None
+
+    def get_translations(self) -> TranslationsDict:
+        """ Return the current translations. If they were loaded from a file, make a new dict in search index order. """
+        if self._translations is not None:
+            return self._translations
+        d, index = self._get_translation_data(mode_strokes=True)
+        return {k: d[k][0] for k in index}
+
+    def _file_tag(self, tag:str) -> str:
+        """ Combine a user <tag> with everything else that the search data in a file depends on. """
+        return repr((tag, self._strip_strokes, self._strip_text, unicodedata.unidata_version))
+
+    def save_index(self, filename:str, tag="") -> None:
+        """ Save the translation search data to a binary file for load_index().
+            <tag> should identify the source of the translations (such as file names and modification times). """
+        sections = {}
+        for name, ref_name, mode_strokes in [('strokes', 'text', True), ('text', 'strokes', False)]:
+            d, index = self._get_translation_data(mode_strokes)
+            items = list(index.iter_items())
+            values = [d[k] for _, k in items]
+            sections[name] = (items, values, ref_name)
+        MappedSearchFile.save(filename, self._file_tag(tag), sections)
+
+    def _mapped_data(self, sf:MappedSearchFile, name:str, strip_chars:str) -> SearchData:
+        """ Load search data from a mapped file section. Lookups are done in place without a copy in memory. """
+        index = StripCaseIndex(strip_chars, sf.items(name), shard_count=self._regex_shards)
+        d = ChainMap(_SENTINEL_MAP, sf.multidict(name))
+        return (d, index)
+
+    def load_index(self, filename:str, tag="") -> bool:
+        """ Use translation search data from a binary file saved with the same <tag> by save_index().
+            The file is memory-mapped and searched in place, so this takes very little time or memory.
+            Return True if successful, or False if the file is missing, invalid, or has a different tag. """
+        try:
+            sf = MappedSearchFile.open(filename)
+        except (OSError, ValueError):
+            return False
+        if sf.tag != self._file_tag(tag):
+            return False
+        with self._tr_lock:
+            self._translations = None
+            self._tr_strokes = self._mapped_data(sf, 'strokes', self._strip_strokes)
+            self._tr_text = self._mapped_data(sf, 'text', self._strip_text)
+            self._tr_chords = None
+        return True
 
     def _get_translation_data(self, mode_strokes:bool) -> SearchData:
-        """ Return the translation search data for <mode_strokes>. """
-        return self._tr_strokes if mode_strokes else self._tr_text
+        """ Return the translation search data for <mode_strokes>. Compile it first if it doesn't exist yet.
+            Other threads that need the same data will wait for it instead of compiling it again. """
+        data = self._tr_strokes if mode_strokes else self._tr_text
+        if data is None:
+            with self._tr_lock:
+                data = self._tr_strokes if mode_strokes else self._tr_text
+                if data is None:
+                    data = self._compile_data(self._translations, mode_strokes,
+                                              compact=self._compact, shard_count=self._regex_shards)
+                    if mode_strokes:
+                        self._tr_strokes = data
+                    else:
+                        self._tr_text = data
+        return data
+
+    def _get_chord_index(self) -> StrokeMaskIndex:
+        """ Return the stroke structure index for the translations. Build it first if it doesn't exist yet.
+            It needs the forward search data, and its entries are in the same order. """
+        if self._stroke_maskfn is None:
+            raise StrokeQueryError("Stroke structure search is not supported without a steno key layout.")
+        _, index = self._get_translation_data(mode_strokes=True)
+        chord_index = self._tr_chords
+        if chord_index is None:
+            with self._tr_lock:
+                chord_index = self._tr_chords
+                if chord_index is None:
+                    chord_index = self._tr_chords = StrokeMaskIndex(index, self._stroke_maskfn)
+        return chord_index
+
+    def prewarm_search(self) -> None:
+        """ Compile translation search data in both directions now, along with the stroke structure index if supported.
+            Worker processes forked afterward will share this data instead of each compiling its own. """
+        for mode_strokes in (False, True):
+            self._get_translation_data(mode_strokes)
+        if self._stroke_maskfn is not None:
+            self._get_chord_index()
+
+    def set_regex_timeout(self, seconds:float=None) -> None:
+        """ Limit each regex search to <seconds>, or remove the limit if None.
+            A search over the limit returns what it found so far with a timeout flag, and it may be resumed. """
+        self._regex_timeout = seconds
+
+    def set_regex_shards(self, count:int) -> None:
+        """ Run large regex searches over translations in parallel using <count> worker processes (0 to disable).
+            This only applies to search data compiled or loaded after the call. """
+        self._regex_shards = count
 
     def set_examples(self, examples:ExamplesDict) -> None:
-        """ Set a new examples reference dict and clear any cached data from the last one. """
+        """ Set a new examples reference dict and clear any cached data from the last one.
+            Memory-mapped examples have translation IDs already. Others are numbered here, once. """
         self._examples_raw = examples
         self._examples_cache.clear()
+        self._postings_cache.clear()
+        self._sample_cache.clear()
+        if hasattr(examples, "translation"):
+            self._tr_list, self._rule_postings = [], {}
+        else:
+            self._tr_list, self._rule_postings = _number_examples(examples)
+
+    def _compile_example_data(self, rule_id:RuleID, mode_strokes:bool) -> SearchData:
+        """ Compile new example search data for <rule_id> in <mode_strokes>. """
+        translations = self._examples_raw.get(rule_id) or {}
+        # Examples are mostly copies of translations. Share their results if that direction has been compiled.
+        tr_data = self._tr_strokes if mode_strokes else self._tr_text
+        base = tr_data[0] if tr_data is not None else None
+        return self._compile_data(translations, mode_strokes, base=base)
 
     def _get_example_data(self, rule_id:RuleID, mode_strokes:bool) -> SearchData:
         """ Return the example search data for <rule_id> in <mode_strokes>.
             Create and cache a new data set if it doesn't exist yet. """
         key = (rule_id, mode_strokes)
-        if key not in self._examples_cache:
-            translations = self._examples_raw.get(rule_id) or {}
-            self._examples_cache[key] = self._compile_data(translations, mode_strokes)
-        return self._examples_cache[key]
+        return self._examples_cache.get(key, lambda: self._compile_example_data(rule_id, mode_strokes))
+
+    def prewarm_examples(self, count:int) -> None:
+        """ Compile and cache example search data in both modes for the <count> rules with the most examples.
+            These are the slowest to compile and usually the most often browsed. Stop if the cache would overflow. """
+        examples = self._examples_raw
+        rule_ids = sorted(examples, key=lambda r_id: len(examples[r_id]), reverse=True)[:count]
+        cache = self._examples_cache
+        for rule_id in rule_ids:
+            for mode_strokes in (False, True):
+                key = (rule_id, mode_strokes)
+                if key in cache:
+                    continue
+                data = self._compile_example_data(rule_id, mode_strokes)
+                info = cache.info()
+                if info.size + _data_size(data) > info.max_size:
+                    return
+                cache.add(key, data)
+
+    def examples_cache_info(self) -> CacheInfo:
+        """ Return hit/miss statistics and the current size of the example search data cache. """
+        return self._examples_cache.info()
 
     def lookup(self, pattern:str, *, mode_strokes=False) -> MatchTuple:
         """ Perform an exact lookup for <pattern>, then a similar key lookup if nothing was found.
@@ -75,30 +281,159 @@ class SearchEngine:
             matches += d[k]
         return tuple(matches)
 
-    def search(self, pattern:str, count=None, *, mode_strokes=False, mode_regex=False) -> MatchDict:
+    def search(self, pattern:str, count=None, *,
+               mode_strokes=False, mode_regex=False, mode_chords=False) -> MatchDict:
         """ Perform a detailed search for <pattern>. Unmatched keys in a result are sentinels with special behavior.
             If there is an index delimiter, search for rule examples instead. Only exact matches will work there.
             <count>        - Maximum number of matches returned. If None, there is no limit.
             <mode_strokes> - If True, search for strokes instead of translations.
-            <mode_regex>   - If True, do a regular expression search instead of a prefix search. """
+            <mode_regex>   - If True, do a regular expression search instead of a prefix search.
+            <mode_chords>  - If True, search for strokes by key structure instead (see parse_stroke_query). """
+        page = self.search_page(pattern, count, mode_strokes=mode_strokes, mode_regex=mode_regex,
+                                mode_chords=mode_chords)
+        return page.matches
+
+    def _search_chords(self, pattern:str, count:int=None, cursor=0) -> SearchPage:
+        """ Search for strokes by key structure starting from <cursor>. The results map strokes to translations. """
+        d, _ = self._get_translation_data(mode_strokes=True)
+        try:
+            chord_index = self._get_chord_index()
+            query = parse_stroke_query(pattern, self._stroke_maskfn)
+        except StrokeQueryError:
+            return SearchPage({BAD_QUERY_KEY: ()}, cursor)
+        if count is None:
+            count = len(chord_index)
+        found = chord_index.search(query, count + 1, cursor)
+        keys = [*map(chord_index.key, found)]
+        if len(keys) > count:
+            cursor = found[-1]
+            keys[-1] = EXPAND_KEY
+        else:
+            cursor = len(chord_index)
+        return SearchPage({k: d[k] for k in keys}, cursor)
+
+    def search_page(self, pattern:str, count=None, cursor=0, *,
+                    mode_strokes=False, mode_regex=False, mode_chords=False) -> SearchPage:
+        """ Perform a search as above starting from the index position <cursor>.
+            Return the matches with a new cursor positioned after the last result.
+            If the results can be expanded, a search from that cursor will return only the following page.
+            A regex search that times out can be expanded the same way. It is flagged so the user can be told.
+            Example searches are centered on a translation and do not support cursors. """
         if not pattern.strip():
-            return {}
+            return SearchPage({}, cursor)
+        timed_out = False
         if INDEX_DELIM in pattern:
             rule_id, tr_pattern = pattern.split(INDEX_DELIM, 1)
             d, index = self._get_example_data(rule_id, mode_strokes)
             keys = index.get_nearby_keys(tr_pattern, count or len(index))
+            cursor = 0
+        elif mode_chords:
+            return self._search_chords(pattern, count, cursor)
         else:
             d, index = self._get_translation_data(mode_strokes)
-            method = index.regex_match_keys if mode_regex else index.prefix_match_keys
             if count is None:
                 count = len(index)
             try:
                 # Search for one more item than requested so we can tell if adding a page will add results.
-                keys = method(pattern, count + 1)
+                # If there is one, the next page starts at its position.
+                if mode_regex:
+                    keys = index.regex_match_keys(pattern, count + 1, start=cursor, timeout=self._regex_timeout)
+                else:
+                    keys = index.prefix_match_keys(pattern, count + 1, start=cursor)
                 if len(keys) > count:
+                    cursor = index.position(keys[-1])
                     keys[-1] = EXPAND_KEY
+                else:
+                    cursor = len(index)
             except RegexError:
                 keys = [BAD_REGEX_KEY]
+            except RegexTimeout as e:
+                # The next page may resume where this search stopped.
+                keys = [*e.keys, EXPAND_KEY]
+                cursor = e.idx_scanned
+                timed_out = True
+        return SearchPage({k: d[k] for k in keys}, cursor, timed_out)
+
+    def count(self, pattern:str, stop:int=None, *,
+              mode_strokes=False, mode_regex=False, mode_chords=False) -> MatchCount:
+        """ Count the matches for a search with the same arguments as search() without finding any of them.
+            If <stop> is given, only count matches before that index position (such as a cursor from search_page()).
+            Prefix search counts are exact and take O(log n) time. Regex and chord search counts are bounded:
+            the upper bound is the number of keys which pass a cheap filter, and the lower bound is usually 0.
+            Invalid patterns have no matches. """
+        if not pattern.strip():
+            return MatchCount(0, 0)
+        if INDEX_DELIM in pattern:
+            # Example searches include every example near the pattern.
+            rule_id, _ = pattern.split(INDEX_DELIM, 1)
+            _, index = self._get_example_data(rule_id, mode_strokes)
+            n = len(index)
+            return MatchCount(n, n)
+        if mode_chords:
+            try:
+                chord_index = self._get_chord_index()
+                query = parse_stroke_query(pattern, self._stroke_maskfn)
+            except StrokeQueryError:
+                return MatchCount(0, 0)
+            return MatchCount(0, chord_index.count_bound(query, stop))
+        _, index = self._get_translation_data(mode_strokes)
+        if not mode_regex:
+            n = index.prefix_count(pattern, stop=stop)
+            return MatchCount(n, n)
+        try:
+            return MatchCount(*index.regex_count_bounds(pattern, stop=stop))
+        except RegexError:
+            return MatchCount(0, 0)
+
+    def _get_postings(self, rule_id:RuleID) -> Postings:
+        """ Return the sorted example translation IDs for <rule_id>. Posting lists in memory-mapped examples are in
+            file order, so a sorted copy of each is cached. """
+        if rule_id in self._rule_postings:
+            return self._rule_postings[rule_id]
+        translations = self._examples_raw.get(rule_id)
+        if translations is None or not hasattr(translations, "posting_list"):
+            return ()
+        return self._postings_cache.get(rule_id, lambda: array('I', sorted(translations.posting_list())))
+
+    def _translation_fn(self) -> Callable[[int], Translation]:
+        """ Return a function that looks up an example translation by its ID from _get_postings(). """
+        return getattr(self._examples_raw, "translation", self._tr_list.__getitem__)
+
+    def search_rules(self, rule_ids:Iterable[RuleID], count=None, *, match_all=True, mode_strokes=False) -> MatchDict:
+        """ Search for example translations that use every rule in <rule_ids>.
+            The results are in the same format and order as search(), with an expansion sentinel if they went over
+            <count>. Only the results on the page are sorted, so no search index is compiled for them.
+            <match_all>    - If False, search for translations that use any one of the rules instead.
+            <mode_strokes> - If True, the results are strokes mapped to translations instead. """
+        # Intersections start from the shortest posting list. The result can only get shorter from there.
+        postings = sorted(map(self._get_postings, rule_ids), key=len)
+        if not postings:
+            return {}
+        if match_all:
+            tr_ids = postings[0]
+            for other in postings[1:]:
+                tr_ids = _intersect_postings(tr_ids, other)
+        else:
+            tr_ids = set().union(*postings)
+        translations = dict(map(self._translation_fn(), tr_ids))
+        if mode_strokes:
+            d = forward_multidict(translations)
+            strip_chars = self._strip_strokes
+        else:
+            d = reverse_multidict(translations)
+            strip_chars = self._strip_text
+
+        def sort_key(k:str) -> Tuple[str, str]:
+            """ Sort by the same (simkey, key) items as a StripCaseIndex. """
+            return k.strip(strip_chars).lower(), k
+
+        if count is None:
+            keys = sorted(d, key=sort_key)
+        else:
+            keys = nsmallest(count + 1, d, key=sort_key)
+            if len(keys) > count:
+                keys[-1] = EXPAND_KEY
+                d[EXPAND_KEY] = ()
         return {k: d[k] for k in keys}
 
     def has_examples(self, rule_id:RuleID) -> bool:
@@ -109,8 +444,20 @@ class SearchEngine:
         """ Return a valid example search pattern for <rule_id> centered on a random translation if one exists.
             <rule_id>      - Identifier of the rule. Only exact matches will work.
             <mode_strokes> - If True, search for strokes instead of translations. """
-        _, index = self._get_example_data(rule_id, mode_strokes)
-        keys = index.get_random_keys(1)
-        if not keys:
+        translations = self._examples_raw.get(rule_id)
+        if not translations:
             return ""
-        return rule_id + INDEX_DELIM + keys[0]
+        keys, letters = self._random_example(rule_id, translations)
+        return rule_id + INDEX_DELIM + (keys if mode_strokes else letters)
+
+    def _random_example(self, rule_id:RuleID, translations:TranslationsDict) -> Translation:
+        """ Return a random translation from the examples for <rule_id> without compiling any search data for them.
+            Mappings that support item_at() (such as memory-mapped examples) can decode just that one item.
+            Plain dicts can't be indexed, so a tuple of their keys is cached to index instead. """
+        idx = random.randrange(len(translations))
+        item_at = getattr(translations, "item_at", None)
+        if item_at is not None:
+            return item_at(idx)
+        key_seq = self._sample_cache.get(rule_id, lambda: tuple(translations))
+        keys = key_seq[idx]
+        return keys, translations[keys]
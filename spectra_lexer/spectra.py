@@ -29,6 +29,8 @@ class Spectra:
         self._opts = opts
         self.translations_paths = opts.translations_paths()
         self.index_path = opts.index_path()
+        self.search_index_path = opts.search_index_path()
+        self.examples_index_path = opts.examples_index_path()
         self.cfg_path = opts.config_path()
 
     class Component:
@@ -94,11 +96,13 @@ class Spectra:
 
     @Component
     def search_engine(self) -> SearchEngine:
-        """ For stroke-based searches, hyphens should be stripped off each end. """
+        """ For stroke-based searches, hyphens should be stripped off each end.
+            Stroke structure searches use the key converter to turn each stroke into a bitmask. """
         ws = " \r\n\t"
         strip_strokes = self.keymap.split + ws
         strip_text = ws
-        return SearchEngine(strip_strokes, strip_text)
+        stroke_maskfn = self._key_converter.rtfcre_to_masks
+        return SearchEngine(strip_strokes, strip_text, stroke_maskfn=stroke_maskfn)
 
     @Component
     def analyzer(self) -> StenoAnalyzer:
@@ -0,0 +1,672 @@
+""" Behavior tests for the HTTP server stack with raw requests over in-memory streams and local sockets. """
+
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import gzip
+from hashlib import sha1
+from http.client import HTTPConnection
+from io import BytesIO
+import json
+from json import JSONDecoder
+import os
+import random
+import signal
+import socket
+from struct import pack, unpack
+from threading import Event, Thread
+from time import sleep, time
+
+import pytest
+
+from spectra_lexer import Spectra
+from spectra_lexer.app_json import JSONGUIApplication
+from spectra_lexer.engine import build_engine
+from spectra_lexer.http.aio import AsyncHTTPConnectionHandler, AsyncHTTPServer
+from spectra_lexer.http.connect import HTTPConnectionHandler
+from spectra_lexer.http.json import JSONApplication, JSONDataProcessor, JSONWebSocketHandler
+from spectra_lexer.http.prefork import PreforkServer
+from spectra_lexer.http.request import HTTPRequestReader
+from spectra_lexer.http.response import HTTPResponse, HTTPResponseHeaders
+from spectra_lexer.http.service import HTTPDataService, HTTPFileService, HTTPGzipFilter, HTTPMethodRouter
+from spectra_lexer.http.status import HTTPError
+from spectra_lexer.http.tcp import PooledTCPServer, TCPServerSocket, ThreadedTCPServer
+from spectra_lexer.http.websocket import CLOSE_NORMAL, CLOSE_PROTOCOL_ERROR, OP_CLOSE, OP_CONTINUATION, OP_PING, \
+    OP_PONG, OP_TEXT, WebSocketHandler
+from spectra_lexer.main_http import build_decoder, build_router
+
+from . import TEST_TRANSLATIONS
+
+
+def _ok(request) -> HTTPResponse:
+    headers = HTTPResponseHeaders()
+    headers.set_content_length(2)
+    return HTTPResponse.OK(headers, b"OK")
+
+
+def _ok_router() -> HTTPMethodRouter:
+    router = HTTPMethodRouter()
+    router.add_route("GET", _ok)
+    return router
+
+
+class _EchoHandler(WebSocketHandler):
+    """ Sends every text message back until the client closes the connection. """
+
+    def handle_websocket(self, ws, log) -> None:
+        while True:
+            text = ws.receive_text()
+            if text is None:
+                return
+            ws.send_text(text)
+
+
+def _ws_frame(payload:bytes, opcode=OP_TEXT, mask=b"\x01\x02\x03\x04", fin=True) -> bytes:
+    """ Make a single masked client frame (payloads under 64 KB only). """
+    masked = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+    n = len(payload)
+    length = bytes([0x80 | n]) if n < 126 else bytes([0x80 | 126]) + pack("!H", n)
+    return bytes([(0x80 if fin else 0) | opcode]) + length + mask + masked
+
+
+def _ws_handshake(path="/ws", key:str=None, version="13") -> bytes:
+    key = key or b64encode(os.urandom(16)).decode()
+    return (f"GET {path} HTTP/1.1\r\nHost: x\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: {version}\r\n\r\n").encode()
+
+
+def _recv_exact(sock:socket.socket, size:int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionResetError("Connection closed early.")
+        data += chunk
+    return data
+
+
+def _ws_read(sock:socket.socket) -> tuple:
+    """ Read one unmasked server frame and return its opcode and payload. """
+    b0, b1 = _recv_exact(sock, 2)
+    length = b1 & 0x7F
+    if length == 126:
+        length, = unpack("!H", _recv_exact(sock, 2))
+    elif length == 127:
+        length, = unpack("!Q", _recv_exact(sock, 8))
+    return b0 & 0x0F, _recv_exact(sock, length)
+
+
+def _read_head(sock:socket.socket) -> bytes:
+    """ Read a response status line and headers from a raw socket. """
+    data = b""
+    while b"\r\n\r\n" not in data:
+        chunk = sock.recv(1)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+@contextmanager
+def _serve(server):
+    """ Run <server> on a local port in a thread and yield the port. """
+    sock = TCPServerSocket.bind_to("127.0.0.1", 0)
+    thread = Thread(target=server.serve, args=(sock,), daemon=True)
+    thread.start()
+    try:
+        yield sock.getsockname()[1]
+    finally:
+        server.shutdown()
+        thread.join()
+        sock.close()
+
+
+def _get(port:int, path="/") -> tuple:
+    """ Make one GET request on a new connection and return the status and content. """
+    conn = HTTPConnection("127.0.0.1", port, timeout=5.0)
+    try:
+        conn.request("GET", path)
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+def test_pool_rejects_when_full() -> None:
+    """ With every worker busy and the queue full, new connections must get a 503 right away.
+        Queued connections must still be served once a worker is free. """
+    entered = Event()
+    release = Event()
+
+    def blocking(request) -> HTTPResponse:
+        entered.set()
+        release.wait(5.0)
+        return _ok(request)
+
+    router = HTTPMethodRouter()
+    router.add_route("GET", blocking)
+    server = PooledTCPServer(HTTPConnectionHandler(router), logger=lambda *_: None, worker_count=1, queue_size=1,
+                             timeout=0.05, idle_timeout=5.0)
+    with _serve(server) as port:
+        with ThreadPoolExecutor(2) as pool:
+            first = pool.submit(_get, port)
+            assert entered.wait(5.0)
+            with socket.create_connection(("127.0.0.1", port), timeout=5.0) as queued_sock:
+                queued_sock.sendall(b"GET / HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n")
+                # The accepting thread handles connections in order, so this one comes after the queued one.
+                status, content = _get(port)
+                assert status == 503 and b"too busy" in content
+                release.set()
+                assert b" 200 " in _read_head(queued_sock)
+            assert first.result() == (200, b"OK")
+
+
+def test_pool_drops_idle_connections() -> None:
+    """ A worker pool must not allow an idle timeout of None. An idle keep-alive client must let go of its worker
+        once the timeout runs out, so that it can't hold the pool against everyone else. """
+    with pytest.raises(ValueError):
+        PooledTCPServer(HTTPConnectionHandler(_ok_router()), idle_timeout=None)
+    server = PooledTCPServer(HTTPConnectionHandler(_ok_router()), logger=lambda *_: None, worker_count=1,
+                             queue_size=1, timeout=0.05, idle_timeout=0.3)
+    with _serve(server) as port:
+        with socket.create_connection(("127.0.0.1", port), timeout=5.0) as idle_sock:
+            idle_sock.sendall(b"GET / HTTP/1.1\r\nHost: x\r\n\r\n")
+            assert b" 200 " in _read_head(idle_sock)
+            assert _recv_exact(idle_sock, 2) == b"OK"
+            # The idle connection holds the only worker until it times out. Then the queued request gets it.
+            start = time()
+            assert _get(port) == (200, b"OK")
+            assert time() - start < 3.0
+            assert idle_sock.recv(1024) == b""
+
+
+def test_request_size_limit() -> None:
+    """ Request content must be checked against the size limit before any of it is read. """
+    def read(length:str):
+        data = f"POST / HTTP/1.1\r\nContent-Length: {length}\r\n\r\n".encode() + b"x" * 10
+        return HTTPRequestReader(BytesIO(data), max_content_size=10).read()
+    assert read("10").content == b"x" * 10
+    for length, code in [("11", 413), ("-1", 400), ("ten", 400)]:
+        with pytest.raises(HTTPError) as exc_info:
+            read(length)
+        assert exc_info.value.status.header().split()[1] == str(code)
+
+
+def test_async_server(tmp_path) -> None:
+    """ The asyncio front end must keep connections alive between requests, stream large files without a copy
+        in memory, and refuse request content over the same size limit as the blocking handler. """
+    data = os.urandom(300000)
+    (tmp_path / "big.bin").write_bytes(data)
+    router = HTTPMethodRouter()
+    router.add_route("GET", HTTPFileService(str(tmp_path), max_file_size=1000))
+    router.add_route("POST", _ok)
+    dispatcher = AsyncHTTPConnectionHandler(router, max_content_size=100)
+    server = AsyncHTTPServer(dispatcher, logger=lambda *_: None, idle_timeout=5.0)
+    with _serve(server) as port:
+        conn = HTTPConnection("127.0.0.1", port, timeout=5.0)
+        for _ in range(2):
+            conn.request("GET", "/big.bin")
+            response = conn.getresponse()
+            assert response.status == 200 and response.read() == data
+        conn.request("POST", "/", body=b"x" * 100)
+        response = conn.getresponse()
+        assert response.status == 200 and response.read() == b"OK"
+        conn.request("POST", "/", body=b"x" * 101)
+        response = conn.getresponse()
+        assert response.status == 413
+        response.read()
+        conn.close()
+        assert _get(port, "/missing")[0] == 404
+
+
+def test_async_content_timeout() -> None:
+    """ A client that sends its headers in time but trickles its content must be cut off by the idle timeout. """
+    router = HTTPMethodRouter()
+    router.add_route("POST", _ok)
+    server = AsyncHTTPServer(AsyncHTTPConnectionHandler(router), logger=lambda *_: None, idle_timeout=0.3)
+    with _serve(server) as port:
+        with socket.create_connection(("127.0.0.1", port), timeout=5.0) as sock:
+            sock.sendall(b"POST / HTTP/1.1\r\nHost: x\r\nContent-Length: 10\r\n\r\nxx")
+            start = time()
+            assert sock.recv(1024) == b""
+            assert time() - start < 3.0
+
+
+def test_static_files(tmp_path) -> None:
+    """ Cached files must be sent compressed to clients that accept gzip, revalidated by entity tag,
+        and reloaded as soon as they change on disk. Incompressible files are never sent with gzip. """
+    text = b"function f() { return 1; }\n" * 100
+    noise = os.urandom(2000)
+    (tmp_path / "index.html").write_bytes(b"<html></html>")
+    (tmp_path / "app.js").write_bytes(text)
+    (tmp_path / "noise.bin").write_bytes(noise)
+    router = HTTPMethodRouter()
+    service = HTTPFileService(str(tmp_path))
+    router.add_route("GET", service)
+    router.add_route("HEAD", service)
+    server = ThreadedTCPServer(HTTPConnectionHandler(router), logger=lambda *_: None)
+    with _serve(server) as port:
+        conn = HTTPConnection("127.0.0.1", port, timeout=5.0)
+        def fetch(path:str, method="GET", **headers) -> tuple:
+            conn.request(method, path, headers=headers)
+            response = conn.getresponse()
+            return response, response.read()
+        response, content = fetch("/app.js")
+        assert response.status == 200 and content == text
+        assert response.getheader("Content-Encoding") is None
+        assert response.getheader("Vary") == "Accept-Encoding"
+        etag = response.getheader("ETag")
+        response, content = fetch("/app.js", **{"Accept-Encoding": "gzip"})
+        assert response.getheader("Content-Encoding") == "gzip" and gzip.decompress(content) == text
+        assert response.getheader("ETag") == etag
+        response, content = fetch("/app.js", **{"If-None-Match": etag})
+        assert response.status == 304 and content == b""
+        response, content = fetch("/app.js", "HEAD")
+        assert response.status == 200 and content == b""
+        assert response.getheader("Content-Length") == str(len(text))
+        response, content = fetch("/noise.bin", **{"Accept-Encoding": "gzip"})
+        assert content == noise and response.getheader("Content-Encoding") is None
+        assert fetch("/")[1] == b"<html></html>"
+        new_text = text + b"// changed\n"
+        (tmp_path / "app.js").write_bytes(new_text)
+        response, content = fetch("/app.js", **{"If-None-Match": etag})
+        assert response.status == 200 and content == new_text
+        assert response.getheader("ETag") != etag
+        assert fetch("/missing.js")[0].status == 404
+        conn.close()
+
+
+def _text(size:int) -> bytes:
+    """ Make text at least <size> bytes long that compresses differently at each gzip level. """
+    rng = random.Random(size)
+    words = ["steno", "chord", "rule", "lexer", "graph", "board", "key", "stroke"]
+    text = b""
+    while len(text) < size:
+        text += f"{rng.choice(words)}{rng.randrange(100)} ".encode()
+    return text
+
+
+def _gzip_get(handler, path:str, accept_gzip=True) -> HTTPResponse:
+    """ Call <handler> with a GET request for <path> read from raw bytes, optionally accepting gzip. """
+    accept = "Accept-Encoding: gzip\r\n" if accept_gzip else ""
+    request = HTTPRequestReader(BytesIO(f"GET {path} HTTP/1.1\r\n{accept}\r\n".encode())).read()
+    return handler(request)
+
+
+def _assert_level(response:HTTPResponse, data:bytes, level:int) -> None:
+    """ The deflate stream after the 10-byte gzip header only depends on the data and level. """
+    assert response.headers.content_encoding() == "gzip"
+    assert response.content[10:] == gzip.compress(data, level, mtime=0)[10:]
+
+
+def test_static_file_eviction(tmp_path) -> None:
+    """ Once the file cache is full, the least recently used files must be evicted to make room for new ones.
+        A file that could never fit is served without evicting anything. """
+    for name, size in [("a", 300), ("b", 300), ("c", 300), ("big", 800)]:
+        (tmp_path / name).write_bytes(os.urandom(size))
+    service = HTTPFileService(str(tmp_path), cache_size=700)
+    def get(name:str) -> None:
+        request = HTTPRequestReader(BytesIO(f"GET /{name} HTTP/1.1\r\n\r\n".encode())).read()
+        assert service(request).content == (tmp_path / name).read_bytes()
+    def cached() -> list:
+        return [os.path.basename(path) for path in service._cache]
+    for name in ["a", "b", "a", "c"]:
+        get(name)
+    assert cached() == ["a", "c"]
+    get("big")
+    assert cached() == ["a", "c"]
+    get("b")
+    assert cached() == ["c", "b"]
+
+
+def test_gzip_levels() -> None:
+    """ Without a fixed level, small content gets the base level, large content a faster one, and everything gets
+        the fastest level under load. Small and already encoded content is left alone. """
+    small = _text(2000)
+    large = _text(40000)
+    entered = Event()
+    release = Event()
+
+    def respond(request) -> HTTPResponse:
+        data = small if request.uri.path == "/small" else large
+        if request.uri.query.get("wait"):
+            entered.set()
+            release.wait(5.0)
+        headers = HTTPResponseHeaders()
+        if request.uri.query.get("encoded"):
+            headers.set_content_encoding("br")
+        headers.set_content_length(len(data))
+        return HTTPResponse.OK(headers, data)
+
+    filt = HTTPGzipFilter(respond, base_level=6, size_threshold=100, busy_count=1)
+    _assert_level(_gzip_get(filt, "/small"), small, 6)
+    _assert_level(_gzip_get(filt, "/large"), large, 3)
+    assert _gzip_get(filt, "/small", accept_gzip=False).content == small
+    assert _gzip_get(filt, "/small?encoded=1").content == small
+    with ThreadPoolExecutor(1) as pool:
+        waiting = pool.submit(_gzip_get, filt, "/large?wait=1")
+        assert entered.wait(5.0)
+        # That request counts as one in progress, and this one as the second, which is over the busy count.
+        _assert_level(_gzip_get(filt, "/small"), small, 1)
+        release.set()
+        _assert_level(waiting.result(), large, 3)
+    fixed = HTTPGzipFilter(respond, compresslevel=9, base_level=6)
+    _assert_level(_gzip_get(fixed, "/large"), large, 9)
+    custom = HTTPGzipFilter(respond, base_level=8)
+    _assert_level(_gzip_get(custom, "/small"), small, 8)
+    _assert_level(_gzip_get(custom, "/large"), large, 3)
+    below_threshold = HTTPGzipFilter(respond, size_threshold=len(small) + 1)
+    assert _gzip_get(below_threshold, "/small").content == small
+
+
+def _pid_response(request) -> HTTPResponse:
+    content = str(os.getpid()).encode()
+    headers = HTTPResponseHeaders()
+    headers.set_content_length(len(content))
+    return HTTPResponse.OK(headers, content)
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="Requires os.fork")
+def test_prefork_server() -> None:
+    """ Forked workers must serve requests from the shared socket, and a worker that dies must be replaced. """
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+
+    def make_server() -> ThreadedTCPServer:
+        router = HTTPMethodRouter()
+        router.add_route("GET", _pid_response)
+        return ThreadedTCPServer(HTTPConnectionHandler(router), logger=lambda *_: None, timeout=0.05)
+
+    messages = []
+    server = PreforkServer(make_server, 2, logger=messages.append, timeout=0.05)
+    thread = Thread(target=server.start, args=("127.0.0.1", port), daemon=True)
+    thread.start()
+    deadline = time() + 5.0
+    while len(messages) < 2 and time() < deadline:
+        sleep(0.01)
+    try:
+        pids = set()
+        for _ in range(6):
+            status, content = _get(port)
+            assert status == 200
+            pids.add(int(content))
+        assert os.getpid() not in pids
+        victim = pids.pop()
+        os.kill(victim, signal.SIGKILL)
+        deadline = time() + 5.0
+        while not any("exited unexpectedly" in m for m in messages) and time() < deadline:
+            sleep(0.05)
+        assert any(f"Worker {victim} exited unexpectedly" in m for m in messages)
+        status, content = _get(port)
+        assert status == 200 and int(content) != victim
+    finally:
+        server.shutdown()
+        thread.join(10.0)
+    assert not thread.is_alive()
+
+
+class _CountingApp(JSONApplication):
+    """ Returns the number of times it has run along with some padding. Requests with "cache" may be cached. """
+
+    def __init__(self) -> None:
+        self.runs = 0
+
+    def run(self, obj):
+        self.runs += 1
+        return {"runs": self.runs, "padding": "x" * 2000}
+
+    def is_cacheable(self, obj) -> bool:
+        return bool(obj.get("cache"))
+
+
+def _post_json(conn:HTTPConnection, body:bytes, **headers) -> tuple:
+    """ POST <body> as JSON on an open connection and return the response and its raw content. """
+    conn.request("POST", "/request", body=body, headers={"Content-Type": "application/json", **headers})
+    response = conn.getresponse()
+    return response, response.read()
+
+
+def test_response_cache(tmp_path) -> None:
+    """ Cacheable requests must run once no matter how their JSON is formatted. A client that already has the
+        response must get a 304, and clients that accept gzip must get the compressed copy. """
+    app = _CountingApp()
+    router = build_router(app, str(tmp_path), cache_size=1 << 20)
+    server = ThreadedTCPServer(HTTPConnectionHandler(router), logger=lambda *_: None)
+    with _serve(server) as port:
+        conn = HTTPConnection("127.0.0.1", port, timeout=5.0)
+        response, content = _post_json(conn, b'{"cache": true, "q": 1}')
+        assert response.status == 200 and json.loads(content)["runs"] == 1
+        etag = response.getheader("ETag")
+        assert etag
+        response, content = _post_json(conn, b'{"q":1,"cache":true}')
+        assert response.status == 200 and json.loads(content)["runs"] == 1
+        assert response.getheader("ETag") == etag
+        response, content = _post_json(conn, b'{"cache": true, "q": 1}', **{"If-None-Match": etag})
+        assert response.status == 304 and content == b""
+        response, content = _post_json(conn, b'{"cache": true, "q": 1}', **{"If-None-Match": '"other"'})
+        assert response.status == 200 and json.loads(content)["runs"] == 1
+        response, content = _post_json(conn, b'{"cache": true, "q": 1}', **{"Accept-Encoding": "gzip"})
+        assert response.getheader("Content-Encoding") == "gzip"
+        assert json.loads(gzip.decompress(content))["runs"] == 1
+        for expected_runs in (2, 3):
+            response, content = _post_json(conn, b'{"cache": false}')
+            assert response.status == 200 and json.loads(content)["runs"] == expected_runs
+        conn.close()
+    # The cache key function and the service share one decoded copy of each request.
+    decoded = []
+    class CountingDecoder(JSONDecoder):
+        def decode(self, s, **kwargs):
+            decoded.append(s)
+            return super().decode(s, **kwargs)
+    processor = JSONDataProcessor(app, CountingDecoder())
+    service = HTTPDataService(processor)
+    for body in [b'{"cache": true}', b'{"cache": false}']:
+        data = b"POST / HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body)
+        request = HTTPRequestReader(BytesIO(data)).read()
+        processor.cache_key(service.decode(request))
+        assert service(request).status.is_ok()
+    assert len(decoded) == 2
+
+
+@pytest.fixture(scope="module")
+def gui_app() -> JSONGUIApplication:
+    engine = build_engine(Spectra())
+    engine.set_translations(TEST_TRANSLATIONS)
+    return JSONGUIApplication(engine, max_batch=3)
+
+
+def test_lazy_pages(gui_app, tmp_path) -> None:
+    """ A lazy display must list every reference without drawing its page, and each page fetched on its own
+        must match the one in a full display. """
+    keys, letters = next(iter(TEST_TRANSLATIONS.items()))
+    router = build_router(gui_app, str(tmp_path), cache_size=1 << 20, max_batch=3)
+    server = ThreadedTCPServer(HTTPConnectionHandler(router), logger=lambda *_: None)
+    with _serve(server) as port:
+        conn = HTTPConnection("127.0.0.1", port, timeout=5.0)
+        def run(obj:dict) -> dict:
+            response, content = _post_json(conn, json.dumps(obj).encode())
+            assert response.status == 200
+            return json.loads(content)
+        full = run({"action": "query", "args": [keys, letters]})["display"]
+        lazy = run({"action": "query", "args": [keys, letters], "lazy_pages": True})["display"]
+        assert full["page_refs"] is None
+        assert lazy["pages_by_ref"] == {}
+        assert lazy["default_page"] == full["default_page"]
+        assert lazy["page_refs"] == list(full["pages_by_ref"])
+        assert lazy["page_refs"]
+        for ref in lazy["page_refs"]:
+            updates = run({"action": "page", "args": [keys, letters, ref]})
+            assert updates["page_ref"] == ref
+            assert updates["page"] == full["pages_by_ref"][ref]
+        updates = run({"action": "page", "args": [keys, letters, "not a ref"]})
+        assert updates["page"] == full["default_page"]
+        conn.close()
+
+
+def test_search_examples() -> None:
+    """ Following an example link must analyze the chosen example only once and include the linked rule's page. """
+    spectra = Spectra()
+    engine = build_engine(spectra)
+    engine.set_translations(TEST_TRANSLATIONS)
+    examples = spectra.analyzer.compile_index(TEST_TRANSLATIONS.items())
+    engine.set_examples(examples)
+    app = JSONGUIApplication(engine)
+    rule_id = max(examples, key=lambda r_id: len(examples[r_id]))
+    updates = app.run({"action": "search_examples", "args": [rule_id], "lazy_pages": True})
+    info = app._analyses.info()
+    assert (info.hits, info.misses) == (0, 1)
+    example_ref = updates["example_ref"]
+    assert example_ref
+    assert list(updates["display"]["pages_by_ref"]) == [example_ref]
+
+
+def test_batch_requests(gui_app, tmp_path) -> None:
+    """ A batch runs each of its actions in order and merges their updates, with later actions taking priority.
+        Batches over the size limit and malformed actions must be rejected before any of them run. """
+    keys, letters = next(iter(TEST_TRANSLATIONS.items()))
+    search_a = {"action": "search", "args": [letters, 1]}
+    search_b = {"action": "search", "args": [keys, 1]}
+    query = {"action": "query", "args": [keys, letters]}
+    updates = gui_app.run({"batch": [search_a, query, search_b]})
+    assert updates["matches"]["pattern"] == keys
+    assert updates["display"]["keys"] == keys
+    assert gui_app.run({"batch": [query], "lazy_pages": True})["display"]["pages_by_ref"] == {}
+    assert gui_app.is_cacheable({"batch": [query, query]})
+    assert not gui_app.is_cacheable({"batch": [query, search_a]})
+    for batch in [[query] * 4, [], query]:
+        with pytest.raises(ValueError):
+            gui_app.run({"batch": batch})
+    with pytest.raises(TypeError):
+        gui_app.run({"batch": [query, "search"]})
+    # The decoder gives each action in a batch the limits of a single request, but no more.
+    # Requests that aren't batches only get the limits of one, even if they mention the field.
+    decoder = build_decoder(3)
+    nested = {"action": "query", "args": [[[]]] * 9}
+    decoder.decode(json.dumps(nested))
+    decoder.decode(json.dumps({"batch": [nested] * 3}))
+    for obj in [{"batch": [nested] * 4}, {"batch": [nested], "args": [[[]]] * 9}, {**nested, "x": "batch", "y": [[]]},
+                {**nested, "y": [[]], "batch": None}]:
+        with pytest.raises(ValueError):
+            decoder.decode(json.dumps(obj))
+    router = build_router(gui_app, str(tmp_path), max_batch=3)
+    server = ThreadedTCPServer(HTTPConnectionHandler(router), logger=lambda *_: None)
+    with _serve(server) as port:
+        conn = HTTPConnection("127.0.0.1", port, timeout=5.0)
+        response, content = _post_json(conn, json.dumps({"batch": [search_a, query]}).encode())
+        assert response.status == 200
+        updates = json.loads(content)
+        assert updates["matches"]["pattern"] == letters and updates["display"]["letters"] == letters
+        conn.close()
+        conn = HTTPConnection("127.0.0.1", port, timeout=5.0)
+        response, content = _post_json(conn, json.dumps({"batch": [query] * 4}).encode())
+        assert response.status == 500
+        conn.close()
+
+
+def test_websocket_leaves_pool_free() -> None:
+    """ An open WebSocket must not hold a pool worker. With one worker, HTTP requests still get through,
+        and WebSockets past their own limit are refused with a 503. """
+    dispatcher = HTTPConnectionHandler(_ok_router(), max_websockets=1)
+    dispatcher.add_websocket_route("/ws", _EchoHandler())
+    server = PooledTCPServer(dispatcher, logger=lambda *_: None, worker_count=1, queue_size=1, timeout=0.05,
+                             idle_timeout=5.0)
+    with _serve(server) as port:
+        with socket.create_connection(("127.0.0.1", port), timeout=5.0) as ws_sock:
+            ws_sock.sendall(_ws_handshake())
+            assert b" 101 " in _read_head(ws_sock)
+            for _ in range(3):
+                assert _get(port) == (200, b"OK")
+            with socket.create_connection(("127.0.0.1", port), timeout=5.0) as extra_sock:
+                extra_sock.sendall(_ws_handshake())
+                assert b" 503 " in _read_head(extra_sock)
+            # The first WebSocket still works.
+            ws_sock.sendall(_ws_frame(b"ping"))
+            assert ws_sock.recv(6) == bytes([0x81, 4]) + b"ping"
+
+
+def test_websocket_protocol() -> None:
+    """ The handshake must follow RFC 6455. Fragmented and long messages must be reassembled, pings answered
+        even in the middle of a message, and close frames echoed. Unmasked client frames break the protocol. """
+    dispatcher = HTTPConnectionHandler(_ok_router())
+    dispatcher.add_websocket_route("/ws", _EchoHandler())
+    server = ThreadedTCPServer(dispatcher, logger=lambda *_: None)
+    with _serve(server) as port:
+        key = b64encode(os.urandom(16)).decode()
+        expected_accept = b64encode(sha1((key + "258EAFA5-E914-47DA-95CA-C5AB0DC85B11").encode()).digest())
+        with socket.create_connection(("127.0.0.1", port), timeout=5.0) as sock:
+            sock.sendall(_ws_handshake(key=key))
+            head = _read_head(sock)
+            assert b" 101 " in head
+            assert b"Sec-WebSocket-Accept: " + expected_accept + b"\r\n" in head
+            sock.sendall(_ws_frame(b"hel", fin=False) + _ws_frame(b"p", OP_PING) + _ws_frame(b"lo", OP_CONTINUATION))
+            assert _ws_read(sock) == (OP_PONG, b"p")
+            assert _ws_read(sock) == (OP_TEXT, b"hello")
+            long_text = b"x" * 300
+            sock.sendall(_ws_frame(long_text))
+            assert _ws_read(sock) == (OP_TEXT, long_text)
+            sock.sendall(_ws_frame(pack("!H", CLOSE_NORMAL), OP_CLOSE))
+            assert _ws_read(sock) == (OP_CLOSE, pack("!H", CLOSE_NORMAL))
+            assert sock.recv(1) == b""
+        with socket.create_connection(("127.0.0.1", port), timeout=5.0) as sock:
+            sock.sendall(_ws_handshake())
+            assert b" 101 " in _read_head(sock)
+            sock.sendall(bytes([0x80 | OP_TEXT, 2]) + b"hi")
+            opcode, payload = _ws_read(sock)
+            assert opcode == OP_CLOSE and unpack("!H", payload[:2])[0] == CLOSE_PROTOCOL_ERROR
+        with socket.create_connection(("127.0.0.1", port), timeout=5.0) as sock:
+            sock.sendall(_ws_handshake(version="8"))
+            assert b" 400 " in _read_head(sock)
+        assert _get(port, "/ws") == (200, b"OK")
+
+
+class _BlockingApp(JSONApplication):
+    """ Echoes each request. Requests with "block" wait for an event first. Requests in the same "group" cancel
+        each other, like searches while typing. """
+
+    def __init__(self) -> None:
+        self.started = Event()
+        self.release = Event()
+
+    def run(self, obj):
+        if obj.get("block"):
+            self.started.set()
+            assert self.release.wait(5.0)
+        return obj
+
+    def cancel_group(self, obj):
+        return obj.get("group")
+
+
+def test_websocket_cancels_stale_requests(gui_app) -> None:
+    """ Each request in a cancel group must make older ones obsolete. One still waiting is skipped, one already
+        running finishes but its result is dropped, and both get a cancellation reply. Other groups are unaffected. """
+    assert gui_app.cancel_group({"action": "search"}) == gui_app.cancel_group({"action": "search_rules"})
+    assert gui_app.cancel_group({"action": "search_examples"}) is None
+    app = _BlockingApp()
+    dispatcher = HTTPConnectionHandler(_ok_router())
+    dispatcher.add_websocket_route("/ws", JSONWebSocketHandler(app))
+    server = ThreadedTCPServer(dispatcher, logger=lambda *_: None)
+
+    def send(sock:socket.socket, msg_id, **request) -> None:
+        sock.sendall(_ws_frame(json.dumps({"id": msg_id, "request": request}).encode()))
+
+    with _serve(server) as port:
+        with socket.create_connection(("127.0.0.1", port), timeout=5.0) as sock:
+            sock.sendall(_ws_handshake())
+            assert b" 101 " in _read_head(sock)
+            send(sock, 1, group="search", block=True, q="s")
+            assert app.started.wait(5.0)
+            send(sock, 2, group="search", q="st")
+            send(sock, 3, q="other")
+            send(sock, 4, group="search", q="ste")
+            # A malformed message gets an error right away from the reading thread, so every request above has
+            # been queued (and cancelled if stale) by the time it arrives.
+            sock.sendall(_ws_frame(b'"no request"'))
+            assert "error" in json.loads(_ws_read(sock)[1])
+            app.release.set()
+            replies = [json.loads(_ws_read(sock)[1]) for _ in range(4)]
+            assert replies == [{"id": 1, "cancelled": True},
+                               {"id": 2, "cancelled": True},
+                               {"id": 3, "result": {"q": "other"}},
+                               {"id": 4, "result": {"group": "search", "q": "ste"}}]
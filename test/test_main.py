@@ -1,10 +1,21 @@
 """ Main feature tests for the Spectra steno lexer.
     Tests translation search, lexical analysis, and graphical rendering. """
 
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
+import json
+import os
+import pickle
 import re
+from threading import Barrier
 
 import pytest
 from spectra_lexer import Spectra
+from spectra_lexer.app_json import build_app
+from spectra_lexer.engine import build_engine
+from spectra_lexer.resource.rules import StenoRule, StenoRuleFactory
+from spectra_lexer.search.mapped import MappedExamplesFile, MappedSearchFile
+from spectra_lexer.spc_search import BAD_QUERY_KEY, EXPAND_KEY, INDEX_DELIM, SearchEngine
 
 from . import TEST_TRANSLATIONS
 
@@ -12,6 +23,8 @@ _spectra = Spectra()
 SEARCH_ENGINE = _spectra.search_engine
 ANALYZER = _spectra.analyzer
 BOARD_ENGINE = _spectra.board_engine
+KEY_CONVERTER = _spectra._key_converter
+RESOURCE_IO = _spectra.resource_io
 GRAPH_ENGINE = _spectra.graph_engine
 del _spectra
 
@@ -29,6 +42,184 @@ def test_search(keys, letters) -> None:
     assert letters in search(re.escape(letters), count=2, mode_regex=True)
 
 
+def test_search_count() -> None:
+    """ Match counts must be exact for prefix searches and bound the actual number of matches for the others. """
+    search_page = SEARCH_ENGINE.search_page
+    count = SEARCH_ENGINE.count
+    for keys, letters in TEST_TRANSLATION_PAIRS[:50]:
+        for pattern, mode_strokes in [(keys[:1], True), (letters[:2], False)]:
+            n = len(SEARCH_ENGINE.search(pattern, mode_strokes=mode_strokes))
+            assert count(pattern, mode_strokes=mode_strokes) == (n, n)
+            matches, cursor, _ = search_page(pattern, 2, mode_strokes=mode_strokes)
+            assert count(pattern, cursor, mode_strokes=mode_strokes).high == min(n, 2)
+        regex = keys[:1] + ".*"
+        n = len(SEARCH_ENGINE.search(regex, mode_strokes=True, mode_regex=True))
+        low, high = count(regex, mode_strokes=True, mode_regex=True)
+        assert low <= n <= high
+        chord = keys.split("/")[-1]
+        low, high = count(chord, mode_chords=True)
+        assert low <= len(SEARCH_ENGINE.search(chord, mode_chords=True)) <= high
+    assert count("(", mode_regex=True) == (0, 0)
+    assert count("  ") == (0, 0)
+
+
+def test_resource_interning(tmp_path) -> None:
+    """ Equal strings loaded from different files must be the same objects, including simkeys in the search index. """
+    tr_paths = [str(tmp_path / f"{i}.json") for i in range(2)]
+    examples_path = str(tmp_path / "index.json")
+    for path in tr_paths:
+        RESOURCE_IO.save_json_translations(path, TEST_TRANSLATIONS)
+    RESOURCE_IO.save_json_examples(examples_path, {"rule": TEST_TRANSLATIONS})
+    translations = RESOURCE_IO.load_json_translations(*tr_paths)
+    examples = RESOURCE_IO.load_json_examples(examples_path)
+    assert translations == examples["rule"] == TEST_TRANSLATIONS
+    for (keys, letters), (ex_keys, ex_letters) in zip(translations.items(), examples["rule"].items()):
+        assert keys is ex_keys
+        assert letters is ex_letters
+    search_engine = copy(SEARCH_ENGINE)
+    search_engine.set_translations(translations)
+    search_engine.search("a")
+    _, index = search_engine._get_translation_data(mode_strokes=False)
+    for simkey, letters in index.iter_items():
+        if simkey == letters:
+            assert simkey is letters
+
+
+def test_search_index_file(tmp_path) -> None:
+    """ Search data loaded from a memory-mapped index file must give the same results as the original. """
+    filename = str(tmp_path / "search.bin")
+    SEARCH_ENGINE.save_index(filename, "v1")
+    mapped = copy(SEARCH_ENGINE)
+    assert not mapped.load_index(filename, "v2")
+    assert not mapped.load_index(filename + ".missing", "v1")
+    # Files with a readable header that is missing fields (or has the wrong types) are invalid, not fatal.
+    bad_filename = str(tmp_path / "bad.bin")
+    for fields in [{}, {"sections": []}, {"sections": {"strokes": 1}}]:
+        MappedSearchFile._write(bad_filename, MappedSearchFile._header_bytes("v1", **fields), [], [])
+        assert not mapped.load_index(bad_filename, "v1")
+    assert mapped.load_index(filename, "v1")
+    assert mapped.get_translations() == TEST_TRANSLATIONS
+    for keys, letters in TEST_TRANSLATION_PAIRS:
+        for pattern, mode_strokes in [(keys, True), (letters, False), (keys[:2], True), (letters[:2], False)]:
+            for mode_regex in (False, True):
+                kwargs = dict(mode_strokes=mode_strokes, mode_regex=mode_regex)
+                assert mapped.search_page(pattern, 5, **kwargs) == SEARCH_ENGINE.search_page(pattern, 5, **kwargs)
+            kwargs = dict(mode_strokes=mode_strokes)
+            assert mapped.lookup(pattern, **kwargs) == SEARCH_ENGINE.lookup(pattern, **kwargs)
+
+
+def test_search_compile_on_demand() -> None:
+    """ Translation search data must only be compiled for a direction when a search first needs it. """
+    search_engine = Spectra().search_engine
+    search_engine.set_translations(TEST_TRANSLATIONS)
+    assert search_engine._tr_strokes is None and search_engine._tr_text is None
+    keys, letters = TEST_TRANSLATION_PAIRS[0]
+    assert search_engine.search(letters, count=2) == {letters: (keys,)}
+    assert search_engine._tr_strokes is None and search_engine._tr_text is not None
+    assert search_engine.search(keys, count=2, mode_strokes=True) == {keys: (letters,)}
+    assert search_engine._tr_strokes is not None
+
+
+def test_examples_index_file(tmp_path) -> None:
+    """ The binary examples index must only be written to its own configured path, never next to the JSON index. """
+    examples_path = str(tmp_path / "index.json")
+    bin_path = str(tmp_path / "cache" / "examples.bin")
+    RESOURCE_IO.save_json_examples(examples_path, {"rule": TEST_TRANSLATIONS})
+    os.mkdir(tmp_path / "cache")
+    examples = None
+    for configured_path in ["", bin_path, bin_path]:
+        spectra = Spectra()
+        spectra.translations_paths = []
+        spectra.index_path = examples_path
+        spectra.search_index_path = ""
+        spectra.examples_index_path = configured_path
+        build_engine(spectra).load_initial()
+        examples = spectra.search_engine._examples_raw
+        assert examples["rule"] == TEST_TRANSLATIONS
+        assert sorted(os.listdir(tmp_path)) == ["cache", "index.json"]
+        assert os.listdir(tmp_path / "cache") == (["examples.bin"] if configured_path else [])
+    # The last load found the file written by the one before it.
+    assert isinstance(examples, MappedExamplesFile)
+
+
+def test_prewarm_search(tmp_path) -> None:
+    """ An app built to be shared by forked worker processes must compile all of its search data first.
+        Otherwise, each process would compile it again on its first search. """
+    translations_path = tmp_path / "main.json"
+    translations_path.write_text(json.dumps(TEST_TRANSLATIONS))
+    for prewarm_search in (False, True):
+        spectra = Spectra()
+        spectra.translations_paths = [str(translations_path)]
+        spectra.index_path = spectra.search_index_path = spectra.examples_index_path = ""
+        build_app(spectra, prewarm_search=prewarm_search)
+        search_engine = spectra.search_engine
+        compiled = [search_engine._tr_strokes, search_engine._tr_text, search_engine._tr_chords]
+        if prewarm_search:
+            assert None not in compiled
+            assert len(search_engine._tr_chords) == len(TEST_TRANSLATIONS)
+        else:
+            assert compiled == [None, None, None]
+
+
+def test_search_timeout() -> None:
+    """ A regex search that runs out of time must be flagged and resume from its cursor without losing results. """
+    search_engine = SearchEngine(" ", " ", regex_timeout=0.0)
+    search_engine.set_translations(TEST_TRANSLATIONS)
+    _, index = search_engine._get_translation_data(mode_strokes=True)
+    index.regex_block_size = 2
+    keys = []
+    cursor = 0
+    for _ in range(len(TEST_TRANSLATIONS)):
+        matches, cursor, timed_out = search_engine.search_page(".*", 100, cursor, mode_strokes=True, mode_regex=True)
+        if not timed_out:
+            assert EXPAND_KEY not in matches
+            keys += matches
+            break
+        assert list(matches)[-1] == EXPAND_KEY
+        keys += list(matches)[:-1]
+    else:
+        raise AssertionError("Search never finished.")
+    assert keys == list(SEARCH_ENGINE.search(".*", mode_strokes=True, mode_regex=True))
+
+
+def _brute_force_chords(chords, n_strokes=None):
+    """ Find translation keys with every chord in any stroke by set comparison of s-keys. """
+    chord_sets = [set(KEY_CONVERTER.rtfcre_to_skeys(c)) for c in chords]
+    matches = []
+    for keys in TEST_TRANSLATIONS:
+        strokes = [set(s) for s in KEY_CONVERTER.rtfcre_to_skeys(keys).split("/")]
+        if n_strokes is not None and len(strokes) != n_strokes:
+            continue
+        if all(any(c <= s for s in strokes) for c in chord_sets):
+            matches.append(keys)
+    return sorted(matches)
+
+
+def test_search_chords() -> None:
+    """ Stroke structure search must find exactly what a brute-force comparison of key sets does. """
+    search = SEARCH_ENGINE.search
+    for query, chords, n_strokes in [("TK -LG", ["TK", "-LG"], None), ("-FRPB", ["-FRPB"], None),
+                                     ("A =2", ["A"], 2), ("*", ["*"], None), ("=1", [], 1)]:
+        assert sorted(search(query, mode_chords=True)) == _brute_force_chords(chords, n_strokes)
+    for keys, letters in TEST_TRANSLATION_PAIRS[:50]:
+        strokes = keys.split("/")
+        query = " ".join([f"{i}:{s}" for i, s in enumerate(strokes, 1)] + [f"={len(strokes)}"])
+        assert search(query, mode_chords=True)[keys] == (letters,)
+        assert keys in search(f"-1:{strokes[-1]} >{len(strokes) - 1}", mode_chords=True)
+    # Pages must add up to the full search.
+    full = search("-T", mode_chords=True)
+    page, cursor, _ = SEARCH_ENGINE.search_page("-T", 3, mode_chords=True)
+    rest = SEARCH_ENGINE.search_page("-T", None, cursor, mode_chords=True).matches
+    assert len(full) > 3 and list(page)[:3] + list(rest) == list(full)
+    assert list(page)[3] == EXPAND_KEY
+    # Chords with keys that aren't in the layout (or no keys at all) must not match everything.
+    for bad_query in ["0:S", "x:S", "=x", "TK/-LG", "Q", "SQ", "1:", "-", "S--T"]:
+        assert search(bad_query, mode_chords=True) == {BAD_QUERY_KEY: ()}
+        assert SEARCH_ENGINE.count(bad_query, mode_chords=True) == (0, 0)
+    with pytest.raises(ValueError):
+        KEY_CONVERTER.rtfcre_to_masks("STQ")
+
+
 RTFCRE_CHARS = set("/-#STKPWHRAO*EUFRPBLGTSDZ")
 DELIMS = '/-'
 
@@ -57,6 +248,30 @@ def test_analysis(keys, letters) -> None:
         assert BOARD_ENGINE.draw_rule(rule)
 
 
+def test_rule_factory_threads() -> None:
+    """ Rules built on several threads at once must only get the connections made on their own thread. """
+    factory = StenoRuleFactory()
+    child = StenoRule(keys="A", letters="a", info="", alt="", id="a", rulemap=())
+    barrier = Barrier(2)
+    def build(n:int) -> StenoRule:
+        # Interleave every step with the other thread.
+        factory.push()
+        barrier.wait()
+        for i in range(n):
+            factory.connect(child, i, 1)
+            barrier.wait()
+        return factory.build("A" * n, "a" * n)
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        rules = list(pool.map(build, [2, 2]))
+    for rule in rules:
+        assert [item.start for item in rule.rulemap] == [0, 1]
+    # Rule factories must still survive pickling for multiprocessing.
+    factory = pickle.loads(pickle.dumps(factory))
+    factory.push()
+    factory.connect(child, 0, 1)
+    assert len(factory.build("A", "a").rulemap) == 1
+
+
 @pytest.mark.parametrize("step", range(1, 6))
 def test_compound(step) -> None:
     """ Compound analysis should work on arbitrary sequences of translations. """
@@ -68,3 +283,64 @@ def test_index() -> None:
     """ Basic test for examples index generation. Every translation should have at least one entry. """
     examples = ANALYZER.compile_index(TEST_TRANSLATION_PAIRS, process_count=1)
     assert {pair for d in examples.values() for pair in d.items()} == set(TEST_TRANSLATION_PAIRS)
+
+
+def test_search_rules(tmp_path) -> None:
+    """ Rule co-occurrence searches must match a brute force check of the examples index. """
+    examples = ANALYZER.compile_index(TEST_TRANSLATION_PAIRS, process_count=1)
+    search_engine = SearchEngine(" ", " ")
+    search_engine.set_examples(examples)
+    rule_ids = sorted(examples, key=lambda r_id: len(examples[r_id]), reverse=True)[:4]
+    for i in range(len(rule_ids)):
+        for j in range(i + 1, len(rule_ids)):
+            r1, r2 = rule_ids[i], rule_ids[j]
+            both = examples[r1].items() & examples[r2].items()
+            either = examples[r1].items() | examples[r2].items()
+            results = search_engine.search_rules([r1, r2], mode_strokes=True)
+            assert {(k, v[0]) for k, v in results.items()} == both
+            results = search_engine.search_rules([r1, r2], match_all=False, mode_strokes=True)
+            assert {(k, v[0]) for k, v in results.items()} == either
+    # Postings are sorted ID arrays made once with the examples. Searches must not add to them.
+    tr_count = len(search_engine._tr_list)
+    assert tr_count == len({pair for d in examples.values() for pair in d.items()})
+    for r_id in rule_ids:
+        postings = search_engine._get_postings(r_id)
+        assert postings.typecode == 'I' and list(postings) == sorted(postings)
+    all_three = examples[rule_ids[0]].items() & examples[rule_ids[1]].items() & examples[rule_ids[2]].items()
+    results = search_engine.search_rules(rule_ids[:3], mode_strokes=True)
+    assert {(k, v[0]) for k, v in results.items()} == all_three
+    assert search_engine.search_rules(["not a rule", rule_ids[0]]) == {}
+    assert len(search_engine._tr_list) == tr_count
+    # Pages must hold the first results in the same order as a search over all of them.
+    r_id = rule_ids[0]
+    full_search = list(search_engine.search(r_id + INDEX_DELIM))
+    results = search_engine.search_rules([r_id])
+    assert list(results) == full_search
+    results = search_engine.search_rules([r_id], count=3)
+    assert list(results) == [*full_search[:3], EXPAND_KEY]
+    assert results[EXPAND_KEY] == ()
+    # Memory-mapped examples use their own translation IDs.
+    filename = str(tmp_path / "examples.bin")
+    RESOURCE_IO.save_binary_examples(filename, examples)
+    mapped_engine = SearchEngine(" ", " ")
+    mapped_engine.set_examples(RESOURCE_IO.load_binary_examples(filename))
+    for match_all in (True, False):
+        assert mapped_engine.search_rules(rule_ids, match_all=match_all) == \
+               search_engine.search_rules(rule_ids, match_all=match_all)
+    assert search_engine.search_rules([]) == {}
+
+
+def test_random_pattern() -> None:
+    """ Random example patterns must come from the examples index without compiling any search data. """
+    examples = ANALYZER.compile_index(TEST_TRANSLATION_PAIRS, process_count=1)
+    search_engine = SearchEngine(" ", " ")
+    search_engine.set_examples(examples)
+    rule_id = max(examples, key=lambda r_id: len(examples[r_id]))
+    for mode_strokes in (False, True):
+        for _ in range(20):
+            pattern = search_engine.random_pattern(rule_id, mode_strokes=mode_strokes)
+            r_id, tr_pattern = pattern.split(INDEX_DELIM, 1)
+            assert r_id == rule_id
+            assert tr_pattern in (examples[rule_id] if mode_strokes else examples[rule_id].values())
+    assert search_engine.examples_cache_info().misses == 0
+    assert search_engine.random_pattern("not a rule") == ""
@@ -1,8 +1,14 @@
 """ Unit tests for structures in search package. """
 
+from time import sleep
+
 import pytest
 
-from spectra_lexer.search.index import RegexError, SimilarKeyIndex, StripCaseIndex
+from spectra_lexer.search.cache import SizedLRUCache
+from spectra_lexer.search.index import RegexError, RegexTimeout, SimilarKeyIndex, StripCaseIndex
+from spectra_lexer.search.mapped import MappedExamplesFile
+from spectra_lexer.search.multidict import forward_multidict, reverse_multidict
+from spectra_lexer.search.strokes import parse_stroke_query, StrokeMaskIndex, StrokeQueryError
 
 
 class _CountAIndex(SimilarKeyIndex[str, int]):
@@ -60,9 +66,10 @@ def test_similar_index() -> None:
         assert set(x.get_random_keys(i)) == keys
 
 
-def test_string_index() -> None:
-    """ Unit tests for the added functionality of the string-based search class. """
-    x = StripCaseIndex(' #{^}')
+@pytest.mark.parametrize("compact", [False, True])
+def test_string_index(compact) -> None:
+    """ Unit tests for the added functionality of the string-based search class. Storage must not matter. """
+    x = StripCaseIndex(' #{^}', compact=compact)
 
     # Similarity is based on string equality after removing case and stripping certain characters from the ends.
     x.update(['beautiful', 'Beautiful', '{^BEAUTIFUL}  ', 'ugly'])
@@ -101,8 +108,199 @@ def test_string_index() -> None:
     assert x.regex_match_keys('.*u.+y', count=None) == ['beautifully', 'ugly']
     assert set(x.regex_match_keys('')) == keys
 
+    # A search may resume from a cursor. The position of a key is a valid cursor to start a search with it.
+    cursor = x.position('beautiful')
+    assert x.prefix_match_keys('beau', count=2, start=cursor) == ['beautiful', 'BEAUTIFULLY']
+    assert x.regex_match_keys('.*ly', start=cursor) == ['beautifully', 'ugly']
+    assert x.prefix_match_keys('beau', start=x.position('ugly')) == []
+    assert x.prefix_match_keys('', start=len(x)) == []
+
+    # Counts for prefix searches are exact. Regex counts are bounded by the literal prefix and earlier searches.
+    assert x.prefix_count('beau') == 5
+    assert x.prefix_count('beau', start=cursor, stop=x.position('beautifully')) == 2
+    assert x.prefix_count('x') == 0
+    assert x.regex_count_bounds('.*ly', start=cursor) == (0, len(x) - cursor)
+    assert x.regex_count_bounds('ugl.') == (0, 2)
+    x.regex_match_keys('ugl.', count=10)
+    assert x.regex_count_bounds('ugl.') == (2, 2)
+    x.regex_match_keys('b.*', count=1)
+    assert x.regex_count_bounds('b.*') == (1, 5)
+
     # Regex errors still raise even if there are no possible matches.
     with pytest.raises(RegexError):
         x.regex_match_keys('beautiful...an open group(', count=1)
     with pytest.raises(RegexError):
         x.regex_match_keys('an open group with no matches(', count=5)
+
+
+def test_string_index_narrowing() -> None:
+    """ Searches for patterns typed one character at a time are narrowed using the results of earlier ones.
+        The results must be identical to those from an index with no memory of earlier searches. """
+    keys = ['beau', 'beautiful', 'Beautiful', 'beautifully', 'BEAUTIFULLY', 'ugly', 'ugliness', 'a\x01', 'a\x00b']
+    x = StripCaseIndex()
+    x.update(keys)
+    ref = StripCaseIndex()
+    ref.memo_size = 0
+    ref.update(keys)
+    typed = ['beautifully', 'b.autiful', '.*ly', 'u(g|x)liness', 'a\\01', 'a\\0b']
+    for text in typed:
+        for i in range(len(text) + 1):
+            pattern = text[:i]
+            for count in (1, 2, 100):
+                assert x.prefix_match_keys(pattern, count) == ref.prefix_match_keys(pattern, count)
+                try:
+                    expected = ref.regex_match_keys(pattern, count)
+                except RegexError:
+                    continue
+                assert x.regex_match_keys(pattern, count) == expected
+    # Changing the index must discard memoized results.
+    x.remove('ugly')
+    assert x.regex_match_keys('ug', 5) == ['ugliness']
+
+
+def test_string_index_regex_limits() -> None:
+    """ Patterns that could backtrack forever are rejected, and a search over its time limit returns partial results.
+        Every match before the point where a search stopped must be included, so it may resume from there. """
+    x = StripCaseIndex()
+    keys = [f"key{i:04}" for i in range(1000)]
+    x.update(keys)
+    for pattern in ['(a+)+$', '(a|aa)*c', '(.*a){20}', '(a*)*', '(a?a)+', r'(\w+\s?)+x', r'(x\S+)*', '.' * 5000]:
+        with pytest.raises(RegexError):
+            x.regex_match_keys(pattern)
+    # Loops with only one way to match, and repeats that aren't nested, are fine.
+    for pattern in ['(the|a)+', '(th|ab)*e', r'(\S+ )*x', '.*.*.*.*.*x', r'(\d+,)*\d+', '(a|ab)*c']:
+        assert x.regex_match_keys(pattern) == []
+    assert x.regex_match_keys('(k|x)ey0+1$', timeout=10.0) == ['key0001']
+    x.regex_block_size = 100
+    with pytest.raises(RegexTimeout) as exc_info:
+        x.regex_match_keys('.*5', 1000, timeout=0.0)
+    e = exc_info.value
+    assert e.idx_scanned == 100
+    assert e.keys == [k for k in keys[:100] if '5' in k]
+    assert x.regex_match_keys('.*5', 1000, start=e.idx_scanned) == [k for k in keys[100:] if '5' in k]
+
+
+def test_string_index_shards() -> None:
+    """ Regex searches over parallel shards must give the same results as a search in one process. """
+    keys = [f"{c}{i:03}" for c in "abc" for i in range(300)]
+    x = StripCaseIndex(shard_count=4)
+    x.shard_min_size = 10
+    x.update(keys)
+    ref = StripCaseIndex()
+    ref.update(keys)
+    try:
+        for pattern in ['.*5', '[ac]1.*2', '.*9$', 'b.*0', '.*x']:
+            for count in (None, 1, 5, 100, 1000):
+                for start in (0, 250, 899):
+                    expected = ref.regex_match_keys(pattern, count, start=start)
+                    assert x.regex_match_keys(pattern, count, start=start) == expected
+        # A change to the index must restart the shards with the new keys.
+        x.remove('a005')
+        ref.remove('a005')
+        assert x.regex_match_keys('.*05') == ref.regex_match_keys('.*05')
+    finally:
+        x.clear()
+
+
+def test_multidict() -> None:
+    """ Multidicts must keep every key in its original order. Equal value tuples may be shared. """
+    d = {"TH": "the", "-T": "the", "THE": "the", "AND": "and", "-PBD": "and", "OF": "of"}
+    fwd = forward_multidict(d)
+    assert fwd == {k: (v,) for k, v in d.items()}
+    rev = reverse_multidict(d)
+    assert rev == {"the": ("TH", "-T", "THE"), "and": ("AND", "-PBD"), "of": ("OF",)}
+    assert list(rev) == ["the", "and", "of"]
+    # Tuples from a base multidict are shared if (and only if) they are equal.
+    subset = {"AND": "and", "-PBD": "and", "TH": "the"}
+    rev_subset = reverse_multidict(subset, rev)
+    assert rev_subset == {"and": ("AND", "-PBD"), "the": ("TH",)}
+    assert rev_subset["and"] is rev["and"]
+    assert forward_multidict(subset, fwd)["TH"] is fwd["TH"]
+
+
+def test_sized_cache() -> None:
+    """ The cache must evict least recently used values by total size and count hits and misses. """
+    cache = SizedLRUCache(10)
+    assert cache.get("a", lambda: "aaaa") == "aaaa"
+    assert cache.get("b", lambda: "bbbb") == "bbbb"
+    assert cache.get("a", lambda: "") == "aaaa"
+    # "b" is now least recently used, so it must go to make room.
+    assert cache.get("c", lambda: "cccc") == "cccc"
+    assert "a" in cache and "b" not in cache and "c" in cache
+    info = cache.info()
+    assert (info.hits, info.misses, info.size, info.count) == (1, 3, 8, 2)
+    # A value larger than the entire cache is returned but not kept.
+    assert cache.get("d", lambda: "d" * 20) == "d" * 20
+    assert "d" not in cache and len(cache) == 2
+    cache.clear()
+    assert cache.info().size == 0 and not cache
+    # Values with a maximum age expire even if they are used often.
+    cache = SizedLRUCache(10, max_age=60.0)
+    cache.add("a", "aaaa")
+    assert cache.get("a", lambda: "") == "aaaa"
+    cache = SizedLRUCache(10, max_age=0.01)
+    cache.add("a", "aaaa")
+    sleep(0.05)
+    assert "a" not in cache and cache.info().size == 0
+    cache.add("b", "bbbb")
+    sleep(0.05)
+    assert cache.get("b", lambda: "new") == "new"
+    assert cache.info().size == 3
+
+
+def test_examples_file(tmp_path) -> None:
+    """ A memory-mapped examples index must act like the dict of dicts it was saved from. """
+    examples = {"a.": {"A": "a", "AEU": "ay", "-T": "the"},
+                "e.": {"AEU": "ay", "E": "e"},
+                "ü.": {"*U": "ü"},
+                "empty": {}}
+    filename = str(tmp_path / "examples.bin")
+    MappedExamplesFile.save(filename, "tag", examples)
+    mapped = MappedExamplesFile.open(filename)
+    assert mapped.tag == "tag"
+    assert "a." in mapped and "x." not in mapped
+    assert list(mapped) == list(examples)
+    assert [len(v) for v in mapped.values()] == [len(v) for v in examples.values()]
+    for rule_id, translations in examples.items():
+        assert dict(mapped[rule_id]) == translations
+        assert dict(map(mapped[rule_id].item_at, range(len(translations)))) == translations
+    # Key lookups decode each rule once, even through different views of the same rule.
+    assert mapped["a."]["AEU"] == "ay"
+    assert mapped["a."].get("X") is None
+    assert mapped["e."]["E"] == "e"
+    assert mapped.decoded("a.", ()) is mapped.decoded("a.", ())
+    with pytest.raises(KeyError):
+        mapped["x."]
+
+
+def _letter_masks(s:str) -> list:
+    """ For testing, strokes are separated by / and each lowercase letter is a key. """
+    return [sum(1 << (ord(c) - 97) for c in set(stroke)) for stroke in s.split("/")]
+
+
+def test_stroke_index() -> None:
+    """ Unit tests for stroke structure queries: chords in any stroke, at stroke positions, and stroke counts. """
+    keys = ["ab", "ab/c", "c/ab", "a/b", "abc/d/e", "", "xyz"]
+    x = StrokeMaskIndex(keys, _letter_masks)
+    assert len(x) == len(keys)
+
+    def search(pattern, count=None, start=0):
+        return [x.key(i) for i in x.search(parse_stroke_query(pattern, _letter_masks), count, start)]
+
+    assert search("ab") == ["ab", "ab/c", "c/ab", "abc/d/e"]
+    assert search("a b") == ["ab", "ab/c", "c/ab", "a/b", "abc/d/e"]
+    assert search("1:ab") == ["ab", "ab/c", "abc/d/e"]
+    assert search("2:ab") == ["c/ab"]
+    assert search("-1:ab") == ["ab", "c/ab"]
+    assert search("-3:c") == ["abc/d/e"]
+    assert search("=2") == ["ab/c", "c/ab", "a/b"]
+    assert search(">2") == ["abc/d/e"]
+    assert search("<2") == ["ab", "", "xyz"]
+    assert search("a <3 >1") == ["ab/c", "c/ab", "a/b"]
+    assert search("w") == []
+    # Paging by start position and count.
+    assert search("c", 2) == ["ab/c", "c/ab"]
+    assert search("c", 2, start=3) == ["abc/d/e"]
+    for bad_query in ["0:a", "a:b", "=", "<b", "a/b", "aB", "1:"]:
+        with pytest.raises(StrokeQueryError):
+            parse_stroke_query(bad_query, _letter_masks)